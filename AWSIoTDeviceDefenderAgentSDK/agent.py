@@ -15,12 +15,20 @@
 from awscrt import io, mqtt, auth, http
 from awsiot import mqtt_connection_builder
 from AWSIoTDeviceDefenderAgentSDK import collector
+from AWSIoTDeviceDefenderAgentSDK import inflight
+from AWSIoTDeviceDefenderAgentSDK import offlinebuffer
+from AWSIoTDeviceDefenderAgentSDK import pipeline
+from AWSIoTDeviceDefenderAgentSDK import reportlog
+from AWSIoTDeviceDefenderAgentSDK import targets
 import logging
 import argparse
-from time import sleep
+import os
+from collections import OrderedDict
+from functools import partial
 from socket import gethostname
 import cbor
 import sys
+import threading
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
@@ -47,6 +55,12 @@ def on_resubscribe_complete(resubscribe_future):
             if qos is None:
                 sys.exit("Server rejected resubscribe to topic: {}".format(topic))
 
+def create_client_bootstrap(threads=1):
+    """Event loop group, host resolver and client bootstrap, which several connections can share."""
+    event_loop_group = io.EventLoopGroup(threads)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    return io.ClientBootstrap(event_loop_group, host_resolver)
+
 class IoTClientWrapper(object):
     """
     Wrapper around the AWS Iot Python SDK.
@@ -68,13 +82,26 @@ class IoTClientWrapper(object):
         self.proxy_port = proxy_port
         self.use_websocket = use_websocket
         self.iot_client = None
+        # Called without arguments when the connection is interrupted or resumed, after the default callbacks
+        self.interrupted_callbacks = []
+        self.resumed_callbacks = []
+
+    def _on_connection_interrupted(self, connection, error, **kwargs):
+        on_connection_interrupted(connection, error, **kwargs)
+        for callback in self.interrupted_callbacks:
+            callback()
 
-    def publish(self, publish_to_topic, payload):
+    def _on_connection_resumed(self, connection, return_code, session_present, **kwargs):
+        on_connection_resumed(connection, return_code, session_present, **kwargs)
+        for callback in self.resumed_callbacks:
+            callback()
+
+    def publish(self, publish_to_topic, payload, qos=mqtt.QoS.AT_MOST_ONCE):
         """Publish to MQTT"""
         publish_future, packet_id = self.iot_client.publish(
             topic=publish_to_topic,
             payload=payload,
-            qos=mqtt.QoS.AT_MOST_ONCE)
+            qos=qos)
         return publish_future
 
     def subscribe(self, subscribe_to_topic, callback):
@@ -88,16 +115,15 @@ class IoTClientWrapper(object):
         print("Subscribed to "+subscribe_to_topic+" with "+str(subscribe_result['qos']))
         return subscribe_result
 
-    def connect(self):
-        """Connect to AWS IoT"""
+    def connect(self, client_bootstrap=None):
+        """Connect to AWS IoT, over the resources of ``client_bootstrap`` if given"""
         if not self.certificate_path or not self.private_key_path:
             print("Missing credentials for authentication.")
             exit(2)
 
         # Spin up resources
-        event_loop_group = io.EventLoopGroup(1)
-        host_resolver = io.DefaultHostResolver(event_loop_group)
-        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+        if client_bootstrap is None:
+            client_bootstrap = create_client_bootstrap()
 
         if self.use_websocket == True:
             proxy_options = None
@@ -112,8 +138,8 @@ class IoTClientWrapper(object):
                 credentials_provider=credentials_provider,
                 websocket_proxy_options=proxy_options,
                 ca_filepath=self.root_ca_path,
-                on_connection_interrupted=on_connection_interrupted,
-                on_connection_resumed=on_connection_resumed,
+                on_connection_interrupted=self._on_connection_interrupted,
+                on_connection_resumed=self._on_connection_resumed,
                 client_id=self.client_id,
                 clean_session=False,
                 keep_alive_secs=6)
@@ -125,8 +151,8 @@ class IoTClientWrapper(object):
                 pri_key_filepath=self.private_key_path,
                 client_bootstrap=client_bootstrap,
                 ca_filepath=self.root_ca_path,
-                on_connection_interrupted=on_connection_interrupted,
-                on_connection_resumed=on_connection_resumed,
+                on_connection_interrupted=self._on_connection_interrupted,
+                on_connection_resumed=self._on_connection_resumed,
                 client_id=self.client_id,
                 clean_session=False,
                 keep_alive_secs=6)
@@ -138,7 +164,6 @@ class IoTClientWrapper(object):
 
         # Future.result() waits until a result is available
         connect_future.result()
-        sleep(2)
 
 
 def parse_args():
@@ -178,13 +203,59 @@ def parse_args():
     parser.add_argument('--verbosity', action="store", dest="verbosity", choices=[x.name for x in io.LogLevel], default=io.LogLevel.NoLogs.name,
                         help='Logging level')
     parser.add_argument('-cm','--include-custom-metrics','--custom-metrics', action="store_true", dest="custom_metrics", default=False, help="Adds custom metrics to payload.")
-    return parser.parse_args()
+    parser.add_argument("--backend", action="store", dest="backend", choices=collector.BACKENDS,
+                        default=collector.BACKEND_PSUTIL,
+                        help="Socket enumeration backend, procfs and sock_diag are Linux only")
+    parser.add_argument("--offline-buffer", action="store", dest="offline_buffer", default=None,
+                        help="Directory where reports are kept while the connection is down, they are lost if omitted")
+    parser.add_argument("--offline-buffer-size", action="store", dest="offline_buffer_size", type=int, default=10,
+                        help="Size of the offline buffer in MiB, the oldest reports are evicted beyond it")
+    parser.add_argument("--drain-rate", action="store", dest="drain_rate", type=float,
+                        default=offlinebuffer.BufferedPublisher.DRAIN_RATE,
+                        help="Reports per second published from the offline buffer once the connection resumes")
+    parser.add_argument("--qos", action="store", dest="qos", type=int, choices=[0, 1], default=0,
+                        help="MQTT quality of service of published reports")
+    parser.add_argument("--track-delivery", action="store_true", dest="track_delivery", default=False,
+                        help="Match reports with accepted/rejected responses, retrying rejected and unanswered ones")
+    parser.add_argument("--delivery-window", action="store", dest="delivery_window", type=int,
+                        default=inflight.InFlightTracker.WINDOW,
+                        help="Maximum number of reports awaiting a response when tracking delivery")
+    parser.add_argument("--delivery-timeout", action="store", dest="delivery_timeout", type=float,
+                        default=inflight.InFlightTracker.TIMEOUT,
+                        help="Seconds to wait for a response before publishing a report again")
+    parser.add_argument("--target", action="append", dest="targets", default=[], metavar="THING[=PROCFS]",
+                        help="Thing to publish metrics for, collected from the given proc filesystem, such as " +
+                        "/proc/<pid> of a process in a container's network namespace. Repeat for each thing")
+    parser.add_argument("--connections", action="store", dest="connections", type=int, default=1,
+                        help="Number of MQTT connections the reports of all targets are published over")
+    parser.add_argument("--workers", action="store", dest="workers", type=int,
+                        default=targets.MultiCollector.WORKERS,
+                        help="Number of threads collecting the metrics of targets concurrently")
+    parser.add_argument("--parallel-collection", action="store_true", dest="parallel_collection", default=False,
+                        help="Collect metric families concurrently, parsing sockets on a process pool")
+    parser.add_argument("--per-interface-stats", action="store_true", dest="per_interface_stats", default=False,
+                        help="Read network stats of each interface, reporting their sum over interfaces present " +
+                        "in consecutive readings")
+    parser.add_argument("--max-payload-size", action="store", dest="max_payload_size", type=int, default=None,
+                        help="Maximum size of an encoded report in bytes, such as 131072 for the MQTT message limit. " +
+                        "Connection and port lists are sampled down to fit")
+    parser.add_argument("--report-log", action="store", dest="report_log", default=None,
+                        help="File every report is appended to in CBOR, with an index of report ids next to it, " +
+                        "including in dry run")
+    parser.add_argument("--stable-sampling", action="store_true", dest="stable_sampling", default=False,
+                        help="Sample large connection and port lists by hash, so the same entries are reported " +
+                        "every cycle")
+    args = parser.parse_args()
+    if args.connections < 1:
+        parser.error("--connections must be at least 1")
+    if args.max_payload_size is not None and args.max_payload_size < 1:
+        parser.error("--max-payload-size must be at least 1")
+    return args
 
 def custom_callback(topic, payload, **kwargs):
     print("Received message from topic '{}': {}".format(topic, payload))
-    raw_payload = payload.decode('utf-8')
     if 'json' in topic:
-        print(raw_payload)
+        print(payload.decode('utf-8'))
     else:
         print(cbor.loads(payload))
 
@@ -192,60 +263,193 @@ def custom_callback(topic, payload, **kwargs):
         print(topic)
         print("--------------\n\n")
 
+def connection_publisher(args, iot_client, offline_buffer=None):
+    """
+    Publish function of a connection, with the quality of service requested on the command line.
+
+    If ``offline_buffer`` is a directory, reports published while the connection is down are kept there and
+    published once it resumes.
+    """
+    publish = partial(iot_client.publish, qos=mqtt.QoS(args.qos))
+    if offline_buffer:
+        max_bytes = args.offline_buffer_size * 1024 * 1024
+        buffered = offlinebuffer.BufferedPublisher(
+            publish,
+            offlinebuffer.OfflineBuffer(offline_buffer, max_bytes,
+                                        min(max_bytes, offlinebuffer.OfflineBuffer.SEGMENT_BYTES)),
+            args.drain_rate)
+        iot_client.interrupted_callbacks.append(buffered.interrupted)
+        iot_client.resumed_callbacks.append(buffered.resumed)
+        # deliver reports buffered before the agent was last stopped
+        buffered.resumed()
+        publish = buffered.publish
+    return publish
+
+
+def report_publisher(args, iot_client, publish, topic):
+    """
+    Subscribe to the responses to the reports published on ``topic``.
+
+    Returns
+    -------
+        A ``(publish_report, tracker)`` pair, ``publish_report`` being called with a topic, a payload and a report
+        id. ``tracker`` is the :class:`~inflight.InFlightTracker` of the topic, or None if delivery is not tracked.
+    """
+    tracker = None
+    if args.track_delivery:
+        tracker = inflight.InFlightTracker(publish, window=args.delivery_window, timeout=args.delivery_timeout)
+
+        def tracked_callback(topic, payload, **kwargs):
+            # acknowledge the report before printing the response, which may fail to decode
+            tracker.on_response(topic, payload)
+            custom_callback(topic, payload, **kwargs)
+        response_callback = tracked_callback
+    else:
+        response_callback = custom_callback
+
+    # Subscribe to the accepted/rejected topics to indicate status of published metrics reports
+    iot_client.subscribe(topic + "/accepted", response_callback)
+    iot_client.subscribe(topic + "/rejected", response_callback)
+
+    if tracker is not None:
+        return tracker.publish, tracker
+
+    def publish_report(topic, payload, report_id):
+        return publish(topic, payload)
+    return publish_report, None
+
+
+def check_deliveries(trackers, stop, period=1.0):
+    """Retry and time out the reports of every tracker, until ``stop`` is set."""
+    while not stop.wait(period):
+        for tracker in trackers:
+            tracker.check()
+
+
 def main():
     # Read in command-line parameters
     args = parse_args()
     io.init_logging(getattr(io.LogLevel, args.verbosity), 'stderr')
-    if not args.dry_run:
-        client_id = ""
-        thing_name = ""
-
-        if not args.client_id:
-            client_id = gethostname()
-        else:
-            client_id = args.client_id
-        
-        if not args.thing_name:
-            thing_name = client_id
-        else:
-            thing_name = args.thing_name
 
-        iot_client = IoTClientWrapper(args.endpoint, args.root_ca_path,
-                                      args.certificate_path, args.private_key_path, client_id,
-                                      args.signing_region, args.proxy_host, args.proxy_port,
-                                      args.use_websocket)
-        iot_client.connect()
+    if not args.client_id:
+        client_id = gethostname()
+    else:
+        client_id = args.client_id
 
-        # client_id must match a registered thing name in your account
-        topic = "$aws/things/" + thing_name + "/defender/metrics/" + args.format
+    if args.targets:
+        target_list = [targets.parse_target(spec) for spec in args.targets]
+    else:
+        target_list = [targets.Target(args.thing_name or client_id, None)]
+
+    # client_id must match a registered thing name in your account, or its policy must allow publishing for them
+    topics = OrderedDict((target.thing_name, "$aws/things/" + target.thing_name + "/defender/metrics/" + args.format)
+                         for target in target_list)
+
+    #  Collector samples metrics from the system, it can track the previous metric to generate deltas.
+    #  It is built before connecting, so the workers of its process pool are forked before MQTT and delivery
+    #  tracking threads exist.
+    collector_options = dict(short_metrics_names=args.short_tags, use_custom_metrics=args.custom_metrics,
+                             backend=args.backend, stable_sampling=args.stable_sampling,
+                             parallel=args.parallel_collection, per_interface=args.per_interface_stats)
+    if args.targets:
+        coll = targets.MultiCollector(target_list, args.workers, **collector_options)
+    else:
+        coll = collector.Collector(**collector_options)
 
-        # Subscribe to the accepted/rejected topics to indicate status of published metrics reports
-        iot_client.subscribe(topic + "/accepted", custom_callback)
-        iot_client.subscribe(topic + "/rejected", custom_callback)
+    # topic -> function publishing a report of the thing to it
+    publishers = {}
+    if not args.dry_run:
+        # every connection shares the same event loop group, resolver and bootstrap
+        client_bootstrap = create_client_bootstrap(args.connections)
+        connections = []
+        for index in range(args.connections):
+            iot_client = IoTClientWrapper(args.endpoint, args.root_ca_path,
+                                          args.certificate_path, args.private_key_path,
+                                          client_id if args.connections == 1 else "{}-{}".format(client_id, index),
+                                          args.signing_region, args.proxy_host, args.proxy_port,
+                                          args.use_websocket)
+            iot_client.connect(client_bootstrap)
+
+            offline_buffer = args.offline_buffer
+            if offline_buffer and args.connections > 1:
+                offline_buffer = os.path.join(offline_buffer, str(index))
+            connections.append((iot_client, connection_publisher(args, iot_client, offline_buffer)))
+
+        trackers = []
+        for index, topic in enumerate(topics.values()):
+            iot_client, publish = connections[index % len(connections)]
+            publishers[topic], tracker = report_publisher(args, iot_client, publish, topic)
+            if tracker is not None:
+                trackers.append(tracker)
+
+        if trackers:
+            tracker_thread = threading.Thread(target=check_deliveries, args=(trackers, threading.Event()),
+                                              name="delivery-tracker")
+            tracker_thread.daemon = True
+            tracker_thread.start()
 
     sample_rate = args.upload_interval
 
-    #  Collector samples metrics from the system, it can track the previous metric to generate deltas
-    coll = collector.Collector(args.short_tags, args.custom_metrics)
-
-    metric = None
-    first_sample = True  # don't publish first sample, so we can accurately report delta metrics
-    while True:
-        metric = coll.collect_metrics()
+    first_sample = [True]  # don't publish first sample, so we can accurately report delta metrics
+
+    def fit_budget(metric):
+        if args.max_payload_size:
+            metric.payload_format = args.format
+            metric.max_payload_size = args.max_payload_size
+        return metric
+
+    report_log = reportlog.ReportLog(args.report_log) if args.report_log else None
+
+    def log_report(thing_name, metric, payload=None):
+        if report_log is not None:
+            report_log.append(metric.report_id, metric.to_cbor() if payload is None else payload, thing_name)
+        return metric
+
+    def message(thing_name, metric):
+        fit_budget(metric)
+        if args.format == "cbor" and not args.dry_run:
+            # encoded once, for both the log and the publish
+            payload = metric.to_cbor()
+            log_report(thing_name, metric, payload)
+            return topics[thing_name], payload, metric.report_id
+        log_report(thing_name, metric)
         if args.dry_run:
-            print(metric.to_json_string(pretty_print=True))
-            if args.format == 'cbor':
-                with open("cbor_metrics", "w+b") as outfile:
-                    outfile.write(bytearray(metric.to_cbor()))
-        else:
-            if first_sample:
-                first_sample = False
-            elif args.format == "cbor":
-                iot_client.publish(topic, bytearray(metric.to_cbor()))
-            else:
-                iot_client.publish(topic, metric.to_json_string())
-
-        sleep(float(sample_rate))
+            return thing_name, metric
+        return topics[thing_name], metric.to_json_string(), metric.report_id
+
+    def serialize(report):
+        if args.dry_run and not args.targets:
+            return "", log_report(target_list[0].thing_name, fit_budget(report))
+        if first_sample[0] and not args.dry_run:
+            first_sample[0] = False
+            return None
+        if args.targets:
+            return [message(target.thing_name, metric) for target, metric in report]
+        return message(target_list[0].thing_name, report)
+
+    # reused between reports, the CBOR encoder writes straight into it
+    cbor_buffer = bytearray()
+
+    def dry_run_publish(thing_name, metric):
+        if thing_name:
+            print(thing_name + ":")
+        print(metric.to_json_string(pretty_print=True))
+        if args.format == 'cbor':
+            with open("cbor_metrics", "w+b") as outfile:
+                outfile.write(metric.to_cbor(cbor_buffer))
+
+    def publish_report(topic, payload, report_id):
+        return publishers[topic](topic, payload, report_id)
+
+    # Sampling, serialization and publishing run concurrently, so a slow publish does not delay the next sample
+    publish_pipeline = pipeline.PublishPipeline(
+        coll.collect_metrics, serialize, dry_run_publish if args.dry_run else publish_report, sample_rate,
+        queue_size=max(pipeline.PublishPipeline.QUEUE_SIZE, 2 * len(target_list)),
+        max_in_flight=max(pipeline.PublishPipeline.MAX_IN_FLIGHT, len(target_list)))
+    publish_pipeline.run()
+    coll.close()
+    if report_log is not None:
+        report_log.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,188 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import struct
+
+# CBOR major types, shifted into the high bits of the initial byte (RFC 7049)
+MAJOR_UINT = 0x00
+MAJOR_NEGINT = 0x20
+MAJOR_BYTES = 0x40
+MAJOR_TEXT = 0x60
+MAJOR_ARRAY = 0x80
+MAJOR_MAP = 0xa0
+
+CBOR_FALSE = b'\xf4'
+CBOR_TRUE = b'\xf5'
+CBOR_NULL = b'\xf6'
+CBOR_FLOAT64 = 0xfb
+
+_UINT8 = struct.Struct('>BB')
+_UINT16 = struct.Struct('>BH')
+_UINT32 = struct.Struct('>BI')
+_UINT64 = struct.Struct('>BQ')
+_FLOAT64 = struct.Struct('>Bd')
+
+
+def _header(major, value):
+    """Initial byte and argument of a data item, in its shortest form."""
+    if value < 24:
+        return bytes((major | value,))
+    if value < 0x100:
+        return _UINT8.pack(major | 24, value)
+    if value < 0x10000:
+        return _UINT16.pack(major | 25, value)
+    if value < 0x100000000:
+        return _UINT32.pack(major | 26, value)
+    return _UINT64.pack(major | 27, value)
+
+
+class CborWriter(object):
+    """
+    Minimal CBOR encoder writing straight into a ``bytearray``.
+
+    Only the types found in metrics reports are supported: maps, arrays, text and byte strings,
+    integers, floats, booleans and null. Output matches the ``cbor`` package, containers are
+    encoded with definite lengths and floats as 64-bit doubles.
+
+    Maps and arrays are written as a header announcing their size, followed by their members, so
+    :meth:`end_map` and :meth:`end_array` only exist to share the interface of other report writers.
+    """
+
+    # Encoded form of recently written text strings, report keys repeat for every list entry
+    _text_cache = {}
+    TEXT_CACHE_SIZE = 1024
+    # Encoded map header and keys of record() calls
+    _record_cache = {}
+
+    def __init__(self, buffer=None):
+        """
+        Parameters
+        ----------
+        buffer: bytearray
+            Buffer to write into, it is cleared first. A new one is allocated if omitted.
+        """
+        if buffer is None:
+            buffer = bytearray()
+        else:
+            del buffer[:]
+        self.buffer = buffer
+
+    def begin_map(self, size):
+        self.buffer += _header(MAJOR_MAP, size)
+
+    def end_map(self):
+        pass
+
+    def begin_array(self, size):
+        self.buffer += _header(MAJOR_ARRAY, size)
+
+    def end_array(self):
+        pass
+
+    def key(self, key):
+        self.text(key)
+
+    def text(self, value):
+        encoded = self._text_cache.get(value)
+        if encoded is None:
+            encoded = self._encode_text(value)
+            if len(self._text_cache) < self.TEXT_CACHE_SIZE:
+                self._text_cache[value] = encoded
+        self.buffer += encoded
+
+    @staticmethod
+    def _encode_text(value):
+        data = value.encode('utf-8')
+        return _header(MAJOR_TEXT, len(data)) + data
+
+    def record(self, keys, values):
+        """
+        Write a map of ``keys`` to ``values``, the common case for list entries.
+
+        ``keys`` should be a tuple reused across calls, as its encoding is cached.
+        """
+        encoded_keys = self._record_keys(keys)
+        buffer = self.buffer
+        for encoded_key, value in zip(encoded_keys, values):
+            buffer += encoded_key
+            # exact type checks, bool is a subclass of int
+            if value.__class__ is str:
+                data = value.encode('utf-8')
+                buffer += _header(MAJOR_TEXT, len(data))
+                buffer += data
+            elif value.__class__ is int and value >= 0:
+                buffer += _header(MAJOR_UINT, value)
+            else:
+                self.value(value)
+
+    def record_size(self, keys, values):
+        """Number of bytes :meth:`record` writes for ``keys`` and ``values``."""
+        size = 0
+        for encoded_key, value in zip(self._record_keys(keys), values):
+            size += len(encoded_key)
+            if value.__class__ is str:
+                length = len(value.encode('utf-8'))
+                size += len(_header(MAJOR_TEXT, length)) + length
+            elif value.__class__ is int and value >= 0:
+                size += len(_header(MAJOR_UINT, value))
+            elif value is None:
+                size += len(CBOR_NULL)
+            else:
+                writer = CborWriter()
+                writer.value(value)
+                size += len(writer.buffer)
+        return size
+
+    def _record_keys(self, keys):
+        encoded_keys = self._record_cache.get(keys)
+        if encoded_keys is None:
+            encoded_keys = [self._encode_text(k) for k in keys]
+            encoded_keys[0] = _header(MAJOR_MAP, len(keys)) + encoded_keys[0]
+            self._record_cache[keys] = encoded_keys
+        return encoded_keys
+
+    def integer(self, value):
+        if value >= 0:
+            self.buffer += _header(MAJOR_UINT, value)
+        else:
+            self.buffer += _header(MAJOR_NEGINT, -1 - value)
+
+    def value(self, value):
+        """Write any supported value, containers are written recursively."""
+        buffer = self.buffer
+        if isinstance(value, str):
+            self.text(value)
+        elif value is True:
+            buffer += CBOR_TRUE
+        elif value is False:
+            buffer += CBOR_FALSE
+        elif isinstance(value, int):
+            self.integer(value)
+        elif isinstance(value, float):
+            buffer += _FLOAT64.pack(CBOR_FLOAT64, value)
+        elif value is None:
+            buffer += CBOR_NULL
+        elif isinstance(value, dict):
+            self.begin_map(len(value))
+            for k, v in value.items():
+                self.value(k)
+                self.value(v)
+        elif isinstance(value, (list, tuple)):
+            self.begin_array(len(value))
+            for v in value:
+                self.value(v)
+        elif isinstance(value, (bytes, bytearray)):
+            buffer += _header(MAJOR_BYTES, len(value))
+            buffer += value
+        else:
+            raise TypeError("Unsupported type for CBOR encoding: " + type(value).__name__)
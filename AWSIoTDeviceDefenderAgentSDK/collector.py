@@ -15,8 +15,184 @@
 import psutil as ps
 import socket
 from AWSIoTDeviceDefenderAgentSDK import metrics
+from AWSIoTDeviceDefenderAgentSDK.metrics import NetworkStats
+from AWSIoTDeviceDefenderAgentSDK import procnet
+from AWSIoTDeviceDefenderAgentSDK import sockdiag
+from AWSIoTDeviceDefenderAgentSDK.scheduler import Scheduler
 import argparse
-from time import sleep
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class InterfaceIndex(object):
+    """
+    Maps local IP addresses to the name of the interface they are assigned to.
+
+    The index is built from a single ``psutil.net_if_addrs`` call, or :func:`~procnet.net_if_addrs` for another
+    network namespace, so resolving the interface of a connection is a dictionary lookup rather than a scan over
+    every address of every interface.
+    """
+    __slots__ = ('_interfaces',)
+
+    WILDCARD_ADDRESSES = ('0.0.0.0', '::')
+    IPV4_MAPPED_PREFIX = '::ffff:'
+
+    def __init__(self, if_addrs):
+        """
+        Parameters
+        ----------
+        if_addrs : dict
+                Interface name to address list mapping, as returned by ``psutil.net_if_addrs``.
+        """
+        interfaces = {}
+        for iface, snics in if_addrs.items():
+            for snic in snics:
+                if snic.family not in (socket.AF_INET, socket.AF_INET6):
+                    continue
+                # link-local IPv6 addresses carry a zone index, e.g. fe80::1%eth0
+                address = snic.address.split('%', 1)[0]
+                # the first interface claiming an address wins, as with a linear scan
+                interfaces.setdefault(address, iface)
+        self._interfaces = interfaces
+
+    @classmethod
+    def take(cls, procfs_path=None):
+        """
+        Build an index of the addresses currently assigned to the system's interfaces.
+
+        Parameters
+        ----------
+        procfs_path : string
+                Proc filesystem of another network namespace to read the addresses of, the agent's own if None.
+        """
+        if procfs_path is None:
+            return cls(ps.net_if_addrs())
+        return cls(procnet.net_if_addrs(procfs_path))
+
+    def interface_name(self, address):
+        """
+        Name of the interface owning ``address``, or ``None`` if no interface does.
+
+        Wildcard addresses are returned unchanged, and IPv4-mapped IPv6 addresses
+        (``::ffff:10.0.0.1``) resolve to the interface of the embedded IPv4 address.
+        """
+        if address in self.WILDCARD_ADDRESSES:
+            return address
+
+        iface = self._interfaces.get(address)
+        if iface is None and address.startswith(self.IPV4_MAPPED_PREFIX):
+            iface = self._interfaces.get(address[len(self.IPV4_MAPPED_PREFIX):])
+        return iface
+
+
+class SocketSnapshot(object):
+    """
+    Immutable view of the system's inet sockets, taken once per collection cycle.
+
+    Enumerating sockets is the dominant cost of a collection cycle, so every metric family
+    derived from socket state reads from the same snapshot instead of querying the system again.
+    """
+    __slots__ = ('connections', 'interfaces')
+
+    def __init__(self, connections, interfaces):
+        """
+        Parameters
+        ----------
+        connections : iterable
+                Connection records shaped like the ones returned by ``psutil.net_connections``.
+        interfaces : InterfaceIndex
+                Address to interface index used to resolve the local interface of each connection.
+        """
+        self.connections = tuple(connections)
+        self.interfaces = interfaces
+
+    @classmethod
+    def take(cls, net_connections=None, procfs_path=None):
+        """
+        Enumerate all inet (TCP and UDP, IPv4 and IPv6) sockets in a single pass.
+
+        Parameters
+        ----------
+        net_connections : callable
+                Returns the connection records to snapshot, defaults to ``psutil.net_connections``.
+        procfs_path : string
+                Proc filesystem of the network namespace the connections belong to, the agent's own if None.
+        """
+        if net_connections is None:
+            connections = ps.net_connections(kind='inet')
+        else:
+            connections = net_connections()
+        return cls(connections, InterfaceIndex.take(procfs_path))
+
+    def interface_name(self, address):
+        """Name of the local interface owning ``address``, see :meth:`InterfaceIndex.interface_name`."""
+        return self.interfaces.interface_name(address)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(self.connections)
+
+
+BACKEND_PSUTIL = 'psutil'
+BACKEND_PROCFS = 'procfs'
+BACKEND_SOCK_DIAG = 'sock_diag'
+BACKENDS = (BACKEND_PSUTIL, BACKEND_PROCFS, BACKEND_SOCK_DIAG)
+
+
+def _listening_ports(snapshot):
+    """Ports of the listening TCP sockets and of the UDP sockets of a snapshot, as ``(tcp_ports, udp_ports)``."""
+    udp_ports = []
+    tcp_ports = []
+    for conn in snapshot:
+        if conn.status == "LISTEN" and conn.type == socket.SOCK_STREAM:
+            iface = snapshot.interface_name(conn.laddr.ip)
+            if iface:
+                tcp_ports.append({'port': conn.laddr.port, 'interface': iface})
+            else:
+                tcp_ports.append({'port': conn.laddr.port})
+        if conn.type == socket.SOCK_DGRAM:  # on Linux, udp socket status is always "NONE"
+            iface = snapshot.interface_name(conn.laddr.ip)
+            if iface:
+                udp_ports.append({'port': conn.laddr.port, 'interface': iface})
+            else:
+                udp_ports.append({'port': conn.laddr.port})
+    return tcp_ports, udp_ports
+
+
+def _established_connections(snapshot):
+    """Established TCP connections of a snapshot, as ``(remote_ip, remote_port, interface, local_port)`` tuples."""
+    connections = []
+    for c in snapshot:
+        if c.type != socket.SOCK_STREAM:
+            continue
+        try:
+            if c.status == "ESTABLISHED" or c.status == "BOUND":
+                connections.append((c.raddr.ip, c.raddr.port, snapshot.interface_name(c.laddr.ip), c.laddr.port))
+        except Exception as ex:
+            print('Failed to parse network info for protocol: tcp')
+            print(ex)
+    return connections
+
+
+def _collect_sockets(backend, procfs_path, files, interfaces):
+    """
+    Enumerate sockets and extract the reported ports and connections, in a worker process.
+
+    Returns
+    -------
+        A ``(tcp_ports, udp_ports, connections)`` tuple, only these small lists are sent back to the agent.
+    """
+    if backend == BACKEND_PROCFS:
+        connections = procnet.ProcNetReader(procfs_path).net_connections(files=files)
+    elif backend == BACKEND_SOCK_DIAG:
+        connections = sockdiag.SockDiagReader().net_connections()
+    else:
+        connections = ps.net_connections(kind='inet')
+    snapshot = SocketSnapshot(connections, interfaces)
+    tcp_ports, udp_ports = _listening_ports(snapshot)
+    return tcp_ports, udp_ports, _established_connections(snapshot)
 
 
 class Collector(object):
@@ -25,9 +201,19 @@ class Collector(object):
 
     This implementation utilizes `psutil <https://psutil.readthedocs.io/en/latest/>`_
     to make parsing metrics easier and more cross-platform.
+
+    On Linux, sockets can instead be enumerated by the ``procfs`` backend, which parses ``/proc/net/*``
+    directly and skips psutil's mapping of sockets to processes, or by the ``sock_diag`` backend, which
+    queries the kernel over netlink for only the socket states that are reported.
+
+    In parallel mode, metric families are collected concurrently: interface counters and CPU usage on threads,
+    since reading them is dominated by system calls, and socket parsing with interface resolution on a process
+    pool, one task per ``/proc/net`` table with the procfs backend. The results are merged into a single
+    metrics object, in the same order as a sequential collection.
     """
 
-    def __init__(self, short_metrics_names=False, use_custom_metrics=True):
+    def __init__(self, short_metrics_names=False, use_custom_metrics=True, backend=BACKEND_PSUTIL,
+                 stable_sampling=False, procfs_path=None, parallel=False, process_pool=None, per_interface=False):
         """
         Parameters
         ----------
@@ -35,48 +221,112 @@ class Collector(object):
                 Toggle short object tags in output metrics.
         use_custom_metrics : bool
                 Toggle whether to collect custom metrics.
+        backend : string
+                Socket enumeration backend, one of ``BACKENDS``. The ``procfs`` backend falls back to
+                psutil if the socket tables under ``psutil.PROCFS_PATH`` cannot be read, the ``sock_diag``
+                backend if netlink sock_diag sockets are not supported.
+        stable_sampling : bool
+                Sample large lists by hash, so the same entries are reported every cycle, see :class:`~metrics.Metrics`.
+        procfs_path : string
+                Proc filesystem to collect from instead of the agent's own, such as ``/proc/<pid>`` of a process
+                in another network namespace. Sockets and network counters are then always read from it by the
+                ``procfs`` backend, whichever ``backend`` is requested, and interfaces are resolved against the
+                addresses of its namespace, see :func:`~procnet.net_if_addrs`.
+        parallel : bool
+                Collect metric families concurrently, see above.
+        process_pool : concurrent.futures.Executor
+                Pool parsing sockets in parallel mode, which several collectors can share. A pool with a worker
+                per CPU is created if omitted, and shut down by :meth:`close`.
+        per_interface : bool
+                Read the traffic counters of each network interface, see :meth:`~metrics.Metrics.add_interface_stats`.
         """
+        if backend not in BACKENDS:
+            raise ValueError("Invalid collection backend: " + str(backend))
+        if procfs_path is not None and not procnet.available(procfs_path):
+            raise ValueError("Socket tables not readable under " + procfs_path)
+
         # Keep a copy of the last metric, if there is one, so we can calculate change in some metrics.
         self._last_metric = None
         self._short_names = short_metrics_names
         self._use_custom_metrics = use_custom_metrics
+        self._stable_sampling = stable_sampling
+        self._procfs_path = procfs_path
+        self._per_interface = per_interface
 
-    @staticmethod
-    def __get_interface_name(address):
+        self._backend = BACKEND_PSUTIL
+        self._reader = None
+        if procfs_path is not None:
+            self._backend = BACKEND_PROCFS
+            self._reader = procnet.ProcNetReader(procfs_path)
+        elif backend == BACKEND_PROCFS:
+            if procnet.available(ps.PROCFS_PATH):
+                self._backend = backend
+                self._reader = procnet.ProcNetReader(ps.PROCFS_PATH)
+            else:
+                print("Socket tables not readable under " + ps.PROCFS_PATH + ", falling back to psutil")
+        elif backend == BACKEND_SOCK_DIAG:
+            if sockdiag.available():
+                self._backend = backend
+                self._reader = sockdiag.SockDiagReader()
+            else:
+                print("Netlink sock_diag not supported, falling back to psutil")
 
-        if address == '0.0.0.0' or address == '::':
-            return address
+        self._parallel = parallel
+        self._process_pool = process_pool
+        self._threads = None
+        self._own_pool = False
+        if parallel:
+            self._threads = ThreadPoolExecutor(max_workers=2)
+            if process_pool is None:
+                self._process_pool = ProcessPoolExecutor()
+                self._own_pool = True
+                # start the workers now, before the agent starts threads that forked children would inherit
+                self._process_pool.submit(int).result()
+
+    @property
+    def backend(self):
+        """Name of the socket enumeration backend in use."""
+        return self._backend
 
-        for iface in ps.net_if_addrs():
-            for snic in ps.net_if_addrs()[iface]:
-                if snic.address == address:
-                    return iface
+    @property
+    def procfs_path(self):
+        """Proc filesystem collected from, None for the agent's own."""
+        return self._procfs_path
 
-    def listening_ports(self, metrics):
+    def _net_connections(self):
+        if self._backend == BACKEND_PROCFS:
+            # PROCFS_PATH may be changed after construction, as the Greengrass sample does
+            return self._reader.net_connections(self._procfs_path or ps.PROCFS_PATH)
+        if self._backend == BACKEND_SOCK_DIAG:
+            return self._reader.net_connections()
+        return ps.net_connections(kind='inet')
+
+    def listening_ports(self, metrics, snapshot=None):
         """
         Iterate over all inet connections in the LISTEN state and extract port and interface.
+
+        If no socket snapshot is supplied, a new one is taken.
         """
-        udp_ports = []
-        tcp_ports = []
-        for conn in ps.net_connections(kind='inet'):
-            iface = Collector.__get_interface_name(conn.laddr.ip)
-            if conn.status == "LISTEN" and conn.type == socket.SOCK_STREAM:
-                if iface:
-                    tcp_ports.append({'port': conn.laddr.port, 'interface': iface})
-                else:
-                    tcp_ports.append({'port': conn.laddr.port})
-            if conn.type == socket.SOCK_DGRAM:  # on Linux, udp socket status is always "NONE"
-                if iface:
-                    udp_ports.append({'port': conn.laddr.port, 'interface': iface})
-                else:
-                    udp_ports.append({'port': conn.laddr.port})
+        if snapshot is None:
+            snapshot = SocketSnapshot.take(self._net_connections, self._procfs_path)
 
+        tcp_ports, udp_ports = _listening_ports(snapshot)
         metrics.add_listening_ports("UDP", udp_ports)
         metrics.add_listening_ports("TCP", tcp_ports)
 
-    @staticmethod
-    def network_stats(metrics):
-        net_counters = ps.net_io_counters(pernic=False)
+    def _net_io_counters(self):
+        if self._procfs_path is None:
+            return ps.net_io_counters(pernic=self._per_interface)
+        return procnet.net_io_counters(self._procfs_path, pernic=self._per_interface)
+
+    def network_stats(self, metrics, net_counters=None):
+        if net_counters is None:
+            net_counters = self._net_io_counters()
+        if self._per_interface:
+            metrics.add_interface_stats(
+                {name: NetworkStats(c.bytes_recv, c.bytes_sent, c.packets_recv, c.packets_sent)
+                 for name, c in net_counters.items()})
+            return
         metrics.add_network_stats(
             net_counters.bytes_recv,
             net_counters.packets_recv,
@@ -84,18 +334,17 @@ class Collector(object):
             net_counters.packets_sent)
 
     @staticmethod
-    def network_connections(metrics):
-        protocols = ['tcp']
-        for protocol in protocols:
-            for c in ps.net_connections(kind=protocol):
-                try:
-                    if c.status == "ESTABLISHED" or c.status == "BOUND":
-                        metrics.add_network_connection(c.raddr.ip, c.raddr.port,
-                                                       Collector.__get_interface_name(c.laddr.ip),
-                                                       c.laddr.port)
-                except Exception as ex:
-                    print('Failed to parse network info for protocol: ' + protocol)
-                    print(ex)
+    def network_connections(metrics, snapshot=None):
+        """
+        Add all established TCP connections to the metrics object.
+
+        If no socket snapshot is supplied, a new one is taken.
+        """
+        if snapshot is None:
+            snapshot = SocketSnapshot.take()
+
+        for connection in _established_connections(snapshot):
+            metrics.add_network_connection(*connection)
 
     @staticmethod
     def cpu_usage(metrics):
@@ -105,18 +354,64 @@ class Collector(object):
     def collect_metrics(self):
         """Sample system metrics and populate a metrics object suitable for publishing to Device Defender."""
         metrics_current = metrics.Metrics(
-            short_names=self._short_names, last_metric=self._last_metric)
+            short_names=self._short_names, last_metric=self._last_metric,
+            stable_sampling=self._stable_sampling)
 
-        self.network_stats(metrics_current)
-        self.listening_ports(metrics_current)
-        self.network_connections(metrics_current)
+        if self._parallel:
+            self._collect_parallel(metrics_current)
+        else:
+            self.network_stats(metrics_current)
 
-        if self._use_custom_metrics:
-            self.cpu_usage(metrics_current)
+            snapshot = SocketSnapshot.take(self._net_connections, self._procfs_path)
+            self.listening_ports(metrics_current, snapshot)
+            self.network_connections(metrics_current, snapshot)
 
+            if self._use_custom_metrics:
+                self.cpu_usage(metrics_current)
+
+        metrics_current.collection_end = time.monotonic()
         self._last_metric = metrics_current
         return metrics_current
 
+    def _collect_parallel(self, metrics_current):
+        counters = self._threads.submit(self._net_io_counters)
+        cpu_percent = self._threads.submit(ps.cpu_percent, None) if self._use_custom_metrics else None
+
+        # the index is small, every socket task gets a copy to resolve interfaces with
+        interfaces = InterfaceIndex.take(self._procfs_path)
+        if self._backend == BACKEND_PROCFS:
+            procfs_path = self._procfs_path or ps.PROCFS_PATH
+            tasks = [(procfs_path, (files,)) for files in procnet.PROC_NET_FILES]
+        else:
+            tasks = [(None, None)]
+        sockets = [self._process_pool.submit(_collect_sockets, self._backend, procfs_path, files, interfaces)
+                   for procfs_path, files in tasks]
+
+        self.network_stats(metrics_current, counters.result())
+
+        tcp_ports = []
+        udp_ports = []
+        connections = []
+        for future in sockets:
+            tcp, udp, established = future.result()
+            tcp_ports.extend(tcp)
+            udp_ports.extend(udp)
+            connections.extend(established)
+        metrics_current.add_listening_ports("UDP", udp_ports)
+        metrics_current.add_listening_ports("TCP", tcp_ports)
+        for connection in connections:
+            metrics_current.add_network_connection(*connection)
+
+        if cpu_percent is not None:
+            metrics_current.add_cpu_usage(cpu_percent.result())
+
+    def close(self):
+        """Shut down the worker pools of parallel mode."""
+        if self._threads is not None:
+            self._threads.shutdown()
+        if self._own_pool:
+            self._process_pool.shutdown()
+
 def main():
     """Use this method to run the collector in stand-alone mode to tests metric collection."""
 
@@ -131,22 +426,35 @@ def main():
     parser.add_argument("--short-names", action="store_true", dest="short_names", default=False, required=False,
                         help="Produce metric report with short names")
     parser.add_argument('-cm','--custom-metrics', action="store_true", dest="custom_metrics", default=False, help="Adds custom metrics to payload.")
+    parser.add_argument("--backend", action="store", dest="backend", choices=BACKENDS, default=BACKEND_PSUTIL,
+                        help="Socket enumeration backend, procfs and sock_diag are Linux only")
+    parser.add_argument("--parallel", action="store_true", dest="parallel", default=False,
+                        help="Collect metric families concurrently, parsing sockets on a process pool")
+    parser.add_argument("--per-interface", action="store_true", dest="per_interface", default=False,
+                        help="Read network stats of each interface and print their deltas")
 
     args = parser.parse_args()
-    collector = Collector(short_metrics_names=args.short_names,use_custom_metrics=args.custom_metrics)
+    collector = Collector(short_metrics_names=args.short_names, use_custom_metrics=args.custom_metrics,
+                          backend=args.backend, parallel=args.parallel, per_interface=args.per_interface)
 
     if args.sample_rate:
         count = int(args.number_samples)
+        scheduler = Scheduler(args.sample_rate)
+        scheduler.begin()
         while True:
             count -= 1
             # setup a loop to collect
             metric = collector.collect_metrics()
             print(metric.to_json_string(pretty_print=True))
+            for name, stats in metric.interface_stats.items():
+                print("{}: {}".format(name, stats))
 
             if count == 0:
                 break
 
-            sleep(float(args.sample_rate))
+            missed = scheduler.wait()
+            if missed:
+                print("Collection overran the sampling interval, skipped {} sample(s)".format(missed))
 
     else:
         metric = collector.collect_metrics()
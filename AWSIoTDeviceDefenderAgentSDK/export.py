@@ -0,0 +1,319 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Compact encoding of metrics reports for exports, such as a copy of every report mirrored to a SIEM.
+
+Exported payloads are not Device Defender reports, they are decoded with :func:`decode`.
+"""
+
+import json
+import struct
+import zlib
+
+import cbor
+
+from AWSIoTDeviceDefenderAgentSDK import metrics
+from AWSIoTDeviceDefenderAgentSDK import tags
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_ZSTD)
+
+# Payload header: magic, version, payload format, compression, adler32 of the dictionary or 0 without one
+HEADER = struct.Struct('<3sBBBI')
+MAGIC = b'DDX'
+VERSION = 1
+_FORMAT_CODES = {metrics.FORMAT_JSON: 0, metrics.FORMAT_CBOR: 1}
+_COMPRESSION_CODES = {COMPRESSION_NONE: 0, COMPRESSION_ZLIB: 1, COMPRESSION_ZSTD: 2}
+_DEFAULT_LEVELS = {COMPRESSION_ZLIB: 6, COMPRESSION_ZSTD: 3}
+
+# Keys of the batch object every payload holds
+REPORTS = 'reports'
+ADDRESSES = 'addresses'
+
+# zlib only looks back 32 KiB, a longer dictionary would never be matched
+DICTIONARY_SIZE = 32 * 1024
+
+_default_dictionaries = {}
+
+
+def _dictionary_id(dictionary):
+    return zlib.adler32(dictionary) & 0xffffffff if dictionary else 0
+
+
+def _connection_lists(report):
+    """Connection lists of a version 1 report tree, whichever tags it uses."""
+    for short_names in (False, True):
+        t = tags.Tags(short_names)
+        section = report.get(t.metrics, {}).get(t.tcp_conn)
+        if section is not None:
+            return t, section[t.established_connections][t.connections]
+    return None, []
+
+
+def intern_addresses(reports):
+    """
+    Replace the remote addresses of version 1 report trees with indices into a shared table.
+
+    The given reports are not modified, connection lists are copied where addresses are replaced.
+
+    Returns
+    -------
+        A tuple of the interned reports and the address table.
+    """
+    table = {}
+    addresses = []
+    interned = []
+    for report in reports:
+        t, connections = _connection_lists(report)
+        if not connections:
+            interned.append(report)
+            continue
+        entries = []
+        for connection in connections:
+            address = connection[t.remote_addr]
+            index = table.get(address)
+            if index is None:
+                index = table[address] = len(addresses)
+                addresses.append(address)
+            entry = dict(connection)
+            entry[t.remote_addr] = index
+            entries.append(entry)
+        report = dict(report)
+        report[t.metrics] = dict(report[t.metrics])
+        report[t.metrics][t.tcp_conn] = {t.established_connections: {
+            t.connections: entries,
+            t.total: report[t.metrics][t.tcp_conn][t.established_connections][t.total]}}
+        interned.append(report)
+    return interned, addresses
+
+
+def restore_addresses(reports, addresses):
+    """Replace address indices of interned report trees with their addresses, in place."""
+    for report in reports:
+        t, connections = _connection_lists(report)
+        for connection in connections:
+            connection[t.remote_addr] = addresses[connection[t.remote_addr]]
+    return reports
+
+
+def _encode_body(body, payload_format):
+    if payload_format == metrics.FORMAT_CBOR:
+        return cbor.dumps(body)
+    return json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+
+def _typical_reports():
+    """Report trees as a small gateway sends them, with a fixed report id, in long and short tags."""
+    reports = []
+    for short_names in (True, False):
+        m = metrics.Metrics(short_names=short_names)
+        for i in range(24):
+            m.add_network_connection("%d.%d.%d.%d" % (10 + i % 3 * 42, 16 + i, 7 * i % 256, 200 - i),
+                                     (443, 8883, 80, 53)[i % 4], ("eth0", "wlan0")[i % 2], 32768 + 97 * i)
+        m.add_network_connection("2001:db8::%x" % 0x1f, 443, "eth0", 50000)
+        m.add_listening_ports("TCP", [{"port": port, "interface": "eth0"} for port in (22, 80, 443, 1883, 8080)])
+        m.add_listening_ports("UDP", [{"port": port, "interface": "eth0"} for port in (53, 68, 123, 5353)])
+        m.add_network_stats(123456789, 9876543, 654321, 43210)
+        m.add_cpu_usage(0.25)
+        report = dict(m._v1_metrics())
+        report[m.t.header] = {m.t.report_id: 1600000000, m.t.version: "1.0"}
+        reports.append(report)
+    return reports
+
+
+def build_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    Preset compression dictionary from sample payloads, such as encoded reports typical of a fleet.
+
+    zlib and zstd both match payloads against the raw content of the dictionary, and zlib encodes nearer
+    matches with fewer bits, so distinct samples are concatenated in the given order, the most representative
+    last, and the oldest bytes are dropped beyond ``size``.
+
+    Parameters
+    ----------
+    samples: iterable
+        Sample payloads, as bytes.
+    size: int
+        Maximum size of the dictionary in bytes.
+    """
+    distinct = []
+    for sample in samples:
+        sample = bytes(sample)
+        if sample not in distinct:
+            distinct.append(sample)
+    return b''.join(distinct)[-size:]
+
+
+def default_dictionary(payload_format=metrics.FORMAT_JSON):
+    """
+    Dictionary built from typical version 1 reports, in short and long tags, interned and not.
+
+    It is derived from the report layout of this package only, so an encoder and a decoder of the same version
+    agree on it without exchanging it.
+    """
+    dictionary = _default_dictionaries.get(payload_format)
+    if dictionary is None:
+        reports = _typical_reports()
+        interned, addresses = intern_addresses(reports)
+        samples = [_encode_body({REPORTS: interned, ADDRESSES: addresses}, payload_format)]
+        samples.extend(_encode_body({REPORTS: [report]}, payload_format) for report in reports)
+        dictionary = _default_dictionaries[payload_format] = build_dictionary(samples)
+    return dictionary
+
+
+def _zstd_dictionary(dictionary):
+    if zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+    if not dictionary:
+        return None
+    return zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+class ExportEncoder(object):
+    """
+    Encodes batches of metrics reports into compact export payloads.
+
+    Each payload holds a batch of reports, optionally with their remote addresses interned in a table shared
+    across the batch, and is compressed with zlib or zstd against a preset dictionary of typical reports. The
+    repetitive field names and structure of the reports are then mostly found in the dictionary, which keeps
+    even a payload of a single report small.
+    """
+
+    def __init__(self, payload_format=metrics.FORMAT_JSON, compression=COMPRESSION_ZLIB, dictionary=None,
+                 level=None, intern=False):
+        """
+        Parameters
+        ----------
+        payload_format: string
+            ``json`` or ``cbor``, the encoding of the batch before compression.
+        compression: string
+            ``none``, ``zlib`` or ``zstd``, which requires the ``zstandard`` package.
+        dictionary: bytes
+            Preset dictionary, the :func:`default_dictionary` of the format if None, no dictionary if empty.
+            Payloads must be decoded with the same dictionary.
+        level: int
+            Compression level, the algorithm's default if None.
+        intern: bool
+            Replace remote addresses with indices into a table of the distinct addresses of the batch. This
+            shrinks uncompressed batches, compression already finds the repeated addresses.
+        """
+        if payload_format not in metrics.FORMATS:
+            raise ValueError("Invalid payload format: " + str(payload_format))
+        if compression not in COMPRESSIONS:
+            raise ValueError("Invalid compression: " + str(compression))
+        if dictionary is None:
+            dictionary = default_dictionary(payload_format) if compression != COMPRESSION_NONE else b''
+        self.payload_format = payload_format
+        self.compression = compression
+        self.dictionary = bytes(dictionary)
+        self.level = _DEFAULT_LEVELS.get(compression) if level is None else level
+        self.intern = intern
+        self._header = HEADER.pack(MAGIC, VERSION, _FORMAT_CODES[payload_format],
+                                   _COMPRESSION_CODES[compression], _dictionary_id(self.dictionary))
+        self._zstd = None
+        if compression == COMPRESSION_ZSTD:
+            dict_data = _zstd_dictionary(self.dictionary)
+            self._zstd = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data)
+
+    def encode(self, report):
+        """Export payload of a single :class:`~metrics.Metrics` report."""
+        return self.encode_batch([report])
+
+    def encode_batch(self, reports):
+        """
+        Export payload of a batch of :class:`~metrics.Metrics` reports.
+
+        Returns
+        -------
+            The payload, as bytes.
+        """
+        return self._header + self._compress(self._body(reports))
+
+    def _body(self, reports):
+        trees = [report._v1_metrics() for report in reports]
+        if self.intern:
+            interned, addresses = intern_addresses(trees)
+            return _encode_body({REPORTS: interned, ADDRESSES: addresses}, self.payload_format)
+        return _encode_body({REPORTS: trees}, self.payload_format)
+
+    def _compress(self, body):
+        if self.compression == COMPRESSION_ZLIB:
+            if self.dictionary:
+                compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+            else:
+                compressor = zlib.compressobj(self.level)
+            return compressor.compress(body) + compressor.flush()
+        if self.compression == COMPRESSION_ZSTD:
+            return self._zstd.compress(body)
+        return body
+
+
+def decode(payload, dictionary=None):
+    """
+    Decode an export payload.
+
+    Parameters
+    ----------
+    payload: bytes
+        Payload returned by :meth:`ExportEncoder.encode_batch`.
+    dictionary: bytes
+        Dictionary the payload was compressed with, the :func:`default_dictionary` of its format if None.
+
+    Returns
+    -------
+        The list of version 1 report trees of the batch, as returned by :meth:`~metrics.Metrics._v1_metrics`.
+
+    Raises
+    ------
+    ValueError
+        If the payload is not an export payload, or was compressed with another dictionary.
+    """
+    payload = bytes(payload)
+    if len(payload) < HEADER.size:
+        raise ValueError("Truncated export payload")
+    magic, version, format_code, compression_code, dictionary_id = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an export payload")
+    payload_format = {code: name for name, code in _FORMAT_CODES.items()}.get(format_code)
+    compression = {code: name for name, code in _COMPRESSION_CODES.items()}.get(compression_code)
+    if payload_format is None or compression is None:
+        raise ValueError("Unsupported export payload encoding")
+
+    if dictionary is None:
+        dictionary = default_dictionary(payload_format) if dictionary_id else b''
+    if _dictionary_id(dictionary) != dictionary_id:
+        raise ValueError("Export payload was compressed with another dictionary")
+
+    body = payload[HEADER.size:]
+    if compression == COMPRESSION_ZLIB:
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        body = decompressor.decompress(body) + decompressor.flush()
+    elif compression == COMPRESSION_ZSTD:
+        dict_data = _zstd_dictionary(dictionary)
+        body = zstandard.ZstdDecompressor(dict_data=dict_data).decompress(body)
+
+    if payload_format == metrics.FORMAT_CBOR:
+        batch = cbor.loads(body)
+    else:
+        batch = json.loads(body.decode('utf-8'))
+    if ADDRESSES in batch:
+        return restore_addresses(batch[REPORTS], batch[ADDRESSES])
+    return batch[REPORTS]
@@ -0,0 +1,159 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import heapq
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+import cbor
+
+from AWSIoTDeviceDefenderAgentSDK import tags
+
+
+def defender_responder(topic, payload):
+    """
+    Answers reports published to a Device Defender metrics topic on its ``/accepted`` topic, as the service does
+    for valid reports. Returns a ``(topic, payload)`` pair, or None for other topics.
+    """
+    if topic.endswith('/json'):
+        report = json.loads(payload)
+
+        def encode(response):
+            return json.dumps(response).encode('utf-8')
+    elif topic.endswith('/cbor'):
+        report = cbor.loads(bytes(payload))
+        encode = cbor.dumps
+    else:
+        return None
+    long_name, short_name = tags.Tags.HEADER
+    header = report.get(long_name) or report.get(short_name)
+    long_name, short_name = tags.Tags.REPORT_ID
+    response = {"thingName": topic.split('/')[2],
+                "reportId": header.get(long_name, header.get(short_name)),
+                "status": "ACCEPTED",
+                "timestamp": int(time.time() * 1000)}
+    return topic + '/accepted', encode(response)
+
+
+class FakeMqttConnection(object):
+    """
+    In-process stand-in for an ``awscrt.mqtt.Connection``, for testing and load testing the agent without a broker.
+
+    ``publish`` and ``subscribe`` return ``(future, packet_id)`` like the real connection. Publish futures are
+    completed by a single delivery thread after ``latency`` seconds, so thousands of reports can be in flight
+    without a thread each. Every published message is recorded in ``published``.
+
+    :meth:`interrupt` and :meth:`resume` simulate a connection outage, publishes fail while it lasts.
+
+    A ``responder`` can answer published messages, the response is delivered to the matching subscription when
+    the publish completes. :func:`defender_responder` accepts every Device Defender report.
+    """
+
+    def __init__(self, latency=0.0, on_connection_interrupted=None, on_connection_resumed=None, responder=None):
+        """
+        Parameters
+        ----------
+        latency: float
+            Seconds between a publish call and the completion of its future.
+        on_connection_interrupted: callable
+            Called with the connection and an error when :meth:`interrupt` is called.
+        on_connection_resumed: callable
+            Called with the connection, a return code and session_present when :meth:`resume` is called.
+        responder: callable
+            Called with the topic and payload of each publish, returns a ``(topic, payload)`` response or None.
+        """
+        self.latency = latency
+        self.responder = responder
+        self.connected = True
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
+        self.published = []
+        self.subscriptions = {}
+        self._packet_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # heap of (due time, packet id, future, result, response)
+        self._pending = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._deliver, name="fake-mqtt-delivery")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def connect(self):
+        return self._completed({'session_present': False})
+
+    def disconnect(self):
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        return self._completed({})
+
+    def subscribe(self, topic, qos, callback=None):
+        with self._lock:
+            self.subscriptions[topic] = callback
+        return self._completed({'topic': topic, 'qos': qos}), next(self._packet_ids)
+
+    def interrupt(self):
+        self.connected = False
+        if self.on_connection_interrupted is not None:
+            self.on_connection_interrupted(connection=self, error=ConnectionError("Simulated outage"))
+
+    def resume(self):
+        self.connected = True
+        if self.on_connection_resumed is not None:
+            self.on_connection_resumed(connection=self, return_code=0, session_present=True)
+
+    def publish(self, topic, payload, qos, retain=False):
+        future = Future()
+        packet_id = next(self._packet_ids)
+        if not self.connected:
+            future.set_exception(ConnectionError("Not connected"))
+            return future, packet_id
+        response = self.responder(topic, payload) if self.responder is not None else None
+        with self._lock:
+            self.published.append((topic, bytes(payload) if isinstance(payload, bytearray) else payload))
+            heapq.heappush(self._pending, (time.monotonic() + self.latency, packet_id, future,
+                                           {'packet_id': packet_id}, response))
+            self._wakeup.notify()
+        return future, packet_id
+
+    @staticmethod
+    def _completed(result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _deliver(self):
+        with self._lock:
+            while not self._closed or self._pending:
+                if not self._pending:
+                    self._wakeup.wait()
+                    continue
+                due = self._pending[0][0]
+                delay = due - time.monotonic()
+                if delay > 0 and not self._closed:
+                    self._wakeup.wait(delay)
+                    continue
+                _, _, future, result, response = heapq.heappop(self._pending)
+                callback = self.subscriptions.get(response[0]) if response is not None else None
+                self._lock.release()
+                try:
+                    future.set_result(result)
+                    if callback is not None:
+                        callback(topic=response[0], payload=response[1], dup=False, qos=1, retain=False)
+                finally:
+                    self._lock.acquire()
@@ -0,0 +1,222 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import cbor
+
+ACCEPTED_SUFFIX = '/accepted'
+REJECTED_SUFFIX = '/rejected'
+
+
+def parse_response(topic, payload):
+    """
+    Decode a Device Defender response published on a ``/accepted`` or ``/rejected`` topic.
+
+    Returns
+    -------
+        A ``(report_id, accepted, details)`` tuple, ``details`` being the ``statusDetails`` of a rejection,
+        or None if the topic is not a response topic.
+    """
+    if topic.endswith(ACCEPTED_SUFFIX):
+        accepted = True
+        metrics_topic = topic[:-len(ACCEPTED_SUFFIX)]
+    elif topic.endswith(REJECTED_SUFFIX):
+        accepted = False
+        metrics_topic = topic[:-len(REJECTED_SUFFIX)]
+    else:
+        return None
+
+    if metrics_topic.endswith('/cbor'):
+        response = cbor.loads(bytes(payload))
+    else:
+        response = json.loads(payload.decode('utf-8') if isinstance(payload, (bytes, bytearray)) else payload)
+    return response.get('reportId'), accepted, response.get('statusDetails')
+
+
+class DeliveryStats(object):
+    """End-to-end delivery counters of an :class:`InFlightTracker`, latencies are in seconds."""
+
+    def __init__(self):
+        self.published = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.retried = 0
+        self.expired = 0
+        self.unknown = 0
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_min = None
+        self.latency_max = None
+
+    def record_latency(self, latency):
+        self.latency_count += 1
+        self.latency_total += latency
+        self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+        self.latency_max = latency if self.latency_max is None else max(self.latency_max, latency)
+
+    @property
+    def latency_mean(self):
+        return self.latency_total / self.latency_count if self.latency_count else None
+
+    @property
+    def success_rate(self):
+        """Share of reports that were accepted, out of those with a final outcome."""
+        finished = self.accepted + self.expired
+        return float(self.accepted) / finished if finished else None
+
+    def __repr__(self):
+        return ("DeliveryStats(published={}, accepted={}, rejected={}, timed_out={}, retried={}, expired={}, "
+                "unknown={}, latency_mean={})".format(self.published, self.accepted, self.rejected, self.timed_out,
+                                                      self.retried, self.expired, self.unknown, self.latency_mean))
+
+
+class _Report(object):
+    __slots__ = ('topic', 'payload', 'first_sent', 'deadline', 'attempts', 'retry_at')
+
+    def __init__(self, topic, payload, now, timeout):
+        self.topic = topic
+        self.payload = payload
+        self.first_sent = now
+        self.deadline = now + timeout
+        self.attempts = 1
+        self.retry_at = None
+
+
+class InFlightTracker(object):
+    """
+    Correlates published reports with Device Defender's accepted and rejected responses, by report id.
+
+    At most ``window`` reports are awaiting a response at once, publishing more blocks until one is resolved.
+    A report that is rejected, or not answered within ``timeout`` seconds, is published again after an
+    exponential backoff, up to ``max_attempts`` times in total, after which it is counted as expired.
+
+    Reports the underlying publish does not send, signalled by returning None as the offline buffer does,
+    are not tracked.
+    """
+
+    WINDOW = 8
+    TIMEOUT = 30.0
+    MAX_ATTEMPTS = 3
+    BACKOFF = 5.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, publish, window=WINDOW, timeout=TIMEOUT, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        publish: callable
+            Publishes a payload to a topic, such as ``IoTClientWrapper.publish``.
+        window: int
+            Maximum number of reports awaiting a response.
+        timeout: float
+            Seconds to wait for a response before a report is published again.
+        max_attempts: int
+            Number of times a report is published before giving up on it.
+        backoff: float
+            Seconds before the first retry, doubled for each later one.
+        max_backoff: float
+            Upper bound of the delay between two attempts.
+        clock: callable
+            Monotonic clock returning seconds.
+        """
+        self._publish = publish
+        self.window = window
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self.stats = DeliveryStats()
+        # report id -> _Report, in publish order
+        self._in_flight = OrderedDict()
+        self._changed = threading.Condition()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def publish(self, topic, payload, report_id):
+        """Publish a report and track it until it is accepted or expires, waiting for room in the window."""
+        with self._changed:
+            while len(self._in_flight) >= self.window:
+                self._changed.wait(self.timeout)
+                self._check(self._clock())
+            future = self._publish(topic, payload)
+            if future is None:
+                return None
+            self._in_flight[report_id] = _Report(topic, payload, self._clock(), self.timeout)
+            self.stats.published += 1
+            return future
+
+    def on_response(self, topic, payload, **kwargs):
+        """Subscription callback for the accepted and rejected topics."""
+        response = parse_response(topic, payload)
+        if response is None:
+            return
+        report_id, accepted, details = response
+        with self._changed:
+            now = self._clock()
+            report = self._in_flight.get(report_id)
+            if report is None:
+                self.stats.unknown += 1
+                return
+            if accepted:
+                del self._in_flight[report_id]
+                self.stats.accepted += 1
+                self.stats.record_latency(now - report.first_sent)
+                self._changed.notify_all()
+            else:
+                print("Report {} rejected: {}".format(report_id, details))
+                self.stats.rejected += 1
+                self._schedule_retry(report_id, report, now)
+
+    def _schedule_retry(self, report_id, report, now):
+        if report.attempts >= self.max_attempts:
+            del self._in_flight[report_id]
+            self.stats.expired += 1
+            print("Giving up on report {} after {} attempt(s)".format(report_id, report.attempts))
+            self._changed.notify_all()
+            return
+        report.deadline = None
+        report.retry_at = now + min(self.max_backoff, self.backoff * 2 ** (report.attempts - 1))
+
+    def check(self):
+        """Retry reports whose backoff has elapsed and time out unanswered ones, call periodically."""
+        with self._changed:
+            self._check(self._clock())
+
+    def _check(self, now):
+        for report_id, report in list(self._in_flight.items()):
+            if report.deadline is not None and now >= report.deadline:
+                self.stats.timed_out += 1
+                self._schedule_retry(report_id, report, now)
+            elif report.retry_at is not None and now >= report.retry_at:
+                report.attempts += 1
+                report.retry_at = None
+                report.deadline = now + self.timeout
+                self.stats.retried += 1
+                try:
+                    self._publish(report.topic, report.payload)
+                except Exception as ex:
+                    print("Failed to republish report {}".format(report_id))
+                    print(ex)
+
+    def run(self, stop, period=1.0):
+        """Call :meth:`check` every ``period`` seconds until ``stop``, a ``threading.Event``, is set."""
+        while not stop.wait(period):
+            self.check()
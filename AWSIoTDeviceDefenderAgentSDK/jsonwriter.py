@@ -0,0 +1,125 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import json
+from json.encoder import encode_basestring_ascii
+
+SEPARATORS = (',', ':')
+
+
+class JsonWriter(object):
+    """
+    Streaming JSON encoder writing compact UTF-8 output to a binary file-like sink.
+
+    Output is byte-identical to ``json.dumps(report, separators=(',', ':'))`` for the same sequence of
+    members. Only the container currently being written is tracked, so nothing is buffered beyond a
+    single list entry. Sizes passed to :meth:`begin_map` and :meth:`begin_array` are ignored, they are
+    accepted to share the interface of :class:`~AWSIoTDeviceDefenderAgentSDK.cborwriter.CborWriter`.
+    """
+
+    # Encoded key prefixes of record() calls
+    _record_cache = {}
+
+    def __init__(self, sink):
+        """
+        Parameters
+        ----------
+        sink: file-like
+            Object with a ``write`` method accepting bytes, such as ``io.BytesIO`` or a file opened in binary mode.
+        """
+        self.sink = sink
+        self._write = sink.write
+        # One flag per open container, True until its first member is written
+        self._first = []
+        self._after_key = False
+
+    def _separate(self):
+        if self._after_key:
+            self._after_key = False
+        elif self._first:
+            if self._first[-1]:
+                self._first[-1] = False
+            else:
+                self._write(b',')
+
+    def begin_map(self, size=None):
+        self._separate()
+        self._write(b'{')
+        self._first.append(True)
+
+    def end_map(self):
+        self._first.pop()
+        self._write(b'}')
+
+    def begin_array(self, size=None):
+        self._separate()
+        self._write(b'[')
+        self._first.append(True)
+
+    def end_array(self):
+        self._first.pop()
+        self._write(b']')
+
+    def key(self, key):
+        self._separate()
+        self._write(encode_basestring_ascii(key).encode('ascii') + b':')
+        self._after_key = True
+
+    def text(self, value):
+        self._separate()
+        self._write(encode_basestring_ascii(value).encode('ascii'))
+
+    def integer(self, value):
+        self._separate()
+        self._write(int.__repr__(value).encode('ascii'))
+
+    def value(self, value):
+        """Write any JSON serializable value, containers are encoded in a single write."""
+        self._separate()
+        self._write(self._encode(value))
+
+    @staticmethod
+    def _encode(value):
+        # exact type checks, bool is a subclass of int
+        if value.__class__ is str:
+            return encode_basestring_ascii(value).encode('ascii')
+        if value.__class__ is int:
+            return int.__repr__(value).encode('ascii')
+        return json.dumps(value, separators=SEPARATORS).encode('utf-8')
+
+    def record(self, keys, values):
+        """
+        Write an object of ``keys`` to ``values``, the common case for list entries.
+
+        ``keys`` should be a tuple reused across calls, as its encoding is cached.
+        """
+        prefixes = self._record_prefixes(keys)
+        self._separate()
+        encode = self._encode
+        parts = [prefix + encode(value) for prefix, value in zip(prefixes, values)]
+        parts.append(b'}')
+        self._write(b''.join(parts))
+
+    def record_size(self, keys, values):
+        """Number of bytes :meth:`record` writes for ``keys`` and ``values``, counting a separating comma."""
+        encode = self._encode
+        return 2 + sum(len(prefix) + len(encode(value))
+                       for prefix, value in zip(self._record_prefixes(keys), values))
+
+    def _record_prefixes(self, keys):
+        prefixes = self._record_cache.get(keys)
+        if prefixes is None:
+            prefixes = [(',' + encode_basestring_ascii(k) + ':').encode('ascii') for k in keys]
+            prefixes[0] = b'{' + prefixes[0][1:]
+            self._record_cache[keys] = prefixes
+        return prefixes
@@ -0,0 +1,401 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Load generator for the agent's publish path, run against an in-process MQTT connection instead of AWS IoT.
+
+Reports of many simulated things are fed through the agent's :class:`~pipeline.PublishPipeline` and
+:class:`~agent.IoTClientWrapper` to a :class:`~fakemqtt.FakeMqttConnection` at a given rate, and the publish
+throughput, queueing and publish latencies and memory of the process are measured. Run from the repository root::
+
+    python -m AWSIoTDeviceDefenderAgentSDK.loadgen --things 1000 --rate 500 --duration 30
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import threading
+import time
+
+import cbor
+
+from AWSIoTDeviceDefenderAgentSDK import agent
+from AWSIoTDeviceDefenderAgentSDK import inflight
+from AWSIoTDeviceDefenderAgentSDK import metrics
+from AWSIoTDeviceDefenderAgentSDK import pipeline
+from AWSIoTDeviceDefenderAgentSDK import tags
+from AWSIoTDeviceDefenderAgentSDK.fakemqtt import FakeMqttConnection, defender_responder
+from AWSIoTDeviceDefenderAgentSDK.reportlog import ReportLogReader
+
+# Shortest interval between two collections, faster rates collect several things per interval
+MIN_INTERVAL = 0.01
+
+
+def resident_memory():
+    """Resident set size of this process in bytes, or its peak where the current size is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LatencyRecorder(object):
+    """Latency samples in seconds, summarized once the load is over."""
+
+    def __init__(self):
+        self._samples = []
+
+    def record(self, seconds):
+        # list.append is atomic, stages and publish callbacks record without a lock
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, fraction):
+        """Sample below which ``fraction`` of the samples lie, 0 without samples."""
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+    @property
+    def mean(self):
+        return sum(self._samples) / len(self._samples) if self._samples else 0.0
+
+    def __repr__(self):
+        return "mean {:.2f} ms, p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+            self.mean * 1000, self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, self.percentile(1.0) * 1000)
+
+
+class SyntheticReports(object):
+    """
+    Reports of simulated things, built with :class:`~metrics.Metrics` the way the collector builds them.
+
+    Each thing talks to its own slice of a pool of remote hosts, so consecutive reports of a thing are alike.
+    """
+
+    def __init__(self, connections=50, listening_ports=10, short_names=False, seed=None):
+        """
+        Parameters
+        ----------
+        connections: int
+            Established connections in each report.
+        listening_ports: int
+            Listening TCP ports in each report, half as many UDP ports.
+        short_names: bool
+            Use short tags.
+        """
+        rng = random.Random(seed)
+        self.connections = connections
+        self.short_names = short_names
+        self._hosts = ["%d.%d.%d.%d" % (rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255),
+                                        rng.randint(1, 254)) for _ in range(max(1, 4 * connections))]
+        self._tcp_ports = [{"port": port, "interface": "eth0"} for port in range(8000, 8000 + listening_ports)]
+        self._udp_ports = [{"port": port} for port in range(5000, 5000 + listening_ports // 2)]
+        self._rng = rng
+
+    def __call__(self, thing_index, report_id):
+        m = metrics.Metrics(short_names=self.short_names)
+        hosts = self._hosts
+        for i in range(self.connections):
+            m.add_network_connection(hosts[(thing_index + i) % len(hosts)], 443, "eth0", 32768 + i)
+        m.add_listening_ports("TCP", self._tcp_ports)
+        m.add_listening_ports("UDP", self._udp_ports)
+        m.add_network_stats(self._rng.randint(0, 10 ** 9), self._rng.randint(0, 10 ** 9),
+                            self._rng.randint(0, 10 ** 6), self._rng.randint(0, 10 ** 6))
+        m.report_id = report_id
+        return m
+
+    def close(self):
+        pass
+
+
+class RecordedReports(object):
+    """
+    Reports replayed from a :class:`~reportlog.ReportLog`, in the order they were recorded and from the start
+    again once all were replayed. Reports are decoded as they are replayed, and their report ids replaced.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: string
+            Report log, written by the agent with ``--report-log``.
+        """
+        self._reader = ReportLogReader(path)
+        if not len(self._reader):
+            self._reader.close()
+            raise ValueError("No reports to replay in " + path)
+        self._positions = itertools.cycle(range(len(self._reader)))
+        self._lock = threading.Lock()
+
+    def __call__(self, thing_index, report_id):
+        with self._lock:
+            report = self._reader[next(self._positions)].report()
+        t = tags.Tags(tags.Tags.HEADER[1] in report)
+        report[t.header] = {t.report_id: report_id, t.version: "1.0"}
+        return report
+
+    def close(self):
+        self._reader.close()
+
+
+def encode_report(report, payload_format):
+    """Serialize a :class:`~metrics.Metrics` object or a decoded report as the agent publishes it."""
+    if isinstance(report, metrics.Metrics):
+        return report.to_cbor() if payload_format == metrics.FORMAT_CBOR else report.to_json_string()
+    if payload_format == metrics.FORMAT_CBOR:
+        return cbor.dumps(report)
+    return json.dumps(report, separators=(',', ':'))
+
+
+def _merge_delivery_stats(all_stats):
+    """Sum of the delivery counters of several trackers."""
+    merged = inflight.DeliveryStats()
+    for stats in all_stats:
+        for counter in ('published', 'accepted', 'rejected', 'timed_out', 'retried', 'expired', 'unknown',
+                        'latency_count', 'latency_total'):
+            setattr(merged, counter, getattr(merged, counter) + getattr(stats, counter))
+        for bound, pick in (('latency_min', min), ('latency_max', max)):
+            values = [value for value in (getattr(merged, bound), getattr(stats, bound)) if value is not None]
+            setattr(merged, bound, pick(values) if values else None)
+    return merged
+
+
+class LoadResult(object):
+    """Measurements of a :meth:`LoadGenerator.run`."""
+
+    def __init__(self, stats, elapsed, queueing, publishing, payload_bytes, memory_start, memory_peak,
+                 delivery=None):
+        self.stats = stats
+        self.elapsed = elapsed
+        self.queueing = queueing
+        self.publishing = publishing
+        self.payload_bytes = payload_bytes
+        self.memory_start = memory_start
+        self.memory_peak = memory_peak
+        self.delivery = delivery
+
+    @property
+    def throughput(self):
+        """Reports published and completed per second."""
+        return self.stats.completed / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        bandwidth = self.payload_bytes / 1024.0 / self.elapsed if self.elapsed else 0.0
+        lines = ["{} reports in {:.1f} s, {:.1f} reports/s, {:.1f} KiB/s".format(
+                 self.stats.completed, self.elapsed, self.throughput, bandwidth),
+                 repr(self.stats),
+                 "queueing:   {!r}".format(self.queueing),
+                 "publishing: {!r}".format(self.publishing),
+                 "memory: {:.1f} MiB at start, {:.1f} MiB peak".format(
+                     self.memory_start / 1048576.0, self.memory_peak / 1048576.0)]
+        if self.delivery is not None:
+            lines.append(repr(self.delivery))
+        return "\n".join(lines)
+
+
+class LoadGenerator(object):
+    """
+    Publishes the reports of simulated things through the agent's publish path, at a given rate.
+
+    Every collection of the pipeline produces the reports of the next few things, round robin, as the agent
+    does for several targets. The time a report waits in the pipeline's queues from its collection to its
+    publish, and the time its publish takes to complete, are recorded.
+    """
+
+    def __init__(self, reports, things=100, rate=100.0, payload_format=metrics.FORMAT_JSON, latency=0.0, qos=0,
+                 track_delivery=False, window=inflight.InFlightTracker.WINDOW,
+                 queue_size=None, max_in_flight=pipeline.PublishPipeline.MAX_IN_FLIGHT):
+        """
+        Parameters
+        ----------
+        reports: callable
+            Called with a thing index and a report id, returns a report, such as :class:`SyntheticReports`.
+        things: int
+            Number of simulated things, each publishing to its own topic.
+        rate: float
+            Reports collected per second, across all things.
+        payload_format: string
+            ``json`` or ``cbor``.
+        latency: float
+            Seconds the fake broker takes to complete a publish.
+        qos: int
+            MQTT quality of service of published reports.
+        track_delivery: bool
+            Publish through an :class:`~inflight.InFlightTracker` per thing, which waits for responses.
+        window: int
+            Reports awaiting a response per thing, when tracking delivery.
+        queue_size: int
+            Size of the pipeline queues, twice the reports of a collection by default, as the agent sizes them.
+        max_in_flight: int
+            Publishes of the pipeline awaiting completion.
+        """
+        if things < 1 or rate <= 0:
+            raise ValueError("A load needs at least one thing and a positive rate")
+        self.reports = reports
+        self.things = things
+        self.rate = float(rate)
+        self.payload_format = payload_format
+        self.qos = qos
+        self.batch = max(1, int(math.ceil(self.rate * MIN_INTERVAL)))
+        self.interval = self.batch / self.rate
+
+        self.client = agent.IoTClientWrapper("localhost", None, None, None, "loadgen", None, None, None, False)
+        self.connection = FakeMqttConnection(latency, on_connection_interrupted=self.client._on_connection_interrupted,
+                                             on_connection_resumed=self.client._on_connection_resumed,
+                                             responder=defender_responder)
+        # the wrapper publishes through the fake connection, as it would through one it connected
+        self.client.iot_client = self.connection
+        self.topics = ["$aws/things/loadgen-{}/defender/metrics/{}".format(i, payload_format) for i in range(things)]
+
+        # topic -> InFlightTracker of the thing publishing to it
+        self.trackers = {}
+        if track_delivery:
+            def publish(topic, payload):
+                return self.client.publish(topic, payload, qos)
+            for topic in self.topics:
+                tracker = self.trackers[topic] = inflight.InFlightTracker(publish, window=window)
+                self.connection.subscribe(topic + "/accepted", 1, tracker.on_response)
+                self.connection.subscribe(topic + "/rejected", 1, tracker.on_response)
+
+        self.queueing = LatencyRecorder()
+        self.publishing = LatencyRecorder()
+        self._payload_bytes = 0
+        self._lock = threading.Lock()
+        self._next_thing = itertools.cycle(range(things))
+        self._report_ids = itertools.count(int(time.time()))
+        if queue_size is None:
+            queue_size = max(pipeline.PublishPipeline.QUEUE_SIZE, 2 * self.batch)
+        self.pipeline = pipeline.PublishPipeline(self._collect, self._serialize, self._publish, self.interval,
+                                                 queue_size=queue_size, max_in_flight=max_in_flight)
+
+    def _collect(self):
+        collected = []
+        for _ in range(self.batch):
+            thing = next(self._next_thing)
+            report_id = next(self._report_ids)
+            collected.append((self.topics[thing], report_id, self.reports(thing, report_id), time.monotonic()))
+        return collected
+
+    def _serialize(self, collected):
+        return [(topic, encode_report(report, self.payload_format), report_id, collected_at)
+                for topic, report_id, report, collected_at in collected]
+
+    def _publish(self, topic, payload, report_id, collected_at):
+        started = time.monotonic()
+        self.queueing.record(started - collected_at)
+        with self._lock:
+            self._payload_bytes += len(payload)
+        if self.trackers:
+            future = self.trackers[topic].publish(topic, payload, report_id)
+        else:
+            future = self.client.publish(topic, payload, self.qos)
+        if future is not None:
+            future.add_done_callback(lambda _: self.publishing.record(time.monotonic() - started))
+        return future
+
+    def run(self, duration=None, samples=None):
+        """
+        Publish for ``duration`` seconds, then wait for the reports already collected to be published.
+
+        Parameters
+        ----------
+        duration: float
+            Seconds to generate load for.
+        samples: int
+            Number of collections of the pipeline instead, each of ``batch`` reports, for a load that does not
+            depend on how long collections take.
+
+        Returns
+        -------
+            A :class:`LoadResult`.
+        """
+        if samples is None:
+            if duration is None:
+                raise ValueError("A load needs a duration or a number of samples")
+            samples = max(1, int(duration / self.interval))
+
+        memory_start = resident_memory()
+        memory_peak = [memory_start]
+        stop = threading.Event()
+
+        def sample_memory():
+            while not stop.wait(0.1):
+                memory_peak[0] = max(memory_peak[0], resident_memory())
+
+        monitors = [threading.Thread(target=sample_memory, name="loadgen-memory")]
+        if self.trackers:
+            monitors.append(threading.Thread(target=agent.check_deliveries, args=(list(self.trackers.values()), stop),
+                                             name="loadgen-delivery"))
+        for monitor in monitors:
+            monitor.daemon = True
+            monitor.start()
+
+        started = time.monotonic()
+        self.pipeline.run(samples=samples)
+        deadline = time.monotonic() + 10
+        while any(len(tracker) for tracker in self.trackers.values()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - started
+
+        stop.set()
+        for monitor in monitors:
+            monitor.join()
+        memory_peak[0] = max(memory_peak[0], resident_memory())
+        self.connection.disconnect()
+
+        delivery = _merge_delivery_stats(tracker.stats for tracker in self.trackers.values()) if self.trackers else None
+        return LoadResult(self.pipeline.stats, elapsed, self.queueing, self.publishing, self._payload_bytes,
+                          memory_start, memory_peak[0], delivery)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish simulated reports through the agent to a local fake broker")
+    parser.add_argument("--things", type=int, default=100, help="Number of simulated things")
+    parser.add_argument("--rate", type=float, default=100.0, help="Reports per second across all things")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to generate load for")
+    parser.add_argument("-f", "--format", dest="format", choices=metrics.FORMATS, default=metrics.FORMAT_JSON)
+    parser.add_argument("-s", "--short_tags", action="store_true", dest="short_tags", default=False)
+    parser.add_argument("--connections-per-report", type=int, default=50, dest="connections",
+                        help="Established connections in each synthetic report")
+    parser.add_argument("--replay", default=None, metavar="REPORT_LOG",
+                        help="Replay the reports of a report log written with --report-log instead")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the fake broker takes per publish")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0)
+    parser.add_argument("--track-delivery", action="store_true", dest="track_delivery", default=False)
+    parser.add_argument("--max-in-flight", type=int, dest="max_in_flight",
+                        default=pipeline.PublishPipeline.MAX_IN_FLIGHT)
+    args = parser.parse_args()
+
+    if args.replay:
+        reports = RecordedReports(args.replay)
+    else:
+        reports = SyntheticReports(args.connections, short_names=args.short_tags)
+    try:
+        generator = LoadGenerator(reports, args.things, args.rate, args.format, args.latency, args.qos,
+                                  args.track_delivery, max_in_flight=args.max_in_flight)
+        print(generator.run(args.duration).summary())
+    finally:
+        reports.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,13 +11,421 @@
 #   express or implied. See the License for the specific language governing
 #   permissions and limitations under the License.
 
+import io
 import time
 import json
-import cbor
 import random
-import os
+import heapq
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+import cbor
 from AWSIoTDeviceDefenderAgentSDK import tags
-from ipaddress import ip_address, IPv4Address
+from AWSIoTDeviceDefenderAgentSDK.cborwriter import CborWriter
+from AWSIoTDeviceDefenderAgentSDK.jsonwriter import JsonWriter
+
+# Compact report entries, tag names and address formatting are only applied when a report is rendered
+Connection = namedtuple('Connection', 'remote_addr remote_port local_interface local_port')
+NetworkStats = namedtuple('NetworkStats', 'bytes_in bytes_out packets_in packets_out')
+
+
+class ListeningPort(namedtuple('ListeningPort', 'port interface')):
+    """Listening port entry, fields can also be looked up by name like the dictionaries it replaces."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == 'port' or key == 'interface' and self.interface:
+                return getattr(self, key)
+            raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+# The C extension of the cbor package encodes the report tree faster than CborWriter can stream it
+try:
+    from cbor import _cbor
+    CBOR_EXTENSION = True
+except ImportError:
+    CBOR_EXTENSION = False
+
+# Serialization formats a payload size budget can be computed for
+FORMAT_JSON = 'json'
+FORMAT_CBOR = 'cbor'
+FORMATS = (FORMAT_JSON, FORMAT_CBOR)
+# Bytes set aside per list for array headers growing with their length, which entry sizes do not include
+_ARRAY_HEADER_SLACK = 4
+
+# Order-independent fingerprint of a record set's entries, summed hashes modulo 2**64
+FINGERPRINT_MASK = (1 << 64) - 1
+
+
+class SetDiff(namedtuple('SetDiff', 'added removed')):
+    """Entries added to and removed from a record set since a previous report, as sets of records."""
+    __slots__ = ()
+
+    @property
+    def changed(self):
+        return bool(self.added or self.removed)
+
+
+MetricsDiff = namedtuple('MetricsDiff', 'connections tcp_ports udp_ports')
+
+# Record set of a previous report, with the sample and rendered entries it was reported with
+_Section = namedtuple('_Section', 'records max_list_size tags sample rendered')
+
+
+def format_address(ip, port):
+    """Format an "ip:port" string, IPv6 addresses are enclosed in brackets."""
+    if ':' in ip:
+        return "[" + ip + "]:" + str(port)
+    return ip + ":" + str(port)
+
+
+class RecordSet(object):
+    """
+    Insertion-ordered collection of report entries, deduplicated by hash.
+
+    Entries are stored as compact hashable keys, so adding an entry, checking for duplicates and indexing are O(1).
+    The list-like ``append``, ``extend`` and ``+=`` operations are supported, duplicates are silently dropped.
+    ``version`` is incremented whenever an entry is added, so rendered output can be cached.
+    New entries are also offered to ``reservoir``, if one is attached, so a sample is kept up to date as the set grows.
+    ``fingerprint`` is a hash of all entries independent of their order, used to quickly tell two sets apart.
+    """
+    __slots__ = ('_entries', '_order', '_key', 'version', 'reservoir', 'fingerprint')
+
+    def __init__(self, entries=(), key=None):
+        """
+        Parameters
+        ----------
+        entries: iterable
+           Initial entries
+        key: callable
+           Converts an added item to the key stored in the set, items are stored as-is if omitted
+        """
+        self._entries = set()
+        self._order = []
+        self._key = key
+        self.version = 0
+        self.reservoir = None
+        self.fingerprint = 0
+        self.extend(entries)
+
+    def add(self, item):
+        """Add an item, returns False if an equal entry is already present."""
+        entry = self._key(item) if self._key else item
+        if entry in self._entries:
+            return False
+        self._entries.add(entry)
+        self._order.append(entry)
+        self.version += 1
+        self.fingerprint = (self.fingerprint + hash(entry)) & FINGERPRINT_MASK
+        if self.reservoir is not None:
+            self.reservoir.offer(entry)
+        return True
+
+    append = add
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __contains__(self, item):
+        return (self._key(item) if self._key else item) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __getitem__(self, index):
+        return self._order[index]
+
+    def same_entries(self, other):
+        """
+        Returns True if both sets hold the same entries, regardless of the order they were added in.
+
+        Only sizes and fingerprints are compared, so this is O(1). Sets of the same size with different
+        entries compare equal with a probability of about 2**-64.
+        """
+        return len(self) == len(other) and self.fingerprint == other.fingerprint
+
+    def diff(self, previous):
+        """Entries added and removed since ``previous``, another record set."""
+        return SetDiff(self._entries - previous._entries, previous._entries - self._entries)
+
+
+def _stable_priority(entry):
+    """Checksum of an entry's fields, the same in every process."""
+    data = '%s\0' * len(entry) % entry if isinstance(entry, tuple) else repr(entry)
+    return zlib.crc32(data.encode('utf-8'))
+
+
+class Reservoir(object):
+    """
+    Streaming sample of at most ``size`` entries, out of any number offered.
+
+    Each offered entry is given a priority and the ``size`` entries with the lowest priorities are kept,
+    so memory is bounded by the sample size and each offer costs O(log size). Priorities are drawn from
+    ``rng``, giving a uniform random sample of the offered entries, or, in stable mode, derived from a
+    checksum of the entry's fields, so an entry that keeps being offered to new reservoirs keeps being chosen
+    for as long as it remains among the lowest ``size`` priorities, across restarts of the agent too. The
+    builtin ``hash`` of strings is salted per process, so it is not used. Entries must be offered at most once.
+    """
+    __slots__ = ('size', '_rng', '_stable', '_heap', '_offered')
+
+    def __init__(self, size, rng=None, stable=False):
+        """
+        Parameters
+        ----------
+        size: int
+           Maximum number of sampled entries
+        rng: random.Random
+           Source of priorities, a new generator seeded from the system is created if omitted
+        stable: bool
+           Derive priorities from entry checksums rather than from ``rng``
+        """
+        self.size = size
+        self._rng = rng or random.Random()
+        self._stable = stable
+        # max-heap of (-priority, offer index, entry), keeping the lowest priorities
+        self._heap = []
+        self._offered = 0
+
+    def offer(self, entry):
+        """Offer an entry, it replaces the sampled entry with the highest priority if its own is lower."""
+        priority = _stable_priority(entry) if self._stable else self._rng.random()
+        self._offered += 1
+        item = (-priority, self._offered, entry)
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.offer(entry)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def sample(self, size=None):
+        """
+        List of the sampled entries, in the order they were offered.
+
+        A smaller ``size`` returns the entries with the lowest priorities only, the sample a smaller reservoir
+        would have kept.
+        """
+        heap = self._heap
+        if size is not None and size < len(heap):
+            heap = heapq.nlargest(size, heap)
+        return [entry for _, _, entry in sorted(heap, key=lambda item: item[1])]
+
+    def candidates(self):
+        """Sampled entries from the lowest priority to the highest, the order in which a smaller sample keeps them."""
+        return [entry for _, _, entry in sorted(self._heap, reverse=True)]
+
+
+# Outcome of a counter delta, see counter_delta
+COUNTER_OK = 'ok'
+COUNTER_WRAPPED = 'wrapped'
+COUNTER_RESET = 'reset'
+
+COUNTER_32_RANGE = 1 << 32
+# Fastest plausible counter increase, in units per second, 100 Gbit/s in bytes
+MAX_COUNTER_RATE = 12.5e9
+# Fastest plausible packet counter increase, in packets per second
+MAX_PACKET_RATE = 20e6
+# Fastest plausible increase of each NetworkStats counter
+MAX_COUNTER_RATES = NetworkStats(bytes_in=MAX_COUNTER_RATE, bytes_out=MAX_COUNTER_RATE,
+                                 packets_in=MAX_PACKET_RATE, packets_out=MAX_PACKET_RATE)
+
+
+def counter_delta(new, old, elapsed=None, max_rate=MAX_COUNTER_RATE):
+    """
+    Increase of a cumulative counter between two readings, telling a wraparound from a reset.
+
+    A counter lower than in the previous reading is taken to have wrapped around if the previous reading fits
+    in 32 bits and the wrapped increase is less than half the 32-bit range, and no faster than ``max_rate`` over
+    ``elapsed`` seconds. 64-bit counters do not wrap in practice, so any other decrease is a reset, as when an
+    interface is recreated or a container restarts. An increase faster than ``max_rate`` is also a reset, of a
+    counter that was reset and has since grown past its previous reading.
+
+    Parameters
+    ----------
+    new: int
+       Current reading
+    old: int
+       Previous reading
+    elapsed: float
+       Monotonic seconds between the two readings, rates are not checked if omitted
+    max_rate: float
+       Fastest plausible increase, in units per second
+
+    Returns
+    -------
+       A ``(delta, status)`` pair, with ``status`` one of ``COUNTER_OK``, ``COUNTER_WRAPPED`` and ``COUNTER_RESET``.
+       The delta of a reset is None, since the increase before the reset is unknown.
+    """
+    limit = max_rate * elapsed if elapsed else None
+    if new >= old:
+        delta = new - old
+        if limit is not None and delta > limit:
+            return None, COUNTER_RESET
+        return delta, COUNTER_OK
+    if old < COUNTER_32_RANGE:
+        wrapped = new + COUNTER_32_RANGE - old
+        if wrapped < COUNTER_32_RANGE // 2 and (limit is None or wrapped <= limit):
+            return wrapped, COUNTER_WRAPPED
+    return None, COUNTER_RESET
+
+
+class InterfaceSlots(object):
+    """
+    Stable column index of each network interface, shared by successive :class:`InterfaceCounters`.
+
+    An interface keeps its slot for as long as it is present. The slots of interfaces that disappear are
+    reused by new ones, lowest first, so the columns stay as long as the largest number of interfaces seen
+    at once, however many veth or tun interfaces come and go.
+    """
+    __slots__ = ('_slots', '_free', '_size')
+
+    def __init__(self):
+        self._slots = {}
+        self._free = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, name):
+        return self._slots[name]
+
+    def update(self, names):
+        """Release the slots of interfaces missing from ``names`` and assign slots to new ones."""
+        present = set(names)
+        for name in [name for name in self._slots if name not in present]:
+            heapq.heappush(self._free, self._slots.pop(name))
+        for name in names:
+            if name not in self._slots:
+                if self._free:
+                    self._slots[name] = heapq.heappop(self._free)
+                else:
+                    self._slots[name] = self._size
+                    self._size += 1
+
+
+class InterfaceCounters(object):
+    """
+    Cumulative traffic counters of every network interface at one point in time, stored column-wise.
+
+    Each ``NetworkStats`` field is an ``array`` column indexed by the interface's slot in an
+    :class:`InterfaceSlots`, so deltas with a previous reading are computed column by column rather than by
+    looking interfaces up one at a time. ``names`` holds the interface of each slot, None for free slots.
+    """
+    __slots__ = ('slots', 'names', 'columns')
+
+    def __init__(self, stats, slots=None):
+        """
+        Parameters
+        ----------
+        stats: dict
+           Interface name to ``NetworkStats`` record of cumulative counters
+        slots: InterfaceSlots
+           Slots of the previous reading, a new assignment is started if omitted
+        """
+        self.slots = slots if slots is not None else InterfaceSlots()
+        self.slots.update(list(stats))
+        size = len(self.slots)
+        self.names = [None] * size
+        self.columns = tuple(array('Q', bytes(8 * size)) for _ in NetworkStats._fields)
+        for name, record in stats.items():
+            slot = self.slots[name]
+            self.names[slot] = name
+            for column, value in zip(self.columns, record):
+                column[slot] = value
+
+    def totals(self):
+        """Counters summed across interfaces, as a ``NetworkStats`` record."""
+        return NetworkStats(*(sum(column) for column in self.columns))
+
+    def delta(self, old, elapsed=None):
+        """
+        Counter increase of every interface present in both readings.
+
+        Interfaces that appeared or disappeared since ``old`` have no delta, neither have interfaces whose counters
+        were reset, see :func:`counter_delta`. Wrapped counters are corrected. Byte and packet counters are checked
+        against their own rate, see ``MAX_COUNTER_RATES``.
+
+        Parameters
+        ----------
+        old: InterfaceCounters
+           Previous reading
+        elapsed: float
+           Seconds between the two readings
+
+        Returns
+        -------
+           A ``(names, columns, status)`` tuple of the interface names, one ``array`` column per ``NetworkStats``
+           field, and ``COUNTER_RESET`` if any interface was left out because of a reset, ``COUNTER_WRAPPED`` if
+           any counter wrapped, ``COUNTER_OK`` otherwise.
+        """
+        names = self.names
+        old_names = old.names
+        slots = [slot for slot in range(min(len(names), len(old_names)))
+                 if names[slot] is not None and names[slot] == old_names[slot]]
+        status = COUNTER_OK
+        reset = set()
+        columns = []
+        for new, previous, max_rate in zip(self.columns, old.columns, MAX_COUNTER_RATES):
+            limit = max_rate * elapsed if elapsed else None
+            delta = array('q', [new[slot] - previous[slot] for slot in slots])
+            # only counters that went down or jumped implausibly need a closer look
+            for index in [index for index, value in enumerate(delta)
+                          if value < 0 or (limit is not None and value > limit)]:
+                value, counter_status = counter_delta(new[slots[index]], previous[slots[index]], elapsed, max_rate)
+                if value is None:
+                    reset.add(index)
+                else:
+                    delta[index] = value
+                    status = COUNTER_WRAPPED
+            columns.append(delta)
+
+        if reset:
+            kept = [index for index in range(len(slots)) if index not in reset]
+            slots = [slots[index] for index in kept]
+            columns = [array('q', [column[index] for index in kept]) for column in columns]
+            status = COUNTER_RESET
+        return [names[slot] for slot in slots], tuple(columns), status
+
+
+# Keys of listening port entries are not shortened by short tag names
+PORT_KEYS = ('port', 'interface')
+
+
+def _port_key(port):
+    """Reduce a listening port dictionary to a ListeningPort record."""
+    if isinstance(port, dict):
+        return ListeningPort(port['port'], port.get('interface'))
+    return port
+
+
+def _port_dict(entry):
+    if isinstance(entry, ListeningPort):
+        if entry.interface:
+            return {'port': entry.port, 'interface': entry.interface}
+        return {'port': entry.port}
+    return entry
 
 
 class Metrics(object):
@@ -34,9 +442,15 @@ class Metrics(object):
         **Selectable metric tags**: allow for verbose metrics tags, for easier debugging, or short memonic tags,
         reducing the amount data transmitted and stored in memory.
 
+        **Memoized rendering**: the report is built and sampled once, and shared by all serialization formats
+        until metrics are added or ``max_list_size`` changes.
+
+        **Incremental reports**: connections and listening ports that are the same as in the previous metrics
+        object keep the previous report's sample and rendered entries, and :meth:`diff` lists what changed.
+
     """
 
-    def __init__(self, short_names=False, last_metric=None):
+    def __init__(self, short_names=False, last_metric=None, stable_sampling=False):
         """Initialize a new metrics object.
 
         Parameters
@@ -45,43 +459,168 @@ class Metrics(object):
                 Toggle short object tags in output metrics.
         last_metric : Metrics object
                 Metric object used for delta metric calculation.
+        stable_sampling : bool
+                Sample large lists by a checksum of each entry rather than randomly, so the same long-lived
+                connections and ports are reported from one report to the next, and after restarts of the agent,
+                instead of a new random subset every time.
         """
         self.t = tags.Tags(short_names)
         # Header Information
         self._timestamp = int(time.time())
+        # Monotonic start and end of collection, the end is set by whoever finishes populating the metrics
+        self.collection_start = time.monotonic()
+        self.collection_end = None
         if last_metric is None:
             self.interval = 0
+            self._elapsed_interval = 0.0
         else:
             self.interval = self._timestamp - last_metric._timestamp
+            self._elapsed_interval = self.collection_start - last_metric.collection_start
+
+        self._max_list_size = 50
+        self._max_payload_size = None
+        self._payload_format = FORMAT_JSON
+        self._stable_sampling = stable_sampling
+        self._rng = random.Random()
 
-        # Network Metrics
-        self._net_connections = []
-        self.listening_tcp_ports = []
-        self.listening_udp_ports = []
+        # Network Metrics, stored as records and rendered to dictionaries on output
+        self._net_connections = self._with_reservoir(RecordSet())
+        self._listening_tcp_ports = self._with_reservoir(RecordSet(key=_port_key))
+        self._listening_udp_ports = self._with_reservoir(RecordSet(key=_port_key))
 
         # Custom Metrics
         self.cpu_metrics = []
 
-        # Network Stats By Interface
-        self.total_counts = {}  # The raw values from the system
-        self._interface_stats = {}  # The diff values, if delta metrics are used
+        # Network Stats By Interface, as NetworkStats records
+        self.total_counts = None  # The raw values from the system
+        self._interface_stats = None  # The diff values, if delta metrics are used
+        self._stats_time = None  # Monotonic time the raw values were read
+        # COUNTER_OK, COUNTER_WRAPPED or COUNTER_RESET once a delta was computed, network stats are left out on reset
+        self.network_stats_status = None
+        # Per-interface mode, as InterfaceCounters readings and their deltas by interface name
+        self.interface_counts = None
+        self._per_interface_stats = None
         if last_metric is None:
-            self._old_interface_stats = {}
+            self._old_interface_stats = None
+            self._old_stats_time = None
+            self._old_interface_counts = None
         else:
             self._old_interface_stats = last_metric.total_counts
+            self._old_stats_time = last_metric._stats_time
+            self._old_interface_counts = last_metric.interface_counts
+
+        # Sections of the previous report, kept instead of the previous object so metrics do not chain in memory
+        self._previous = None if last_metric is None else last_metric._sections()
 
-        self.max_list_size = 50
+        # Sampled list entries and rendered report, with the cache key they were built for
+        self._revision = 0
+        self._samples = None
+        self._samples_key = None
+        self._sample_sources = (None, None, None)
+        self._rendered = None
+        self._rendered_key = None
+        self._report = None
+        self._report_key = None
+
+    @property
+    def report_id(self):
+        """Identifier of the report in its header, used to match Device Defender's responses to it."""
+        return self._timestamp
+
+    @report_id.setter
+    def report_id(self, report_id):
+        self._timestamp = int(report_id)
+        self._revision += 1
+
+    @property
+    def max_list_size(self):
+        """Lists larger than this size are randomly sampled down to it in the report."""
+        return self._max_list_size
+
+    @max_list_size.setter
+    def max_list_size(self, size):
+        self._max_list_size = size
+        self._revision += 1
+        for record_set in (self._net_connections, self._listening_tcp_ports, self._listening_udp_ports):
+            self._with_reservoir(record_set)
+
+    @property
+    def max_payload_size(self):
+        """
+        Size in bytes the encoded report is kept under, None for no limit.
+
+        Lists are sampled down to fit, at most ``max_list_size`` entries each, see :meth:`_budgeted_samples`.
+        The size is that of the compact encoding in ``payload_format``.
+        """
+        return self._max_payload_size
+
+    @max_payload_size.setter
+    def max_payload_size(self, size):
+        self._max_payload_size = size
+        self._revision += 1
+
+    @property
+    def payload_format(self):
+        """Serialization format ``max_payload_size`` applies to, ``json`` or ``cbor``."""
+        return self._payload_format
+
+    @payload_format.setter
+    def payload_format(self, payload_format):
+        if payload_format not in FORMATS:
+            raise ValueError("Invalid payload format: " + str(payload_format))
+        self._payload_format = payload_format
+        self._revision += 1
+
+    def _new_reservoir(self):
+        return Reservoir(self._max_list_size, self._rng, self._stable_sampling)
+
+    def _with_reservoir(self, record_set):
+        """Attach a reservoir sized to ``max_list_size`` to a record set, filled with its current entries."""
+        if self._max_list_size:
+            record_set.reservoir = self._new_reservoir()
+            record_set.reservoir.extend(record_set)
+        else:
+            record_set.reservoir = None
+        return record_set
 
     @property
     def network_stats(self):
         """Retrieve network TCP and UDP stats aggregated across all interfaces."""
-        return self._interface_stats
+        if not self._interface_stats:
+            return {}
+        t = self.t
+        stats = self._interface_stats
+        return {t.bytes_in: stats.bytes_in,
+                t.bytes_out: stats.bytes_out,
+                t.packets_in: stats.packets_in,
+                t.packets_out: stats.packets_out}
+
+    @property
+    def listening_tcp_ports(self):
+        """Deduplicated set of listening TCP ports, a :class:`RecordSet` of :class:`ListeningPort` entries."""
+        return self._listening_tcp_ports
+
+    @listening_tcp_ports.setter
+    def listening_tcp_ports(self, ports):
+        self._listening_tcp_ports = self._with_reservoir(RecordSet(ports, key=_port_key))
+        self._revision += 1
+
+    @property
+    def listening_udp_ports(self):
+        """Deduplicated set of listening UDP ports, a :class:`RecordSet` of :class:`ListeningPort` entries."""
+        return self._listening_udp_ports
+
+    @listening_udp_ports.setter
+    def listening_udp_ports(self, ports):
+        self._listening_udp_ports = self._with_reservoir(RecordSet(ports, key=_port_key))
+        self._revision += 1
 
     def listening_ports(self, protocol):
+        """List of listening port dictionaries for a protocol, TCP or UDP."""
         if protocol.upper() == "UDP":
-            return self.listening_udp_ports
+            return [_port_dict(p) for p in self._listening_udp_ports]
         elif protocol.upper() == "TCP":
-            return self.listening_tcp_ports
+            return [_port_dict(p) for p in self._listening_tcp_ports]
         else:
             print(("Invalid Protocol: " + protocol))
             return []
@@ -100,13 +639,9 @@ class Metrics(object):
 
         """
         if protocol.upper() == "UDP":
-            for p in ports:
-                if p not in self.listening_udp_ports:
-                    self.listening_udp_ports += ports
+            self._listening_udp_ports.extend(ports)
         elif protocol.upper() == "TCP":
-            for p in ports:
-                if p not in self.listening_tcp_ports:
-                    self.listening_tcp_ports += ports
+            self._listening_tcp_ports.extend(ports)
         else:
             print(("Invalid Protocol: " + protocol))
 
@@ -116,6 +651,9 @@ class Metrics(object):
         If a previous metrics object was supplied,attempts to calculate and store delta metric.
         If a previous metrics object is not present, we do not send any metrics.
 
+        Counters that wrapped around are corrected, and if any counter was reset, network stats are left out of
+        the report rather than sending a bogus delta, see :func:`counter_delta` and ``network_stats_status``.
+
         Parameters
         ----------
         bytes_in: int
@@ -127,26 +665,77 @@ class Metrics(object):
         packets_out: int
            Number of packets sent from this interface
         """
-        self.total_counts = {
-            'bytes_in': bytes_in,
-            'bytes_out': bytes_out,
-            'packets_in': packets_in,
-            'packets_out': packets_out
-        }
+        self._revision += 1
+        self.total_counts = NetworkStats(bytes_in, bytes_out, packets_in, packets_out)
+        self._stats_time = time.monotonic()
 
-        if self._old_interface_stats:
-            bytes_in_diff = bytes_in - self._old_interface_stats[self.t.bytes_in]
-            bytes_out_diff = bytes_out - self._old_interface_stats[self.t.bytes_out]
-            packets_in_diff = packets_in - self._old_interface_stats[self.t.packets_in]
-            packets_out_diff = packets_out - self._old_interface_stats[self.t.packets_out]
+        old = self._old_interface_stats
+        if old:
+            elapsed = self._elapsed()
+            deltas = [counter_delta(new, previous, elapsed, max_rate)
+                      for new, previous, max_rate in zip(self.total_counts, old, MAX_COUNTER_RATES)]
+            statuses = set(status for _, status in deltas)
+            if COUNTER_RESET in statuses:
+                self._interface_stats = None
+                self.network_stats_status = COUNTER_RESET
+            else:
+                self._interface_stats = NetworkStats(*(delta for delta, _ in deltas))
+                self.network_stats_status = COUNTER_WRAPPED if COUNTER_WRAPPED in statuses else COUNTER_OK
+        else:
+            self._interface_stats = None
+
+    def _elapsed(self):
+        """Seconds between the previous and current counter readings, None if unknown."""
+        if self._old_stats_time is None or self._stats_time is None:
+            return None
+        return self._stats_time - self._old_stats_time
 
-            self._interface_stats = {self.t.bytes_in: bytes_in_diff,
-                                     self.t.bytes_out: bytes_out_diff,
-                                     self.t.packets_in: packets_in_diff,
-                                     self.t.packets_out: packets_out_diff}
+    def add_interface_stats(self, stats):
+        """
+        Add cumulative network stats of each network interface.
 
+        The report keeps the aggregate ``network_stats`` of :meth:`add_network_stats`, summed over the interfaces
+        present in both this and the previous reading, so interfaces that come and go do not skew it.
+        Per-interface deltas are available from :attr:`interface_stats`.
+
+        Parameters
+        ----------
+        stats: dict
+           Interface name to ``NetworkStats`` record of cumulative counters
+        """
+        self._revision += 1
+        old = self._old_interface_counts
+        counts = InterfaceCounters(stats, old.slots if old is not None else None)
+        self.interface_counts = counts
+        self.total_counts = counts.totals()
+        self._stats_time = time.monotonic()
+
+        if old is not None:
+            names, columns, self.network_stats_status = counts.delta(old, self._elapsed())
+            self._per_interface_stats = (names, columns)
+            self._interface_stats = NetworkStats(*(sum(column) for column in columns))
         else:
-            self._interface_stats = {}
+            self._per_interface_stats = None
+            self._interface_stats = None
+
+    @property
+    def interface_stats(self):
+        """Network stats delta of each interface, as an ordered dictionary of ``NetworkStats`` records by name."""
+        if not self._per_interface_stats:
+            return OrderedDict()
+        names, columns = self._per_interface_stats
+        return OrderedDict(sorted((name, NetworkStats(*values)) for name, values in zip(names, zip(*columns))))
+
+    @property
+    def network_rates(self):
+        """
+        Network stats delta divided by the time between the two counter readings, as a ``NetworkStats`` record
+        of per-second rates, or None if there is no delta.
+        """
+        elapsed = self._elapsed()
+        if not self._interface_stats or elapsed is None or elapsed <= 0:
+            return None
+        return NetworkStats(*(value / elapsed for value in self._interface_stats))
 
     def add_network_connection(self, remote_addr, remote_port, interface, local_port):
         """
@@ -163,15 +752,7 @@ class Metrics(object):
         local_port: int
             Local port of the connection
         """
-        ipAddress = remote_addr
-        if type(ip_address(remote_addr)) is not IPv4Address:
-            ipAddress = "[" + remote_addr + "]"
-        new_conn = {self.t.remote_addr: ipAddress + ":" + str(remote_port),
-                    self.t.local_interface: interface,
-                    self.t.local_port: local_port}
-
-        if new_conn not in self._net_connections:
-            self._net_connections.append(new_conn)
+        self._net_connections.add(Connection(remote_addr, remote_port, interface, local_port))
 
     def add_cpu_usage(self, cpu_usage):
         """
@@ -183,33 +764,47 @@ class Metrics(object):
              representing the current system-wide CPU utilization as a percentage
         """
         self.cpu_metrics = {"number": cpu_usage}
+        self._revision += 1
 
 
     @property
     def network_connections(self):
-        return self._net_connections
+        """List of connection dictionaries, keyed by metric tags."""
+        return [self._connection_dict(c) for c in self._net_connections]
+
+    def _connection_dict(self, connection):
+        t = self.t
+        return {t.remote_addr: format_address(connection.remote_addr, connection.remote_port),
+                t.local_interface: connection.local_interface,
+                t.local_port: connection.local_port}
 
     def _sample_list(self, input_list):
         """
         Downsamples a list to a desired size, choosing random elements from input list.
 
+        Record sets carry a reservoir that is filled as entries are added, other collections are streamed
+        through a new one.
+
         Parameters
         ----------
-        input_list: list
-           List of arbitrary size
+        input_list: iterable
+           Collection of arbitrary size
 
         Returns
         -------
            A list of of length of less than or equal to max_list_size,
-           with items randomly selected from input list
+           with items randomly selected from input list, in their original order
 
         """
-        if self.max_list_size and len(input_list) > self.max_list_size:
-            random.seed(os.urandom(50))
-            output_list = random.sample(input_list, self.max_list_size)
-            return output_list
-        else:
-            return input_list
+        size = self.max_list_size
+        if not size or len(input_list) <= size:
+            return list(input_list)
+
+        reservoir = getattr(input_list, 'reservoir', None)
+        if reservoir is None or reservoir.size != size:
+            reservoir = self._new_reservoir()
+            reservoir.extend(input_list)
+        return reservoir.sample()
 
     def to_json_string(self, pretty_print=False):
         """
@@ -227,12 +822,209 @@ class Metrics(object):
         else:
             return json.dumps(metrics, separators=(',', ':'))
 
-    def to_cbor(self):
-        """Returns a cbor serialized metrics object."""
-        return cbor.dumps(self._v1_metrics())
+    def write_json(self, sink):
+        """
+        Stream the metrics as compact json to a binary file-like object, such as ``io.BytesIO``.
+
+        The output is byte-identical to ``to_json_string()``, but the report is written straight from the
+        stored metrics, without building it as nested dictionaries first.
+
+        Parameters
+        ----------
+        sink: file-like
+            Object with a ``write`` method accepting bytes.
+
+        Returns
+        -------
+            The sink
+        """
+        self._write_v1_metrics(JsonWriter(sink))
+        return sink
+
+    def to_cbor(self, buffer=None):
+        """
+        Returns a cbor serialized metrics object, as bytes that can be published as-is.
+
+        The report is encoded by the C extension of the ``cbor`` package from the same cached report as
+        ``to_json_string``. Without the extension, it is streamed by :class:`~cborwriter.CborWriter` straight
+        from the stored metrics instead, which is faster than the package's pure Python encoder. Both produce
+        the same bytes.
+
+        Parameters
+        ----------
+        buffer: bytearray
+            Buffer to encode into and return, allowing it to be reused across reports. Its previous content is
+            discarded.
+        """
+        if not CBOR_EXTENSION:
+            writer = CborWriter(buffer)
+            self._write_v1_metrics(writer)
+            return writer.buffer
+        encoded = cbor.dumps(self._v1_metrics())
+        if buffer is None:
+            return encoded
+        buffer[:] = encoded
+        return buffer
+
+    def _cache_key(self):
+        return (self._revision,
+                self._net_connections.version,
+                self._listening_tcp_ports.version,
+                self._listening_udp_ports.version)
+
+    def _record_sets(self):
+        return self._net_connections, self._listening_tcp_ports, self._listening_udp_ports
+
+    def _sections(self):
+        """Record sets of this report, with their sample and rendered entries if the report is current."""
+        key = self._cache_key()
+        samples = self._samples if self._samples_key == key else None
+        rendered = self._rendered if samples is not None and self._rendered_key == key else None
+        return tuple(_Section(records, self._max_list_size, self.t,
+                              samples[index] if samples else None,
+                              rendered[index] if rendered else None)
+                     for index, records in enumerate(self._record_sets()))
+
+    def _unchanged_section(self, index):
+        """Previous report's section at ``index``, if it was sampled from the same entries with the same size."""
+        if self._previous is None:
+            return None
+        section = self._previous[index]
+        if section.sample is None or section.max_list_size != self._max_list_size:
+            return None
+        if not section.records.same_entries(self._record_sets()[index]):
+            return None
+        return section
+
+    def _sampled(self):
+        """
+        Sampled connections, listening TCP ports and listening UDP ports, cached until the metrics change.
+
+        Sections with the same entries as the previous report reuse its sample.
+        """
+        key = self._cache_key()
+        if self._samples is None or self._samples_key != key:
+            if self._max_payload_size:
+                # sizes depend on every section, a previous sample may no longer fit
+                sources = (None, None, None)
+                self._samples = self._budgeted_samples()
+            else:
+                sources = tuple(self._unchanged_section(index) for index in range(3))
+                self._samples = tuple(source.sample if source else self._sample_list(records)
+                                      for source, records in zip(sources, self._record_sets()))
+            self._sample_sources = sources
+            self._samples_key = key
+        return self._samples
+
+    def _budgeted_samples(self):
+        """
+        Samples of connections, listening TCP ports and listening UDP ports that fit within ``max_payload_size``.
+
+        The report without list entries is encoded once, then the remaining budget is filled with entries in the
+        order their reservoirs would keep them, each costed with its exact encoded size. The next entry is always
+        taken from the list with the smallest share of its entries reported so far, so coverage is balanced
+        across lists. Short tags and CBOR leave room for more entries.
+        """
+        writer = CborWriter() if self._payload_format == FORMAT_CBOR else JsonWriter(io.BytesIO())
+        remaining = self._max_payload_size - self._encoded_size(([], [], [])) - 3 * _ARRAY_HEADER_SLACK
+
+        record_sets = self._record_sets()
+        reservoirs = []
+        for records in record_sets:
+            reservoir = records.reservoir
+            if reservoir is None or reservoir.size != self._max_list_size:
+                reservoir = Reservoir(self._max_list_size or len(records), self._rng, self._stable_sampling)
+                reservoir.extend(records)
+            reservoirs.append(reservoir)
+        candidates = [reservoir.candidates() for reservoir in reservoirs]
+
+        t = self.t
+        connection_keys = (t.remote_addr, t.local_interface, t.local_port)
+
+        def connection_size(c):
+            return writer.record_size(connection_keys, (format_address(c.remote_addr, c.remote_port),
+                                                        c.local_interface, c.local_port))
+
+        def port_size(p):
+            if not isinstance(p, ListeningPort):
+                return len(json.dumps(p, separators=(',', ':'))) + 1
+            return writer.record_size(PORT_KEYS if p.interface else PORT_KEYS[:1], p)
+
+        sizes = (connection_size, port_size, port_size)
+        counts = [0, 0, 0]
+        # (share of the list reported, list index), the least covered list gets the next entry
+        heap = [(0.0, index) for index in range(3) if candidates[index]]
+        while heap and remaining > 0:
+            _, index = heapq.heappop(heap)
+            size = sizes[index](candidates[index][counts[index]])
+            if size > remaining:
+                continue
+            remaining -= size
+            counts[index] += 1
+            if counts[index] < len(candidates[index]):
+                heapq.heappush(heap, (float(counts[index]) / len(record_sets[index]), index))
+        return tuple(reservoir.sample(count) for reservoir, count in zip(reservoirs, counts))
+
+    def _encoded_size(self, samples):
+        """Size of the compact report in ``payload_format``, with the given samples of each list."""
+        if self._payload_format == FORMAT_CBOR:
+            writer = CborWriter()
+            self._write_v1_metrics(writer, samples)
+            return len(writer.buffer)
+        sink = io.BytesIO()
+        self._write_v1_metrics(JsonWriter(sink), samples)
+        return sink.tell()
+
+    def _rendered_entries(self):
+        """Sampled entries rendered to dictionaries, unchanged sections reuse the previous report's lists."""
+        samples = self._sampled()
+        key = self._samples_key
+        if self._rendered is None or self._rendered_key != key:
+            render = (self._connection_dict, _port_dict, _port_dict)
+            self._rendered = tuple(
+                source.rendered if source and source.rendered is not None and source.tags is self.t
+                else [render[index](entry) for entry in sample]
+                for index, (source, sample) in enumerate(zip(self._sample_sources, samples)))
+            self._rendered_key = key
+        return self._rendered
+
+    def diff(self, previous=None):
+        """
+        Connections and listening ports added and removed since a previous metrics object.
+
+        Parameters
+        ----------
+        previous: Metrics object
+            Metrics to compare with, defaults to the ``last_metric`` this object was created with.
+
+        Returns
+        -------
+            A ``MetricsDiff`` of ``SetDiff`` records for connections, TCP ports and UDP ports,
+            or None if there is nothing to compare with.
+        """
+        if previous is not None:
+            previous_sets = previous._record_sets()
+        elif self._previous is not None:
+            previous_sets = [section.records for section in self._previous]
+        else:
+            return None
+        return MetricsDiff(*(records.diff(previous_records)
+                             for records, previous_records in zip(self._record_sets(), previous_sets)))
 
     def _v1_metrics(self):
-        """Format metrics in Device Defender version 1 format."""
+        """
+        Format metrics in Device Defender version 1 format.
+
+        The report, including the sampled subset of each list, is built once and reused until the metrics
+        change, so every serialization of the same metrics agrees. The returned report must not be modified.
+        """
+        key = self._cache_key()
+        if self._report is None or self._report_key != key:
+            self._report = self._build_v1_metrics()
+            self._report_key = key
+        return self._report
+
+    def _build_v1_metrics(self):
 
         t = self.t
         header = {t.report_id: self._timestamp,
@@ -242,17 +1034,19 @@ class Metrics(object):
         if self.network_stats:
             metrics[t.interface_stats] = self.network_stats
 
+        connections, tcp_ports, udp_ports = self._rendered_entries()
+
         if self._net_connections:
-            metrics[t.tcp_conn] = {t.established_connections: {t.connections: self._sample_list(self._net_connections),
+            metrics[t.tcp_conn] = {t.established_connections: {t.connections: connections,
                                                                t.total: len(self._net_connections)}}
 
-        if self.listening_tcp_ports:
-            metrics[t.listening_tcp_ports] = {t.ports: self._sample_list(self.listening_tcp_ports),
-                                              t.total: len(self.listening_tcp_ports)}
+        if self._listening_tcp_ports:
+            metrics[t.listening_tcp_ports] = {t.ports: tcp_ports,
+                                              t.total: len(self._listening_tcp_ports)}
 
-        if self.listening_udp_ports:
-            metrics[t.listening_udp_ports] = {t.ports: self._sample_list(self.listening_udp_ports),
-                                              t.total: len(self.listening_udp_ports)}
+        if self._listening_udp_ports:
+            metrics[t.listening_udp_ports] = {t.ports: udp_ports,
+                                              t.total: len(self._listening_udp_ports)}
 
         report = {t.header: header,
                   t.metrics: metrics}
@@ -261,3 +1055,91 @@ class Metrics(object):
             report[t.custom_metrics] = {t.cpu_usage: [self.cpu_metrics]}
 
         return report
+
+    def _write_v1_metrics(self, writer, samples=None):
+        """
+        Stream the Device Defender version 1 report to a report writer, such as a :class:`CborWriter`.
+
+        Entries are written straight from their records, in the same order and with the same sampled
+        subset as :meth:`_v1_metrics`, unless other ``samples`` of each list are given.
+        """
+        t = self.t
+        stats = self._interface_stats
+        sampled_connections, sampled_tcp_ports, sampled_udp_ports = samples or self._sampled()
+        sections = sum(1 for section in (stats, self._net_connections,
+                                         self._listening_tcp_ports, self._listening_udp_ports) if section)
+
+        writer.begin_map(3 if self.cpu_metrics else 2)
+
+        writer.key(t.header)
+        writer.begin_map(2)
+        writer.key(t.report_id)
+        writer.value(self._timestamp)
+        writer.key(t.version)
+        writer.value("1.0")
+        writer.end_map()
+
+        writer.key(t.metrics)
+        writer.begin_map(sections)
+
+        if stats:
+            writer.key(t.interface_stats)
+            writer.begin_map(4)
+            writer.key(t.bytes_in)
+            writer.value(stats.bytes_in)
+            writer.key(t.bytes_out)
+            writer.value(stats.bytes_out)
+            writer.key(t.packets_in)
+            writer.value(stats.packets_in)
+            writer.key(t.packets_out)
+            writer.value(stats.packets_out)
+            writer.end_map()
+
+        if self._net_connections:
+            writer.key(t.tcp_conn)
+            writer.begin_map(1)
+            writer.key(t.established_connections)
+            writer.begin_map(2)
+            writer.key(t.connections)
+            writer.begin_array(len(sampled_connections))
+            keys = (t.remote_addr, t.local_interface, t.local_port)
+            for c in sampled_connections:
+                writer.record(keys, (format_address(c.remote_addr, c.remote_port), c.local_interface, c.local_port))
+            writer.end_array()
+            writer.key(t.total)
+            writer.value(len(self._net_connections))
+            writer.end_map()
+            writer.end_map()
+
+        for tag, ports, sampled_ports in ((t.listening_tcp_ports, self._listening_tcp_ports, sampled_tcp_ports),
+                                          (t.listening_udp_ports, self._listening_udp_ports, sampled_udp_ports)):
+            if not ports:
+                continue
+            writer.key(tag)
+            writer.begin_map(2)
+            writer.key(t.ports)
+            writer.begin_array(len(sampled_ports))
+            for p in sampled_ports:
+                if not isinstance(p, ListeningPort):
+                    writer.value(p)
+                elif p.interface:
+                    writer.record(PORT_KEYS, p)
+                else:
+                    writer.record(PORT_KEYS[:1], p)
+            writer.end_array()
+            writer.key(t.total)
+            writer.value(len(ports))
+            writer.end_map()
+
+        writer.end_map()
+
+        if self.cpu_metrics:
+            writer.key(t.custom_metrics)
+            writer.begin_map(1)
+            writer.key(t.cpu_usage)
+            writer.begin_array(1)
+            writer.value(self.cpu_metrics)
+            writer.end_array()
+            writer.end_map()
+
+        writer.end_map()
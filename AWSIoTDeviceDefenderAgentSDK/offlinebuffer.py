@@ -0,0 +1,414 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from AWSIoTDeviceDefenderAgentSDK.scheduler import Scheduler
+
+# Record header: payload length, topic length, crc32 of topic and payload
+RECORD_HEADER = struct.Struct('<IHI')
+# Read position: segment number, offset in the segment, crc32 of both
+INDEX = struct.Struct('<QQI4x')
+SEGMENT_SUFFIX = '.seg'
+INDEX_FILE = 'index'
+
+
+def _segment_name(number):
+    return '%020d%s' % (number, SEGMENT_SUFFIX)
+
+
+def _checksum(topic, payload):
+    return zlib.crc32(payload, zlib.crc32(topic)) & 0xffffffff
+
+
+class OfflineBuffer(object):
+    """
+    Persistent, size-bounded FIFO of serialized reports, kept while the MQTT connection is down.
+
+    Reports are appended to segment files in ``directory`` and flushed to disk before :meth:`append` returns.
+    The position of the oldest report not yet delivered is kept in a small memory-mapped index file, updated
+    in place as reports are acknowledged, and fully delivered segments are deleted.
+
+    Every record carries a checksum. When the buffer is opened, a record left incomplete by a crash is
+    truncated from the last segment, and an index that does not check out falls back to the oldest segment,
+    so reports are delivered at least once. When the buffer exceeds ``max_bytes``, its oldest segment is
+    evicted, whether or not it was delivered.
+    """
+
+    MAX_BYTES = 10 * 1024 * 1024
+    SEGMENT_BYTES = 1024 * 1024
+
+    def __init__(self, directory, max_bytes=MAX_BYTES, segment_bytes=SEGMENT_BYTES, sync=True):
+        """
+        Parameters
+        ----------
+        directory: string
+            Directory holding the buffer, created if missing.
+        max_bytes: int
+            Size of the buffer on disk above which the oldest segments are evicted.
+        segment_bytes: int
+            Size above which a new segment is started.
+        sync: bool
+            fsync every appended report and every acknowledgement, so they survive power loss and not only a crash
+            of the agent.
+        """
+        if segment_bytes > max_bytes:
+            raise ValueError("Segment size must not exceed the buffer size")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self.evicted = 0
+        self._lock = threading.RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # segment number -> [size in bytes, number of records]
+        self._segments = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                number = int(name[:-len(SEGMENT_SUFFIX)])
+                self._segments[number] = self._recover(number)
+        if not self._segments:
+            self._segments[0] = [0, 0]
+
+        self._writer = open(self._path(max(self._segments)), 'ab')
+        self._reader = None
+        self._reader_segment = None
+        self._peeked = None
+
+        self._index = self._open_index()
+        self._read_segment, self._read_offset = self._load_index()
+        self._pending = self._count_pending()
+
+    def _path(self, number):
+        return os.path.join(self.directory, _segment_name(number))
+
+    @staticmethod
+    def _scan(f, offset=0):
+        """Yield the offset following each valid record of a segment, from ``offset``."""
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            payload_length, topic_length, checksum = RECORD_HEADER.unpack(header)
+            topic = f.read(topic_length)
+            payload = f.read(payload_length)
+            if len(topic) < topic_length or len(payload) < payload_length or _checksum(topic, payload) != checksum:
+                return
+            offset += RECORD_HEADER.size + topic_length + payload_length
+            yield offset
+
+    def _recover(self, number):
+        """Size and record count of a segment, truncating it after its last valid record."""
+        path = self._path(number)
+        records = 0
+        end = 0
+        with open(path, 'r+b') as f:
+            for end in self._scan(f):
+                records += 1
+            if end != os.path.getsize(path):
+                print("Truncating incomplete report at offset {} of offline buffer segment {}".format(end, path))
+                f.truncate(end)
+        return [end, records]
+
+    def _open_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < INDEX.size:
+                os.ftruncate(fd, INDEX.size)
+            return mmap.mmap(fd, INDEX.size)
+        finally:
+            os.close(fd)
+
+    def _load_index(self):
+        segment, offset, checksum = INDEX.unpack_from(self._index)
+        oldest = min(self._segments)
+        valid = checksum == zlib.crc32(INDEX.pack(segment, offset, 0)[:16]) & 0xffffffff
+        if not valid or segment not in self._segments or offset > self._segments[segment][0]:
+            return oldest, 0
+        return segment, offset
+
+    def _store_index(self):
+        packed = INDEX.pack(self._read_segment, self._read_offset, 0)
+        self._index[:] = INDEX.pack(self._read_segment, self._read_offset, zlib.crc32(packed[:16]) & 0xffffffff)
+        if self.sync:
+            self._index.flush()
+
+    def _count_pending(self):
+        pending = 0
+        for number in sorted(self._segments):
+            if number < self._read_segment:
+                continue
+            if number == self._read_segment:
+                with open(self._path(number), 'rb') as f:
+                    pending += sum(1 for _ in self._scan(f, self._read_offset))
+            else:
+                pending += self._segments[number][1]
+        return pending
+
+    def __len__(self):
+        """Number of reports not delivered yet."""
+        return self._pending
+
+    @property
+    def size(self):
+        """Bytes used by segment files."""
+        return sum(size for size, _ in self._segments.values())
+
+    def append(self, topic, payload):
+        """
+        Durably add a report at the end of the buffer, evicting the oldest segments if it is full.
+
+        Parameters
+        ----------
+        topic: string
+            Topic to publish the report to.
+        payload: bytes or string
+            Serialized report.
+        """
+        topic = topic.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        record = RECORD_HEADER.pack(len(payload), len(topic), _checksum(topic, payload)) + topic + bytes(payload)
+        if len(record) > self.segment_bytes:
+            raise ValueError("Report of {} bytes does not fit in an offline buffer segment".format(len(record)))
+
+        with self._lock:
+            current = max(self._segments)
+            if self._segments[current][0] + len(record) > self.segment_bytes:
+                self._writer.close()
+                current += 1
+                self._segments[current] = [0, 0]
+                self._writer = open(self._path(current), 'ab')
+
+            self._writer.write(record)
+            self._writer.flush()
+            if self.sync:
+                os.fsync(self._writer.fileno())
+            self._segments[current][0] += len(record)
+            self._segments[current][1] += 1
+            self._pending += 1
+
+            while self.size > self.max_bytes and len(self._segments) > 1:
+                self._evict(min(self._segments))
+
+    def _evict(self, number):
+        if number == self._read_segment:
+            with open(self._path(number), 'rb') as f:
+                lost = sum(1 for _ in self._scan(f, self._read_offset))
+            self._advance_segment()
+        elif number > self._read_segment:
+            lost = self._segments[number][1]
+        else:
+            lost = 0
+        self._pending -= lost
+        self.evicted += lost
+        print("Offline buffer full, evicted {} undelivered report(s)".format(lost))
+        self._delete(number)
+
+    def _delete(self, number):
+        del self._segments[number]
+        os.remove(self._path(number))
+
+    def _advance_segment(self):
+        """Move the read position to the start of the next segment."""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._read_segment = min(n for n in self._segments if n > self._read_segment)
+        self._read_offset = 0
+        self._store_index()
+
+    def peek(self):
+        """Oldest undelivered report as a ``(topic, payload)`` pair, or None if the buffer is empty."""
+        with self._lock:
+            while self._pending:
+                if self._reader is None or self._reader_segment != self._read_segment:
+                    if self._reader is not None:
+                        self._reader.close()
+                    self._reader = open(self._path(self._read_segment), 'rb')
+                    self._reader_segment = self._read_segment
+
+                self._reader.seek(self._read_offset)
+                header = self._reader.read(RECORD_HEADER.size)
+                if len(header) == RECORD_HEADER.size:
+                    payload_length, topic_length, _ = RECORD_HEADER.unpack(header)
+                    topic = self._reader.read(topic_length).decode('utf-8')
+                    payload = self._reader.read(payload_length)
+                    self._peeked = (self._read_segment, self._read_offset,
+                                    RECORD_HEADER.size + topic_length + payload_length)
+                    return topic, payload
+
+                # end of a fully delivered segment
+                finished = self._read_segment
+                self._advance_segment()
+                self._delete(finished)
+            return None
+
+    def ack(self):
+        """Mark the report returned by the last :meth:`peek` as delivered."""
+        with self._lock:
+            if self._peeked is None:
+                raise ValueError("No report to acknowledge")
+            segment, offset, size = self._peeked
+            self._peeked = None
+            if (segment, offset) != (self._read_segment, self._read_offset):
+                # evicted while it was being delivered
+                return
+            self._read_offset += size
+            self._pending -= 1
+            self._store_index()
+
+    def drain(self, publish, rate=None, timeout=30.0, stop=None):
+        """
+        Publish buffered reports oldest first, until the buffer is empty or a publish fails.
+
+        Parameters
+        ----------
+        publish: callable
+            Publishes a payload to a topic, returning a ``concurrent.futures.Future`` or None.
+        rate: float
+            Maximum number of reports published per second, unlimited if omitted.
+        timeout: float
+            Seconds to wait for each publish to complete.
+        stop: threading.Event
+            Stops draining when set.
+
+        Returns
+        -------
+            Number of reports delivered
+        """
+        scheduler = None
+        if rate:
+            scheduler = Scheduler(1.0 / rate, sleep=stop.wait if stop is not None else time.sleep)
+        delivered = 0
+        while stop is None or not stop.is_set():
+            message = self.peek()
+            if message is None:
+                break
+            if scheduler is not None:
+                scheduler.wait()
+            try:
+                future = publish(*message)
+                if future is not None:
+                    future.result(timeout)
+            except Exception as ex:
+                print("Failed to publish buffered report, {} report(s) left".format(len(self)))
+                print(ex)
+                break
+            self.ack()
+            delivered += 1
+        return delivered
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            if self._reader is not None:
+                self._reader.close()
+            self._index.flush()
+            self._index.close()
+
+
+class BufferedPublisher(object):
+    """
+    Publishes reports directly while connected, and through an :class:`OfflineBuffer` otherwise.
+
+    Reports published while the connection is down, or whose publish fails, are appended to the buffer. When the
+    connection resumes, a background thread drains the buffer at ``drain_rate`` reports per second. Reports are
+    also buffered while the buffer is not empty, so they are delivered in the order they were produced.
+    """
+
+    DRAIN_RATE = 1.0
+
+    def __init__(self, publish, buffer, drain_rate=DRAIN_RATE):
+        """
+        Parameters
+        ----------
+        publish: callable
+            Publishes a payload to a topic, returning a ``concurrent.futures.Future``, such as
+            ``IoTClientWrapper.publish``.
+        buffer: OfflineBuffer
+            Where reports are kept until they can be delivered.
+        drain_rate: float
+            Maximum number of buffered reports published per second once the connection resumes.
+        """
+        self._publish = publish
+        self.buffer = buffer
+        self.drain_rate = drain_rate
+        self.connected = True
+        self._stop = threading.Event()
+        self._drainer = None
+        self._drain_lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        if self.connected and not len(self.buffer):
+            try:
+                future = self._publish(topic, payload)
+            except Exception as ex:
+                print("Publish failed, buffering report")
+                print(ex)
+            else:
+                if future is not None:
+                    future.add_done_callback(lambda f: self._published(f, topic, payload))
+                return future
+        self.buffer.append(topic, payload)
+        if self.connected:
+            # reports left over by a failed publish or drain
+            self._start_drain()
+        return None
+
+    def _published(self, future, topic, payload):
+        if future.exception() is not None:
+            print("Publish failed, buffering report")
+            print(future.exception())
+            self.buffer.append(topic, payload)
+
+    @property
+    def draining(self):
+        return self._drainer is not None and self._drainer.is_alive()
+
+    def interrupted(self):
+        """Buffer reports until :meth:`resumed` is called."""
+        self.connected = False
+
+    def resumed(self):
+        """Publish reports directly again, after delivering the buffered ones in the background."""
+        self.connected = True
+        self._start_drain()
+
+    def _start_drain(self):
+        # called from both the publishing thread and the MQTT callback thread
+        with self._drain_lock:
+            if len(self.buffer) and not self.draining:
+                self._drainer = threading.Thread(target=self._drain, name="offline-buffer-drain")
+                self._drainer.daemon = True
+                self._drainer.start()
+
+    def _drain(self):
+        delivered = self.buffer.drain(self._publish, rate=self.drain_rate, stop=self._stop)
+        print("Delivered {} buffered report(s), {} left".format(delivered, len(self.buffer)))
+
+    def close(self):
+        self._stop.set()
+        if self._drainer is not None:
+            self._drainer.join()
+        self.buffer.close()
@@ -0,0 +1,238 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import queue
+import threading
+import time
+
+from AWSIoTDeviceDefenderAgentSDK.scheduler import Scheduler
+
+# Marks the end of the stream of reports between stages
+_STOP = object()
+
+
+class PipelineStats(object):
+    """Counters of a :class:`PublishPipeline`, updated by its stages."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.collected = 0
+        self.missed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.published = 0
+        self.completed = 0
+        self.failed = 0
+        self.errors = 0
+
+    def increment(self, counter, count=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + count)
+
+    @property
+    def in_flight(self):
+        return self.published - self.completed - self.failed
+
+    def __repr__(self):
+        return ("PipelineStats(collected={}, missed={}, dropped={}, skipped={}, published={}, completed={}, "
+                "failed={}, errors={})".format(self.collected, self.missed, self.dropped, self.skipped,
+                                               self.published, self.completed, self.failed, self.errors))
+
+
+class PublishPipeline(object):
+    """
+    Collects, serializes and publishes metrics reports in three concurrent stages.
+
+    The sampling thread calls ``collect`` on the deadlines of a :class:`~scheduler.Scheduler`, so the cadence
+    does not drift by the time spent collecting, and deadlines missed by slow collections are counted. Reports are
+    handed to a serializer thread over a bounded queue, and serialized payloads to a publisher thread over another.
+    When a queue is full its oldest report is dropped, so a slow broker never delays sampling and the freshest
+    reports are the ones that get published.
+
+    The publisher does not wait for each publish to complete, publish futures are tracked with callbacks and up
+    to ``max_in_flight`` publishes may be outstanding at once.
+    """
+
+    QUEUE_SIZE = 4
+    MAX_IN_FLIGHT = 8
+
+    def __init__(self, collect, serialize, publish, interval, queue_size=QUEUE_SIZE, max_in_flight=MAX_IN_FLIGHT,
+                 clock=time.monotonic, sleep=None):
+        """
+        Parameters
+        ----------
+        collect: callable
+            Returns a new report, typically ``Collector.collect_metrics``.
+        serialize: callable
+            Converts a report to a ``(topic, payload)`` pair, or None to skip publishing it. Any further items
+            of the returned tuple are passed on to ``publish``, such as the report id. A list of messages can be
+            returned for reports covering several things.
+        publish: callable
+            Publishes a payload to a topic, returning a ``concurrent.futures.Future`` or None if it completed
+            synchronously, such as ``IoTClientWrapper.publish``.
+        interval: float
+            Seconds between the start of two collections.
+        queue_size: int
+            Number of reports buffered between two stages.
+        max_in_flight: int
+            Number of publishes that may be awaiting completion.
+        clock: callable
+            Monotonic clock the collection deadlines are measured with.
+        sleep: callable
+            Waits for a number of seconds between collections, by default until the deadline or :meth:`stop`.
+        """
+        self._collect = collect
+        self._serialize = serialize
+        self._publish = publish
+        self.interval = float(interval)
+        self._reports = queue.Queue(queue_size)
+        self._payloads = queue.Queue(queue_size)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._stop = threading.Event()
+        self._clock = clock
+        self._sleep = sleep if sleep is not None else self._stop.wait
+        self._threads = []
+        self.stats = PipelineStats()
+
+    def start(self, samples=None):
+        """
+        Start the pipeline threads and return immediately.
+
+        Parameters
+        ----------
+        samples: int
+            Stop sampling after this many reports, sample until :meth:`stop` is called if omitted.
+        """
+        self._threads = [threading.Thread(target=self._sample, args=(samples,), name="metrics-sampler"),
+                         threading.Thread(target=self._serializer, name="metrics-serializer"),
+                         threading.Thread(target=self._publisher, name="metrics-publisher")]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop sampling, then wait until reports already collected have been published."""
+        self._stop.set()
+        self.join()
+
+    def join(self, timeout=None):
+        """Wait for the pipeline to finish, returns False if it is still running after ``timeout`` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if thread.is_alive():
+                return False
+        return True
+
+    def run(self, samples=None):
+        """Run the pipeline and block until ``samples`` reports are published, or until interrupted."""
+        self.start(samples)
+        try:
+            while not self.join(timeout=1.0):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _sample(self, samples):
+        scheduler = Scheduler(self.interval, clock=self._clock, sleep=self._sleep)
+        scheduler.begin()
+        collected = 0
+        try:
+            while not self._stop.is_set():
+                try:
+                    report = self._collect()
+                except Exception as ex:
+                    self.stats.increment('errors')
+                    print("Failed to collect metrics")
+                    print(ex)
+                else:
+                    self.stats.increment('collected')
+                    self._offer(self._reports, report)
+
+                collected += 1
+                if samples is not None and collected >= samples:
+                    break
+                missed = scheduler.wait()
+                if missed:
+                    self.stats.increment('missed', missed)
+                    print("Collection overran the sampling interval, skipped {} sample(s)".format(missed))
+        finally:
+            self._reports.put(_STOP)
+
+    def _offer(self, stage_queue, item):
+        """Queue an item for the next stage, dropping the oldest queued item if the stage is behind."""
+        while True:
+            try:
+                stage_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    stage_queue.get_nowait()
+                    self.stats.increment('dropped')
+                except queue.Empty:
+                    pass
+
+    def _serializer(self):
+        try:
+            while True:
+                report = self._reports.get()
+                if report is _STOP:
+                    break
+                try:
+                    message = self._serialize(report)
+                except Exception as ex:
+                    self.stats.increment('errors')
+                    print("Failed to serialize metrics")
+                    print(ex)
+                    continue
+                if message is None:
+                    self.stats.increment('skipped')
+                elif isinstance(message, list):
+                    for item in message:
+                        self._offer(self._payloads, item)
+                else:
+                    self._offer(self._payloads, message)
+        finally:
+            self._payloads.put(_STOP)
+
+    def _publisher(self):
+        while True:
+            message = self._payloads.get()
+            if message is _STOP:
+                break
+            self._in_flight.acquire()
+            self.stats.increment('published')
+            try:
+                future = self._publish(*message)
+            except Exception as ex:
+                self._published(None, ex)
+                continue
+            if future is None:
+                self._published(None)
+            else:
+                future.add_done_callback(self._published)
+
+        # wait for outstanding publishes
+        while self.stats.in_flight > 0:
+            time.sleep(0.01)
+
+    def _published(self, future, error=None):
+        if error is None and future is not None:
+            error = future.exception()
+        if error is None:
+            self.stats.increment('completed')
+        else:
+            self.stats.increment('failed')
+            print("Failed to publish metrics")
+            print(error)
+        self._in_flight.release()
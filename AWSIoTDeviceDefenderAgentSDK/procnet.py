@@ -0,0 +1,275 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import os
+import socket
+import struct
+from collections import namedtuple
+
+addr = namedtuple('addr', 'ip port')
+sconn = namedtuple('sconn', 'family type laddr raddr status')
+snetio = namedtuple('snetio', 'bytes_sent bytes_recv packets_sent packets_recv')
+snicaddr = namedtuple('snicaddr', 'family address netmask broadcast ptp')
+
+# Socket states as printed in the "st" column of /proc/net/tcp*, named like psutil's CONN_* constants
+TCP_STATUSES = {
+    b'01': "ESTABLISHED",
+    b'02': "SYN_SENT",
+    b'03': "SYN_RECV",
+    b'04': "FIN_WAIT1",
+    b'05': "FIN_WAIT2",
+    b'06': "TIME_WAIT",
+    b'07': "CLOSE",
+    b'08': "CLOSE_WAIT",
+    b'09': "LAST_ACK",
+    b'0A': "LISTEN",
+    b'0B': "CLOSING",
+}
+UDP_STATUS = "NONE"
+
+PROC_NET_FILES = (
+    ('tcp', socket.AF_INET, socket.SOCK_STREAM),
+    ('tcp6', socket.AF_INET6, socket.SOCK_STREAM),
+    ('udp', socket.AF_INET, socket.SOCK_DGRAM),
+    ('udp6', socket.AF_INET6, socket.SOCK_DGRAM),
+)
+
+
+def available(procfs_path='/proc'):
+    """Returns True if the socket tables can be read from ``procfs_path``."""
+    return os.access(os.path.join(procfs_path, 'net', 'tcp'), os.R_OK)
+
+
+def net_io_counters(procfs_path='/proc', pernic=False):
+    """
+    Read the traffic counters of the network interfaces from ``/proc/net/dev``.
+
+    Unlike ``psutil.net_io_counters``, the proc filesystem is passed explicitly, so the counters of another
+    network namespace can be read through ``/proc/<pid>``.
+
+    Parameters
+    ----------
+    procfs_path : string
+            Mount point of the proc filesystem, or the ``/proc/<pid>`` directory of a process.
+    pernic : bool
+            Return a dictionary of counters per interface name instead of their sum.
+    """
+    counters = {}
+    with open(os.path.join(procfs_path, 'net', 'dev'), 'rb') as f:
+        # two header lines, then "iface: rx bytes packets errs drop fifo frame compressed multicast tx bytes ..."
+        for line in f.readlines()[2:]:
+            name, _, fields = line.partition(b':')
+            fields = fields.split()
+            if len(fields) < 10:
+                continue
+            counters[name.strip().decode('ascii')] = snetio(int(fields[8]), int(fields[0]),
+                                                            int(fields[9]), int(fields[1]))
+    if pernic:
+        return counters
+    return snetio(*(sum(column) for column in zip(*counters.values()))) if counters else snetio(0, 0, 0, 0)
+
+
+def _read_lines(path):
+    """Lines of a file, or no lines if it is missing, as ``/proc/net/if_inet6`` is without IPv6."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('ascii', 'replace').splitlines()
+    except (IOError, OSError):
+        return []
+
+
+def _ipv4_local_addresses(procfs_path):
+    """Addresses assigned to interfaces, the ``/32 host LOCAL`` entries of ``/proc/net/fib_trie``."""
+    addresses = []
+    address = None
+    # "|-- 10.0.0.1" names an entry, the following "/32 host LOCAL" lines describe it
+    for line in _read_lines(os.path.join(procfs_path, 'net', 'fib_trie')):
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == '|--':
+            address = fields[1]
+        elif fields[:3] == ['/32', 'host', 'LOCAL'] and address is not None and address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def _ipv4_routes(procfs_path):
+    """Directly connected routes of ``/proc/net/route``, as ``(network, mask, interface)``, longest mask first."""
+    routes = []
+    for line in _read_lines(os.path.join(procfs_path, 'net', 'route'))[1:]:
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+        # destination and mask are printed in host byte order, the default route matches any address
+        network, mask = (struct.unpack('!I', struct.pack('=I', int(field, 16)))[0] for field in (fields[1], fields[7]))
+        if mask:
+            routes.append((network, mask, fields[0]))
+    routes.sort(key=lambda route: -route[1])
+    return routes
+
+
+def net_if_addrs(procfs_path='/proc'):
+    """
+    Read the IP addresses assigned to the network interfaces of the namespace of a proc filesystem.
+
+    Unlike ``psutil.net_if_addrs``, which only sees the agent's own network namespace, the proc filesystem is
+    passed explicitly. IPv6 addresses and their interfaces are read from ``/proc/net/if_inet6``. The kernel does
+    not list the interface of IPv4 addresses, so the local addresses of ``/proc/net/fib_trie`` are assigned to
+    the interface of the most specific route of ``/proc/net/route`` containing them. Loopback addresses are
+    assigned to the interface with index 1, the namespace's loopback, if it has IPv6 addresses. Addresses whose
+    interface cannot be told are left out, so they are not reported with the name of another interface.
+
+    Parameters
+    ----------
+    procfs_path : string
+            Mount point of the proc filesystem, or the ``/proc/<pid>`` directory of a process.
+
+    Returns
+    -------
+        A dictionary of interface names to ``snicaddr`` lists, shaped like the result of ``psutil.net_if_addrs``.
+    """
+    if_addrs = {}
+    loopback = None
+    # address, interface index, prefix length, scope, flags and interface name
+    for line in _read_lines(os.path.join(procfs_path, 'net', 'if_inet6')):
+        fields = line.split()
+        if len(fields) < 6 or len(fields[0]) != 32:
+            continue
+        prefix = int(fields[2], 16)
+        netmask = ((1 << 128) - 1) ^ ((1 << (128 - prefix)) - 1)
+        if_addrs.setdefault(fields[5], []).append(snicaddr(
+            socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, bytes(bytearray.fromhex(fields[0]))),
+            socket.inet_ntop(socket.AF_INET6, bytes(bytearray.fromhex('%032x' % netmask))), None, None))
+        if int(fields[1], 16) == 1:
+            loopback = fields[5]
+
+    routes = _ipv4_routes(procfs_path)
+    for address in _ipv4_local_addresses(procfs_path):
+        ip = struct.unpack('!I', socket.inet_aton(address))[0]
+        for network, mask, iface in routes:
+            if ip & mask == network:
+                break
+        else:
+            if loopback is None or ip >> 24 != 127:
+                continue
+            network, mask, iface = 127 << 24, 0xff000000, loopback
+        netmask = socket.inet_ntoa(struct.pack('!I', mask))
+        if_addrs.setdefault(iface, []).append(snicaddr(socket.AF_INET, address, netmask, None, None))
+    return if_addrs
+
+
+class ProcNetReader(object):
+    """
+    Enumerates inet sockets by parsing ``/proc/net/{tcp,tcp6,udp,udp6}`` directly.
+
+    Unlike ``psutil.net_connections``, no attempt is made to map sockets to the processes owning them,
+    which requires walking every ``/proc/<pid>/fd`` directory. Only the fields used by
+    :class:`~AWSIoTDeviceDefenderAgentSDK.collector.Collector` are produced.
+
+    Files are streamed through a single read buffer owned by the reader, and decoded addresses are
+    cached between cycles, since the same local addresses and remote peers appear on many sockets.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+    ADDRESS_CACHE_SIZE = 4096
+
+    def __init__(self, procfs_path='/proc'):
+        """
+        Parameters
+        ----------
+        procfs_path : string
+                Mount point of the proc filesystem to read from.
+        """
+        self.procfs_path = procfs_path
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._addresses = {}
+
+    def net_connections(self, procfs_path=None, files=PROC_NET_FILES):
+        """
+        Yield a record for every TCP and UDP socket, IPv4 and IPv6.
+
+        Records have ``family``, ``type``, ``laddr``, ``raddr`` and ``status`` fields with the same meaning
+        as the ones returned by ``psutil.net_connections``. An unconnected remote address is an empty tuple.
+
+        Only the tables listed in ``files``, a subset of ``PROC_NET_FILES``, are read.
+        """
+        procfs_path = procfs_path or self.procfs_path
+        if len(self._addresses) > self.ADDRESS_CACHE_SIZE:
+            self._addresses.clear()
+
+        for name, family, type_ in files:
+            path = os.path.join(procfs_path, 'net', name)
+            if not os.path.exists(path):
+                # IPv6 disabled
+                continue
+            for conn in self._parse(path, family, type_):
+                yield conn
+
+    def _parse(self, path, family, type_):
+        addresses = self._addresses
+        decode = self._decode_address
+        header = True
+        for line in self._lines(path):
+            if header:
+                header = False
+                continue
+            fields = line.split(None, 4)
+            if len(fields) < 4:
+                continue
+            _, laddr, raddr, status = fields[:4]
+
+            local = addresses.get(laddr)
+            if local is None:
+                local = addresses[laddr] = decode(laddr, family)
+            remote = addresses.get(raddr)
+            if remote is None:
+                remote = addresses[raddr] = decode(raddr, family)
+
+            if type_ == socket.SOCK_STREAM:
+                status = TCP_STATUSES.get(status, status.decode('ascii'))
+            else:
+                status = UDP_STATUS
+            yield sconn(family, type_, local, remote, status)
+
+    def _lines(self, path):
+        """Stream the lines of ``path`` through the reader's buffer."""
+        view = memoryview(self._buffer)
+        pending = b''
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                size = f.readinto(view)
+                if not size:
+                    break
+                lines = (pending + view[:size]).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line
+        if pending:
+            yield pending
+
+    @staticmethod
+    def _decode_address(address, family):
+        """
+        Convert an "ip:port" pair as printed in /proc/net/* to an ``addr`` tuple.
+
+        The address is printed as one (IPv4) or four (IPv6) 32-bit words in host byte order.
+        Addresses with port 0 are unconnected and decode to an empty tuple.
+        """
+        ip, port = address.split(b':')
+        port = int(port, 16)
+        if not port:
+            return ()
+        if family == socket.AF_INET:
+            packed = struct.pack('=I', int(ip, 16))
+        else:
+            packed = struct.pack('=4I', *(int(ip[i:i + 8], 16) for i in range(0, 32, 8)))
+        return addr(socket.inet_ntop(family, packed), port)
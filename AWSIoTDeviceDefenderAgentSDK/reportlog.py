@@ -0,0 +1,284 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import cbor
+
+# Record header: payload length, thing name length, report id, crc32 of thing name and payload
+RECORD_HEADER = struct.Struct('<IHqI')
+# Index entry: report id, offset of the record in the log
+INDEX_ENTRY = struct.Struct('<qQ')
+INDEX_SUFFIX = '.idx'
+
+
+def _checksum(thing_name, payload):
+    return zlib.crc32(payload, zlib.crc32(thing_name)) & 0xffffffff
+
+
+def _scan(f, offset=0):
+    """Yield the report id, offset and end of each valid record of a log, from ``offset``."""
+    f.seek(offset)
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        payload_length, name_length, report_id, checksum = RECORD_HEADER.unpack(header)
+        thing_name = f.read(name_length)
+        payload = f.read(payload_length)
+        if len(thing_name) < name_length or len(payload) < payload_length or \
+                _checksum(thing_name, payload) != checksum:
+            return
+        end = offset + RECORD_HEADER.size + name_length + payload_length
+        yield report_id, offset, end
+        offset = end
+
+
+def _read_index(path, log_size):
+    """Index entries of a log, up to the first one that does not point inside the log in increasing order."""
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'rb') as f:
+        data = f.read()
+    previous = -1
+    for report_id, offset in struct.iter_unpack(INDEX_ENTRY.format, data[:len(data) - len(data) % INDEX_ENTRY.size]):
+        if offset <= previous or offset >= log_size:
+            break
+        entries.append((report_id, offset))
+        previous = offset
+    return entries
+
+
+class ReportLog(object):
+    """
+    Append-only history of serialized reports, with an index of their report ids.
+
+    Each record holds a CBOR report, the thing it was collected for and a checksum, prefixed by their lengths.
+    For every record, the report id and the offset of the record are appended to an index file next to the log,
+    ``<path>.idx``, which lets :class:`ReportLogReader` seek to a range of report ids, that is of collection times,
+    without scanning the log.
+
+    When the log is opened, a record left incomplete by a crash is truncated, and the index is completed with
+    the records it misses.
+    """
+
+    def __init__(self, path, sync=False):
+        """
+        Parameters
+        ----------
+        path: string
+            Log file, created if missing.
+        sync: bool
+            fsync every appended report, so it survives power loss and not only a crash of the agent.
+        """
+        self.path = path
+        self.sync = sync
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'ab'):
+            pass
+
+        entries = self._recover()
+        self._count = len(entries)
+        self._writer = open(path, 'ab')
+        self._index = open(path + INDEX_SUFFIX, 'ab')
+
+    def _recover(self):
+        """Valid index entries, after truncating the log and index past the last complete record."""
+        index_path = self.path + INDEX_SUFFIX
+        indexed = _read_index(index_path, os.path.getsize(self.path))
+        entries = list(indexed)
+        with open(self.path, 'r+b') as f:
+            # the last indexed record may itself be incomplete
+            while entries and next(_scan(f, entries[-1][1]), None) is None:
+                entries.pop()
+            end = entries.pop()[1] if entries else 0
+            for report_id, offset, end in _scan(f, end):
+                entries.append((report_id, offset))
+            if end != os.path.getsize(self.path):
+                print("Truncating incomplete report at offset {} of report log {}".format(end, self.path))
+                f.truncate(end)
+
+        if entries != indexed or not os.path.exists(index_path) or \
+                os.path.getsize(index_path) != len(entries) * INDEX_ENTRY.size:
+            with open(index_path, 'wb') as index:
+                index.write(b''.join(INDEX_ENTRY.pack(report_id, offset) for report_id, offset in entries))
+        return entries
+
+    def __len__(self):
+        """Number of reports in the log."""
+        return self._count
+
+    def append(self, report_id, payload, thing_name=''):
+        """
+        Add a report at the end of the log.
+
+        Parameters
+        ----------
+        report_id: int
+            Id of the report, its collection time in seconds since the epoch.
+        payload: bytes
+            Serialized report, CBOR for :meth:`LogRecord.report` to decode it.
+        thing_name: string
+            Thing the report was collected for.
+        """
+        thing_name = thing_name.encode('utf-8')
+        payload = bytes(payload)
+        record = RECORD_HEADER.pack(len(payload), len(thing_name), report_id,
+                                    _checksum(thing_name, payload)) + thing_name + payload
+        with self._lock:
+            offset = self._writer.tell()
+            self._writer.write(record)
+            self._writer.flush()
+            self._index.write(INDEX_ENTRY.pack(report_id, offset))
+            self._index.flush()
+            if self.sync:
+                os.fsync(self._writer.fileno())
+                os.fsync(self._index.fileno())
+            self._count += 1
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            self._index.close()
+
+
+class LogRecord(object):
+    """
+    A report of a :class:`ReportLogReader`, read from the memory-mapped log only when accessed.
+    """
+
+    __slots__ = ('report_id', 'offset', '_log')
+
+    def __init__(self, log, report_id, offset):
+        self._log = log
+        self.report_id = report_id
+        self.offset = offset
+
+    def _header(self):
+        return RECORD_HEADER.unpack_from(self._log, self.offset)
+
+    @property
+    def thing_name(self):
+        _, name_length, _, _ = self._header()
+        start = self.offset + RECORD_HEADER.size
+        return self._log[start:start + name_length].decode('utf-8')
+
+    @property
+    def payload(self):
+        """Serialized report, as bytes."""
+        payload_length, name_length, _, _ = self._header()
+        start = self.offset + RECORD_HEADER.size + name_length
+        return self._log[start:start + payload_length]
+
+    def report(self):
+        """Decoded report."""
+        return cbor.loads(self.payload)
+
+    def __repr__(self):
+        return "LogRecord(report_id={}, offset={})".format(self.report_id, self.offset)
+
+
+class ReportLogReader(object):
+    """
+    Memory-mapped reader of a :class:`ReportLog`.
+
+    Records are located through the index, and their reports are only read and decoded when asked for, so weeks
+    of history can be iterated over or searched by collection time without loading them. Records appended after
+    the reader was opened are not seen.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: string
+            Log file written by :class:`ReportLog`.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._log = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        entries = _read_index(path + INDEX_SUFFIX, size)
+        # records missing from the index, appended by a writer that crashed before indexing them
+        start = entries[-1][1] if entries else 0
+        scanned = [(report_id, offset) for report_id, offset, end in _scan(self._file, start) if end <= size]
+        if entries and scanned:
+            # the last indexed record, scanned again
+            del scanned[0]
+        elif entries:
+            # the last indexed record is incomplete
+            del entries[-1]
+        entries.extend(scanned)
+
+        self._ids = [report_id for report_id, _ in entries]
+        self._offsets = [offset for _, offset in entries]
+        # positions in report id order, when clock adjustments appended the ids out of order
+        self._order = None
+        if any(later < earlier for earlier, later in zip(self._ids, self._ids[1:])):
+            self._order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+            self._sorted_ids = [self._ids[position] for position in self._order]
+        else:
+            self._sorted_ids = self._ids
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, position):
+        """Record at a position in the log, in the order reports were appended."""
+        return LogRecord(self._log, self._ids[position], self._offsets[position])
+
+    def __iter__(self):
+        for position in range(len(self._offsets)):
+            yield self[position]
+
+    def range(self, start=None, end=None):
+        """
+        Records of reports collected from ``start`` included to ``end`` excluded, in report id order.
+
+        Parameters
+        ----------
+        start: int
+            Earliest report id, from the first report if None.
+        end: int
+            Report id to stop before, to the last report if None.
+        """
+        first = 0 if start is None else bisect.bisect_left(self._sorted_ids, start)
+        last = len(self._sorted_ids) if end is None else bisect.bisect_left(self._sorted_ids, end)
+        for position in range(first, last):
+            yield self[self._order[position] if self._order is not None else position]
+
+    def get(self, report_id):
+        """Records with a report id, one per thing it was collected for."""
+        return list(self.range(report_id, report_id + 1))
+
+    def close(self):
+        if self._log:
+            self._log.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,76 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import time
+
+
+class Scheduler(object):
+    """
+    Paces a loop on absolute deadlines, ``interval`` seconds apart from the first one.
+
+    Deadlines are measured with ``time.monotonic``, so they neither drift by the time spent working between
+    them nor jump when the wall clock is stepped by NTP. When work overruns one or more deadlines, they are
+    counted as missed and skipped, rather than run back to back to catch up.
+    """
+
+    def __init__(self, interval, clock=time.monotonic, sleep=time.sleep):
+        """
+        Parameters
+        ----------
+        interval: float
+            Seconds between two deadlines, must be positive.
+        clock: callable
+            Monotonic clock returning seconds.
+        sleep: callable
+            Waits for a number of seconds, such as ``threading.Event.wait`` to make waiting interruptible.
+        """
+        interval = float(interval)
+        if interval <= 0:
+            raise ValueError("Scheduler interval must be positive: " + str(interval))
+        self.interval = interval
+        self._clock = clock
+        self._sleep = sleep
+        self.start = None
+        self.tick = 0
+        self.missed = 0
+
+    def begin(self):
+        """Set the first deadline to now, returns it."""
+        self.start = self._clock()
+        self.tick = 0
+        return self.start
+
+    @property
+    def deadline(self):
+        """Monotonic time of the current deadline."""
+        return self.start + self.tick * self.interval
+
+    def wait(self):
+        """
+        Sleep until the next deadline that has not passed yet.
+
+        Returns
+        -------
+            The number of deadlines missed since the previous one, 0 if the loop kept up.
+        """
+        if self.start is None:
+            self.begin()
+            return 0
+
+        now = self._clock()
+        due = max(self.tick + 1, int((now - self.start) / self.interval) + 1)
+        missed = due - self.tick - 1
+        self.missed += missed
+        self.tick = due
+        self._sleep(self.deadline - now)
+        return missed
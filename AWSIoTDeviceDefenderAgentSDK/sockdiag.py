@@ -0,0 +1,156 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import errno
+import socket
+import struct
+
+from AWSIoTDeviceDefenderAgentSDK.procnet import addr, sconn, UDP_STATUS
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+# struct nlmsghdr
+NLMSG_HEADER = struct.Struct('=IHHII')
+# struct inet_diag_req_v2, followed by a zeroed struct inet_diag_sockid
+INET_DIAG_REQ = struct.Struct('=BBBBI48x')
+# struct inet_diag_msg, up to and including the addresses of struct inet_diag_sockid (network byte order)
+INET_DIAG_MSG = struct.Struct('>BBBBHH16s16s')
+NLMSG_ERROR_CODE = struct.Struct('=i')
+
+# Kernel socket states, from include/net/tcp_states.h
+TCP_ESTABLISHED = 1
+TCP_CLOSE = 7
+TCP_LISTEN = 10
+TCP_STATUSES = {
+    1: "ESTABLISHED",
+    2: "SYN_SENT",
+    3: "SYN_RECV",
+    4: "FIN_WAIT1",
+    5: "FIN_WAIT2",
+    6: "TIME_WAIT",
+    7: "CLOSE",
+    8: "CLOSE_WAIT",
+    9: "LAST_ACK",
+    10: "LISTEN",
+    11: "CLOSING",
+}
+
+# Only the states the collector reports are dumped by the kernel. Unconnected UDP sockets are in the
+# CLOSE state, and every UDP socket is reported as a listening port.
+TCP_STATES = (1 << TCP_ESTABLISHED) | (1 << TCP_LISTEN)
+UDP_STATES = (1 << TCP_ESTABLISHED) | (1 << TCP_CLOSE)
+
+DUMP_REQUESTS = (
+    (socket.AF_INET, socket.IPPROTO_TCP, TCP_STATES),
+    (socket.AF_INET6, socket.IPPROTO_TCP, TCP_STATES),
+    (socket.AF_INET, socket.IPPROTO_UDP, UDP_STATES),
+    (socket.AF_INET6, socket.IPPROTO_UDP, UDP_STATES),
+)
+
+
+def netlink_socket():
+    """Default socket factory, opens a NETLINK_SOCK_DIAG socket."""
+    return socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG)
+
+
+def available():
+    """Returns True if sock_diag netlink sockets are supported on this system."""
+    try:
+        netlink_socket().close()
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+class SockDiagReader(object):
+    """
+    Enumerates inet sockets with NETLINK_SOCK_DIAG, the interface used by ``ss``.
+
+    The kernel filters sockets by state before replying, so only established and listening TCP
+    sockets and UDP sockets are transferred and parsed, regardless of how many other sockets
+    (TIME_WAIT, SYN_RECV, ...) exist on the host. Records are the same as those produced by
+    :class:`~AWSIoTDeviceDefenderAgentSDK.procnet.ProcNetReader`.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, socket_factory=None):
+        """
+        Parameters
+        ----------
+        socket_factory : callable
+                Returns a new netlink socket, supporting ``sendto``, ``recv_into`` and ``close``.
+                Defaults to :func:`netlink_socket`.
+        """
+        self._socket_factory = socket_factory or netlink_socket
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._seq = 0
+
+    def net_connections(self):
+        """Yield a record for every established or listening TCP socket and every UDP socket."""
+        sock = self._socket_factory()
+        try:
+            for family, protocol, states in DUMP_REQUESTS:
+                for conn in self._dump(sock, family, protocol, states):
+                    yield conn
+        finally:
+            sock.close()
+
+    def _dump(self, sock, family, protocol, states):
+        self._seq += 1
+        request = INET_DIAG_REQ.pack(family, protocol, 0, 0, states)
+        sock.sendto(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), SOCK_DIAG_BY_FAMILY,
+                                      NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0) + request, (0, 0))
+
+        type_ = socket.SOCK_STREAM if protocol == socket.IPPROTO_TCP else socket.SOCK_DGRAM
+        view = memoryview(self._buffer)
+        while True:
+            size = sock.recv_into(view)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= size:
+                length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(view, offset)
+                if length < NLMSG_HEADER.size:
+                    raise OSError(errno.EPROTO, "Malformed netlink message")
+                payload = offset + NLMSG_HEADER.size
+                if msg_type == NLMSG_DONE:
+                    return
+                if msg_type == NLMSG_ERROR:
+                    code, = NLMSG_ERROR_CODE.unpack_from(view, payload)
+                    if code:
+                        raise OSError(-code, "sock_diag dump failed")
+                elif msg_type == SOCK_DIAG_BY_FAMILY:
+                    yield self._decode(view, payload, type_)
+                # messages are padded to a 4 byte boundary
+                offset += (length + 3) & ~3
+            if not size:
+                raise OSError(errno.EPROTO, "Netlink dump ended without NLMSG_DONE")
+
+    @staticmethod
+    def _decode(view, offset, type_):
+        family, state, _, _, sport, dport, src, dst = INET_DIAG_MSG.unpack_from(view, offset)
+        if family == socket.AF_INET:
+            src = src[:4]
+            dst = dst[:4]
+        laddr = addr(socket.inet_ntop(family, src), sport) if sport else ()
+        raddr = addr(socket.inet_ntop(family, dst), dport) if dport else ()
+        if type_ == socket.SOCK_STREAM:
+            status = TCP_STATUSES.get(state, str(state))
+        else:
+            status = UDP_STATUS
+        return sconn(family, type_, laddr, raddr, status)
@@ -41,99 +41,62 @@ class Tags(object):
     CUSTOM_METRICS = ("custom_metrics", "cmet")
     CPU_USAGE = "cpu_usage"
 
-    def __init__(self, short_names=False):
-        self.short_names = short_names
+    # Attribute name and tag of every field, resolved once per naming mode
+    NAMES = (
+        ('header', HEADER),
+        ('metrics', METRICS),
+        ('report_id', REPORT_ID),
+        ('version', VERSION),
+        ('tcp_conn', TCP_CONN),
+        ('connections', CONNECTIONS),
+        ('established_connections', ESTABLISHED_CONNECTIONS),
+        ('remote_addr', REMOTE_ADDR),
+        ('remote_port', REMOTE_PORT),
+        ('local_port', LOCAL_PORT),
+        ('local_interface', LOCAL_INTERFACE),
+        ('listening_tcp_ports', LISTENING_TCP_PORTS),
+        ('listening_udp_ports', LISTENING_UDP_PORTS),
+        ('ports', PORTS),
+        ('interface_stats', NETWORK_STATS),
+        ('bytes_in', BYTES_IN),
+        ('bytes_out', BYTES_OUT),
+        ('packets_in', PACKETS_IN),
+        ('packets_out', PACKETS_OUT),
+        ('total', TOTAL),
+        ('cpu_usage', CPU_USAGE),
+        ('custom_metrics', CUSTOM_METRICS),
+    )
+
+    __slots__ = ('short_names',) + tuple(name for name, _ in NAMES)
+
+    _instances = {}
+
+    def __new__(cls, short_names=False):
+        """
+        Returns the shared, immutable tag table for the requested naming mode.
+
+        Field names are plain attributes, resolved when the table is first created,
+        so looking up a tag in a hot loop does not go through a property call.
+        """
+        short_names = bool(short_names)
+        key = (cls, short_names)
+        instance = cls._instances.get(key)
+        if instance is None:
+            instance = object.__new__(cls)
+            object.__setattr__(instance, 'short_names', short_names)
+            for name, tag in cls.NAMES:
+                object.__setattr__(instance, name, tag if isinstance(tag, str) else tag[short_names])
+            cls._instances[key] = instance
+        return instance
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Tags are immutable, use Tags(short_names) to select a naming mode")
+
+    def __reduce__(self):
+        return self.__class__, (self.short_names,)
 
     def get(self, tag):
         if self.short_names:
             return tag[1]
         else:
             return tag[0]
-
-    @property
-    def header(self):
-        return self.get(self.HEADER)
-
-    @property
-    def metrics(self):
-        return self.get(self.METRICS)
-
-    @property
-    def report_id(self):
-        return self.get(self.REPORT_ID)
-
-    @property
-    def version(self):
-        return self.get(self.VERSION)
-
-    @property
-    def tcp_conn(self):
-        return self.get(self.TCP_CONN)
-
-    @property
-    def connections(self):
-        return self.get(self.CONNECTIONS)
-
-    @property
-    def established_connections(self):
-        return self.get(self.ESTABLISHED_CONNECTIONS)
-
-    @property
-    def remote_addr(self):
-        return self.get(self.REMOTE_ADDR)
-
-    @property
-    def remote_port(self):
-        return self.get(self.REMOTE_PORT)
-
-    @property
-    def local_port(self):
-        return self.get(self.LOCAL_PORT)
-
-    @property
-    def local_interface(self):
-        return self.get(self.LOCAL_INTERFACE)
-
-    @property
-    def listening_tcp_ports(self):
-        return self.get(self.LISTENING_TCP_PORTS)
-
-    @property
-    def listening_udp_ports(self):
-        return self.get(self.LISTENING_UDP_PORTS)
-
-    @property
-    def ports(self):
-        return self.get(self.PORTS)
-
-    @property
-    def interface_stats(self):
-        return self.get(self.NETWORK_STATS)
-
-    @property
-    def bytes_in(self):
-        return self.get(self.BYTES_IN)
-
-    @property
-    def bytes_out(self):
-        return self.get(self.BYTES_OUT)
-
-    @property
-    def packets_in(self):
-        return self.get(self.PACKETS_IN)
-
-    @property
-    def packets_out(self):
-        return self.get(self.PACKETS_OUT)
-
-    @property
-    def total(self):
-        return self.get(self.TOTAL)
-
-    @property
-    def cpu_usage(self):
-        return self.CPU_USAGE
-
-    @property
-    def custom_metrics(self):
-        return self.get(self.CUSTOM_METRICS)
\ No newline at end of file
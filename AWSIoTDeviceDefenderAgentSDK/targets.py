@@ -0,0 +1,100 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from AWSIoTDeviceDefenderAgentSDK import collector
+
+# A thing monitored by the agent, and the proc filesystem its metrics are collected from, None for the agent's own
+Target = namedtuple('Target', 'thing_name procfs_path')
+
+
+def parse_target(spec):
+    """
+    Parse a ``thing_name[=procfs_path]`` target specification, such as ``web-1=/proc/4242``.
+
+    Raises
+    ------
+    ValueError
+        If the thing name is empty.
+    """
+    thing_name, separator, procfs_path = spec.partition('=')
+    thing_name = thing_name.strip()
+    if not thing_name:
+        raise ValueError("Invalid target, missing thing name: " + spec)
+    return Target(thing_name, procfs_path.strip() if separator and procfs_path.strip() else None)
+
+
+class MultiCollector(object):
+    """
+    Collects metrics for several things in one process, each from its own proc filesystem.
+
+    Every target has its own :class:`~collector.Collector`, so deltas are computed per thing, and all of them
+    are sampled concurrently by a pool of worker threads. Reading the socket tables of a namespace is mostly
+    spent in system calls, which release the GIL. In parallel mode, the collectors share one process pool.
+    """
+
+    WORKERS = 4
+
+    def __init__(self, targets, workers=WORKERS, **collector_options):
+        """
+        Parameters
+        ----------
+        targets: list
+            :class:`Target` to collect for, thing names must be unique.
+        workers: int
+            Number of threads collecting concurrently.
+        collector_options:
+            Passed on to each :class:`~collector.Collector`.
+        """
+        thing_names = [target.thing_name for target in targets]
+        if len(set(thing_names)) != len(thing_names):
+            raise ValueError("Duplicate thing names in targets: " + ", ".join(thing_names))
+
+        self.targets = list(targets)
+        self._process_pool = None
+        if collector_options.get('parallel') and collector_options.get('process_pool') is None:
+            self._process_pool = ProcessPoolExecutor()
+            self._process_pool.submit(int).result()
+            collector_options = dict(collector_options, process_pool=self._process_pool)
+        self._collectors = [collector.Collector(procfs_path=target.procfs_path, **collector_options)
+                            for target in self.targets]
+        self._executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(self.targets))))
+
+    def _collect(self, index):
+        try:
+            return self._collectors[index].collect_metrics()
+        except Exception as ex:
+            print("Failed to collect metrics for " + self.targets[index].thing_name)
+            print(ex)
+            return None
+
+    def collect_metrics(self):
+        """
+        Sample every target concurrently.
+
+        Returns
+        -------
+            A list of ``(target, metrics)`` pairs, in target order. Targets whose collection failed are left out,
+            so one unreadable namespace does not hold back the reports of the others.
+        """
+        reports = self._executor.map(self._collect, range(len(self.targets)))
+        return [(target, report) for target, report in zip(self.targets, reports) if report is not None]
+
+    def close(self):
+        self._executor.shutdown()
+        for target_collector in self._collectors:
+            target_collector.close()
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
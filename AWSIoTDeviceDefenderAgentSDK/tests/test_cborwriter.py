@@ -0,0 +1,75 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import cbor
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK.cborwriter import CborWriter
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        0, 23, 24, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 63 - 1,
+        -1, -24, -25, -256, -257, -2 ** 32, -2 ** 63,
+        0.0, 25.65, -1.5, 1e300,
+        "", "a", "x" * 23, "x" * 24, "x" * 300, "x" * 70000, u"interface é",
+        b"", b"\x00\x01",
+        None, True, False,
+        [], [1, [2, [3]]], {}, {"a": 1, "b": [None, 2.5]},
+    ],
+)
+def test_matches_reference_encoder(value):
+    writer = CborWriter()
+    writer.value(value)
+
+    assert bytes(writer.buffer) == cbor.dumps(value)
+    assert cbor.loads(bytes(writer.buffer)) == value
+
+
+def test_streamed_containers():
+    writer = CborWriter()
+    writer.begin_map(2)
+    writer.key("ports")
+    writer.begin_array(2)
+    writer.value(80)
+    writer.value(443)
+    writer.end_array()
+    writer.key("total")
+    writer.integer(2)
+    writer.end_map()
+
+    assert cbor.loads(bytes(writer.buffer)) == {"ports": [80, 443], "total": 2}
+
+
+def test_reuses_buffer():
+    buffer = bytearray(b"stale content")
+    writer = CborWriter(buffer)
+    writer.value(1)
+
+    assert writer.buffer is buffer
+    assert buffer == bytearray(b"\x01")
+
+
+def test_unsupported_type():
+    with pytest.raises(TypeError):
+        CborWriter().value(object())
+
+
+@pytest.mark.parametrize("values", [("11.0.0.1:443", "eth0", 50000), ("[::1]:1", None, 7),
+                                    ("x" * 300, "vëth", 2 ** 33), ("a", -1, 1.5)])
+def test_record_size(values):
+    keys = ("remote_addr", "local_interface", "local_port")
+    writer = CborWriter()
+    writer.record(keys, values)
+
+    assert CborWriter().record_size(keys, values) == len(writer.buffer)
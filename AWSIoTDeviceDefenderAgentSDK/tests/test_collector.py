@@ -267,9 +267,84 @@ def test_collector_net_connections(
     assert metrics_output.network_connections[3]["remote_addr"] == "11.0.0.5:567"
     assert metrics_output.network_connections[3]["local_interface"] == "em1"
     assert metrics_output.network_connections[3]["local_port"] == 44444
-    assert metrics_output.network_connections[4]["remote_addr"] == "11.0.0.6:678"
-    assert metrics_output.network_connections[4]["local_interface"] == "em1"
-    assert metrics_output.network_connections[4]["local_port"] == 66666
-    assert metrics_output.network_connections[5]["remote_addr"] == "11.0.0.7:789"
-    assert metrics_output.network_connections[5]["local_interface"] is None
-    assert metrics_output.network_connections[5]["local_port"] == 77777
+
+    # UDP sockets are never reported as established connections
+    assert len(metrics_output.network_connections) == 4
+
+
+@mock.patch(PATCH_MODULE_LOCATION_PS + "net_if_addrs")
+@mock.patch(PATCH_MODULE_LOCATION_PS + "net_io_counters")
+@mock.patch(PATCH_MODULE_LOCATION_PS + "net_connections")
+def test_collector_single_socket_snapshot(
+    mock_net_connections,
+    mock_io_counters,
+    mock_if_addrs,
+    net_connections,
+    if_addrs,
+    net_io_counters,
+):
+    mock_net_connections.return_value = net_connections
+    mock_io_counters.return_value = net_io_counters
+    mock_if_addrs.return_value = if_addrs
+
+    new_collector = collector.Collector(short_metrics_names=False)
+    metric = new_collector.collect_metrics()
+
+    mock_net_connections.assert_called_once_with(kind="inet")
+    assert metric.collection_start <= metric.collection_end
+
+
+def test_socket_snapshot_is_immutable(net_connections, if_addrs):
+    snapshot = collector.SocketSnapshot(net_connections, collector.InterfaceIndex(if_addrs))
+
+    assert len(snapshot) == len(net_connections)
+    assert isinstance(snapshot.connections, tuple)
+    with pytest.raises(AttributeError):
+        snapshot.extra = []
+
+
+@mock.patch(PATCH_MODULE_LOCATION_PS + "net_if_addrs")
+@mock.patch(PATCH_MODULE_LOCATION_PS + "net_io_counters")
+@mock.patch(PATCH_MODULE_LOCATION_PS + "net_connections")
+def test_collector_reads_interfaces_once_per_cycle(
+    mock_net_connections,
+    mock_io_counters,
+    mock_if_addrs,
+    net_connections,
+    if_addrs,
+    net_io_counters,
+):
+    mock_net_connections.return_value = net_connections
+    mock_io_counters.return_value = net_io_counters
+    mock_if_addrs.return_value = if_addrs
+
+    new_collector = collector.Collector(short_metrics_names=False)
+    new_collector.collect_metrics()
+
+    mock_if_addrs.assert_called_once_with()
+
+
+def test_interface_index_lookups():
+    index = collector.InterfaceIndex(
+        {
+            "lo": [
+                if_addr_tuple(socket.AF_INET, "127.0.0.1", None, None, None),
+                if_addr_tuple(socket.AF_INET6, "::1", None, None, None),
+            ],
+            "eth0": [
+                if_addr_tuple(psutil.AF_LINK, "02:42:ac:11:00:02", None, None, None),
+                if_addr_tuple(socket.AF_INET, "10.0.0.1", None, None, None),
+                if_addr_tuple(socket.AF_INET6, "fe80::42:acff:fe11:2%eth0", None, None, None),
+            ],
+            "eth0:1": [if_addr_tuple(socket.AF_INET, "10.0.0.1", None, None, None)],
+        }
+    )
+
+    assert index.interface_name("10.0.0.1") == "eth0"
+    assert index.interface_name("::1") == "lo"
+    assert index.interface_name("fe80::42:acff:fe11:2") == "eth0"
+    assert index.interface_name("::ffff:127.0.0.1") == "lo"
+    assert index.interface_name("0.0.0.0") == "0.0.0.0"
+    assert index.interface_name("::") == "::"
+    assert index.interface_name("192.168.1.1") is None
+    assert index.interface_name("02:42:ac:11:00:02") is None
@@ -0,0 +1,108 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import json
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import export, metrics
+from AWSIoTDeviceDefenderAgentSDK.export import ExportEncoder, decode
+
+
+def report(short_names=False, subnet=0):
+    m = metrics.Metrics(short_names=short_names)
+    for i in range(30):
+        m.add_network_connection("52.1.%d.%d" % (subnet, i % 10), 443, "eth0", 40000 + i)
+    m.add_listening_ports("TCP", [{"port": 22, "interface": "eth0"}])
+    m.add_listening_ports("UDP", [{"port": 68}])
+    m.add_network_stats(1000, 2000, 10, 20)
+    m.add_cpu_usage(12.5)
+    return m
+
+
+def trees(reports):
+    return [json.loads(r.to_json_string()) for r in reports]
+
+
+@pytest.mark.parametrize("payload_format", metrics.FORMATS)
+@pytest.mark.parametrize("compression", [export.COMPRESSION_NONE, export.COMPRESSION_ZLIB])
+@pytest.mark.parametrize("dictionary", [None, b""])
+@pytest.mark.parametrize("intern", [False, True])
+def test_round_trip(payload_format, compression, dictionary, intern):
+    reports = [report(), report(short_names=True), report(subnet=1), metrics.Metrics()]
+    encoder = ExportEncoder(payload_format, compression, dictionary, intern=intern)
+
+    assert decode(encoder.encode_batch(reports), dictionary) == trees(reports)
+    assert decode(encoder.encode(reports[0]), dictionary) == trees(reports[:1])
+
+
+def test_dictionary_and_interning_shrink_payloads():
+    reports = [report(subnet=i % 2) for i in range(8)]
+    plain = len(ExportEncoder(compression=export.COMPRESSION_NONE, intern=False).encode_batch(reports))
+    interned = len(ExportEncoder(compression=export.COMPRESSION_NONE, intern=True).encode_batch(reports))
+    assert interned < plain
+
+    single = reports[0]
+    without_dictionary = len(ExportEncoder(dictionary=b"").encode(single))
+    with_dictionary = len(ExportEncoder().encode(single))
+    assert with_dictionary < without_dictionary < len(single.to_json_string())
+
+
+def test_interning_does_not_modify_reports():
+    m = report()
+    before = m.to_json_string()
+    interned, addresses = export.intern_addresses([m._v1_metrics()])
+    assert m.to_json_string() == before
+    assert len(addresses) == 10
+    assert interned[0]["metrics"]["tcp_connections"]["established_connections"]["connections"][9]["remote_addr"] == 9
+
+
+def test_custom_dictionary():
+    dictionary = export.build_dictionary([ExportEncoder(compression=export.COMPRESSION_NONE).encode(report())] * 2)
+    payload = ExportEncoder(dictionary=dictionary).encode(report())
+
+    assert decode(payload, dictionary) == trees([report()])
+    with pytest.raises(ValueError):
+        decode(payload)
+
+
+def test_default_dictionary_is_stable():
+    assert export.default_dictionary() == export.build_dictionary([export.default_dictionary()])
+    export._default_dictionaries.clear()
+    first = export.default_dictionary(metrics.FORMAT_CBOR)
+    export._default_dictionaries.clear()
+    assert export.default_dictionary(metrics.FORMAT_CBOR) == first
+    assert len(first) <= export.DICTIONARY_SIZE
+
+
+def test_invalid_options_and_payloads():
+    with pytest.raises(ValueError):
+        ExportEncoder(compression="lzma")
+    with pytest.raises(ValueError):
+        ExportEncoder(payload_format="xml")
+    with pytest.raises(ValueError):
+        decode(b"{}")
+    with pytest.raises(ValueError):
+        decode(report().to_cbor())
+
+
+def test_zstd():
+    pytest.importorskip("zstandard")
+    reports = [report(), report(subnet=1)]
+    encoder = ExportEncoder(metrics.FORMAT_CBOR, export.COMPRESSION_ZSTD)
+    assert decode(encoder.encode_batch(reports)) == trees(reports)
+
+
+def test_zstd_unavailable(monkeypatch):
+    monkeypatch.setattr(export, "zstandard", None)
+    with pytest.raises(ValueError):
+        ExportEncoder(compression=export.COMPRESSION_ZSTD)
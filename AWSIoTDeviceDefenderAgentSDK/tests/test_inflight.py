@@ -0,0 +1,189 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import argparse
+import json
+import threading
+import time
+
+import cbor
+
+from AWSIoTDeviceDefenderAgentSDK import agent
+from AWSIoTDeviceDefenderAgentSDK.fakemqtt import FakeMqttConnection, defender_responder
+from AWSIoTDeviceDefenderAgentSDK.inflight import InFlightTracker, parse_response
+
+TOPIC = "$aws/things/thing/defender/metrics/json"
+CBOR_TOPIC = "$aws/things/thing/defender/metrics/cbor"
+
+
+def report(report_id):
+    return json.dumps({"header": {"report_id": report_id, "version": "1.0"}, "metrics": {}})
+
+
+def response(report_id, status="ACCEPTED"):
+    return json.dumps({"thingName": "thing", "reportId": report_id, "status": status}).encode('utf-8')
+
+
+class RecordingPublish(object):
+    def __init__(self, result=True):
+        self.result = result
+        self.published = []
+
+    def __call__(self, topic, payload):
+        self.published.append((topic, payload))
+        return self.result
+
+
+def publish_to(connection):
+    def publish(topic, payload):
+        future, _ = connection.publish(topic, payload, 1)
+        return future
+    return publish
+
+
+def test_parse_response():
+    assert parse_response(TOPIC + "/accepted", response(5)) == (5, True, None)
+    rejected = json.dumps({"reportId": 6, "status": "REJECTED",
+                           "statusDetails": {"ErrorCode": "InvalidJson"}})
+    assert parse_response(TOPIC + "/rejected", rejected) == (6, False, {"ErrorCode": "InvalidJson"})
+    assert parse_response(CBOR_TOPIC + "/accepted", cbor.dumps({"reportId": 7})) == (7, True, None)
+    assert parse_response(TOPIC, response(5)) is None
+
+
+def test_defender_responder_short_names():
+    payload = cbor.dumps({"hed": {"rid": 42, "v": "1.0"}, "met": {}})
+    topic, answer = defender_responder(CBOR_TOPIC, payload)
+    assert topic == CBOR_TOPIC + "/accepted"
+    assert cbor.loads(answer)["reportId"] == 42
+
+
+def test_tracks_acknowledgements_end_to_end():
+    connection = FakeMqttConnection(latency=0.01, responder=defender_responder)
+    tracker = InFlightTracker(publish_to(connection), window=4)
+    connection.subscribe(TOPIC + "/accepted", 1, tracker.on_response)
+
+    for report_id in range(1, 21):
+        tracker.publish(TOPIC, report(report_id), report_id)
+
+    deadline = time.monotonic() + 5
+    while len(tracker) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    connection.disconnect()
+
+    assert len(tracker) == 0
+    assert tracker.stats.published == 20
+    assert tracker.stats.accepted == 20
+    assert tracker.stats.success_rate == 1.0
+    assert tracker.stats.latency_count == 20
+    assert 0 < tracker.stats.latency_min <= tracker.stats.latency_mean <= tracker.stats.latency_max
+
+
+def test_window_blocks_publish():
+    publish = RecordingPublish()
+    tracker = InFlightTracker(publish, window=2)
+    tracker.publish(TOPIC, report(1), 1)
+    tracker.publish(TOPIC, report(2), 2)
+
+    blocked = threading.Thread(target=tracker.publish, args=(TOPIC, report(3), 3))
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+    assert len(publish.published) == 2
+
+    tracker.on_response(TOPIC + "/accepted", response(1))
+    blocked.join(1)
+    assert not blocked.is_alive()
+    assert len(publish.published) == 3
+    assert len(tracker) == 2
+
+
+def test_rejected_report_retried_then_expires(clock):
+    publish = RecordingPublish()
+    tracker = InFlightTracker(publish, max_attempts=3, backoff=5.0, clock=clock)
+    tracker.publish(TOPIC, report(1), 1)
+
+    tracker.on_response(TOPIC + "/rejected", response(1, "REJECTED"))
+    clock.now += 4.0
+    tracker.check()
+    assert len(publish.published) == 1
+
+    clock.now += 1.0
+    tracker.check()
+    assert len(publish.published) == 2
+    assert tracker.stats.retried == 1
+
+    # the second retry waits twice as long
+    tracker.on_response(TOPIC + "/rejected", response(1, "REJECTED"))
+    clock.now += 9.0
+    tracker.check()
+    assert len(publish.published) == 2
+    clock.now += 1.0
+    tracker.check()
+    assert len(publish.published) == 3
+
+    tracker.on_response(TOPIC + "/rejected", response(1, "REJECTED"))
+    assert len(tracker) == 0
+    assert tracker.stats.rejected == 3
+    assert tracker.stats.expired == 1
+    assert tracker.stats.success_rate == 0.0
+
+
+def test_unanswered_report_times_out_and_is_retried(clock):
+    publish = RecordingPublish()
+    tracker = InFlightTracker(publish, timeout=10.0, backoff=1.0, clock=clock)
+    tracker.publish(TOPIC, report(1), 1)
+
+    clock.now += 10.0
+    tracker.check()
+    assert tracker.stats.timed_out == 1
+    clock.now += 1.0
+    tracker.check()
+    assert publish.published == [(TOPIC, report(1))] * 2
+
+    clock.now += 1.5
+    tracker.on_response(TOPIC + "/accepted", response(1))
+    assert len(tracker) == 0
+    assert tracker.stats.accepted == 1
+    assert tracker.stats.latency_max == 12.5
+
+
+def test_untracked_and_unknown_reports():
+    publish = RecordingPublish(result=None)
+    tracker = InFlightTracker(publish)
+    assert tracker.publish(TOPIC, report(1), 1) is None
+    assert len(tracker) == 0
+    assert tracker.stats.published == 0
+
+    tracker.on_response(TOPIC + "/accepted", response(99))
+    assert tracker.stats.unknown == 1
+
+
+def test_agent_tracks_cbor_reports_end_to_end():
+    connection = FakeMqttConnection(latency=0.01, responder=defender_responder)
+    client = agent.IoTClientWrapper("localhost", None, None, None, "thing", None, None, None, False)
+    client.iot_client = connection
+    args = argparse.Namespace(track_delivery=True, delivery_window=4, delivery_timeout=30.0)
+    publish_report, tracker = agent.report_publisher(args, client, client.publish, CBOR_TOPIC)
+
+    for report_id in range(1, 11):
+        publish_report(CBOR_TOPIC, cbor.dumps({"header": {"report_id": report_id, "version": "1.0"}, "metrics": {}}),
+                       report_id)
+
+    deadline = time.monotonic() + 5
+    while len(tracker) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    connection.disconnect()
+
+    # the CBOR responses reach the tracker, they are not decoded as text
+    assert len(tracker) == 0
+    assert tracker.stats.accepted == 10
+    assert tracker.stats.timed_out == 0
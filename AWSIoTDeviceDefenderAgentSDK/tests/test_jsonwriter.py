@@ -0,0 +1,87 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import io
+import json
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK.jsonwriter import JsonWriter
+
+
+def compact(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        0, -1, 2 ** 70, 25.65, float("inf"),
+        "", "a", u"interface é", "quote \" and \\ backslash\n",
+        None, True, False,
+        [], [1, [2, [3]]], {}, {"a": 1, "b": [None, 2.5]},
+    ],
+)
+def test_matches_json_dumps(value):
+    sink = io.BytesIO()
+    JsonWriter(sink).value(value)
+
+    assert sink.getvalue() == compact(value)
+
+
+def test_streamed_containers():
+    sink = io.BytesIO()
+    writer = JsonWriter(sink)
+    writer.begin_map(3)
+    writer.key("ports")
+    writer.begin_array(3)
+    writer.integer(80)
+    writer.record(("port", "interface"), (443, "eth0"))
+    writer.begin_map(0)
+    writer.end_map()
+    writer.end_array()
+    writer.key("empty")
+    writer.begin_array(0)
+    writer.end_array()
+    writer.key("total")
+    writer.text("two")
+    writer.end_map()
+
+    assert sink.getvalue() == compact({"ports": [80, {"port": 443, "interface": "eth0"}, {}],
+                                       "empty": [],
+                                       "total": "two"})
+
+
+def test_record_with_nested_values():
+    sink = io.BytesIO()
+    writer = JsonWriter(sink)
+    writer.begin_array(2)
+    writer.record(("a", "b"), (None, [1.5, "x"]))
+    writer.record(("a", "b"), (True, {"c": -3}))
+    writer.end_array()
+
+    assert sink.getvalue() == compact([{"a": None, "b": [1.5, "x"]}, {"a": True, "b": {"c": -3}}])
+
+
+@pytest.mark.parametrize("values", [("11.0.0.1:443", "eth0", 50000), ("[::1]:1", None, 7),
+                                    ("x\"y", "vëth", 2 ** 33), ("a", -1, 1.5)])
+def test_record_size(values):
+    keys = ("remote_addr", "local_interface", "local_port")
+    sink = io.BytesIO()
+    writer = JsonWriter(sink)
+    writer.begin_array()
+    writer.record(keys, values)
+    writer.record(keys, values)
+    writer.end_array()
+
+    # the second record is preceded by a comma
+    assert 2 * JsonWriter(io.BytesIO()).record_size(keys, values) == len(sink.getvalue()) - 1
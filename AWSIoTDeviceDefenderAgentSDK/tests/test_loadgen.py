@@ -0,0 +1,99 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import json
+
+import cbor
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import metrics
+from AWSIoTDeviceDefenderAgentSDK.loadgen import (LatencyRecorder, LoadGenerator, RecordedReports,
+                                                  SyntheticReports)
+from AWSIoTDeviceDefenderAgentSDK.reportlog import ReportLog
+
+
+def test_latency_recorder():
+    recorder = LatencyRecorder()
+    assert recorder.percentile(0.99) == 0.0
+    for sample in range(1, 101):
+        recorder.record(sample / 1000.0)
+    assert len(recorder) == 100
+    assert recorder.percentile(0.5) == 0.05
+    assert recorder.percentile(0.99) == 0.099
+    assert recorder.percentile(1.0) == 0.1
+    assert recorder.mean == pytest.approx(0.0505)
+
+
+def test_synthetic_reports():
+    reports = SyntheticReports(connections=10, seed=1)
+    report = reports(3, 42)
+    assert report.report_id == 42
+    assert len(report.network_connections) == 10
+    assert reports(3, 43).network_connections == report.network_connections
+
+
+@pytest.mark.parametrize("payload_format", metrics.FORMATS)
+def test_publishes_every_thing(payload_format):
+    generator = LoadGenerator(SyntheticReports(connections=5, seed=1), things=20, rate=400,
+                              payload_format=payload_format, latency=0.005)
+    result = generator.run(0.25)
+
+    assert result.stats.completed == result.stats.published == result.stats.collected * generator.batch
+    assert result.stats.dropped == result.stats.failed == 0
+    assert len(result.queueing) == len(result.publishing) == result.stats.published
+    assert result.publishing.percentile(0.5) >= 0.005
+    assert result.throughput > 0
+    assert result.memory_peak >= result.memory_start > 0
+
+    topics = [topic for topic, _ in generator.connection.published]
+    assert set(topics) == set(generator.topics)
+    decode = cbor.loads if payload_format == metrics.FORMAT_CBOR else json.loads
+    report_ids = [decode(payload)["header"]["report_id"] for _, payload in generator.connection.published]
+    assert len(set(report_ids)) == len(report_ids)
+
+
+def test_tracked_delivery_of_recorded_reports(tmp_path):
+    path = str(tmp_path / "reports.log")
+    log = ReportLog(path)
+    for report_id in range(3):
+        m = metrics.Metrics(short_names=report_id % 2 == 1)
+        m.add_network_connection("11.0.0.%d" % report_id, 443, "eth0", 50000)
+        m.report_id = report_id
+        log.append(report_id, m.to_cbor(), "recorded")
+    log.close()
+
+    reports = RecordedReports(path)
+    try:
+        # the queues hold every report, so none is dropped while the window is full
+        generator = LoadGenerator(reports, things=4, rate=100, latency=0.005, qos=1, track_delivery=True, window=2,
+                                  queue_size=6)
+        result = generator.run(samples=6)
+    finally:
+        reports.close()
+
+    assert result.stats.dropped == 0
+    assert result.delivery.published == result.stats.published == 6
+    assert result.delivery.accepted == result.delivery.published
+    assert result.delivery.latency_min >= 0.005
+    # every recorded report is replayed, with its own tags
+    replayed = set()
+    for _, payload in generator.connection.published:
+        report = json.loads(payload)
+        replayed.add(json.dumps(report.get("metrics", report.get("met")), sort_keys=True))
+    assert len(replayed) == 3
+
+
+def test_empty_replay(tmp_path):
+    path = str(tmp_path / "reports.log")
+    ReportLog(path).close()
+    with pytest.raises(ValueError):
+        RecordedReports(path)
@@ -11,6 +11,14 @@
 #   express or implied. See the License for the specific language governing
 #   permissions and limitations under the License.
 
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+
+import cbor
 import pytest
 from AWSIoTDeviceDefenderAgentSDK import metrics, tags
 
@@ -146,7 +154,7 @@ def test_v1_metrics_optional_elements(simple_metric):
     simple_metric._interface_stats = {}
     simple_metric.listening_tcp_ports = []
     simple_metric.listening_udp_ports = []
-    simple_metric._net_connections = []
+    simple_metric._net_connections = metrics.RecordSet()
 
     report = simple_metric._v1_metrics()
     metric_block = report[t.metrics]
@@ -188,7 +196,8 @@ def test_v1_sampled_lists(simple_metric):
 
 
 def test_listening_ports(simple_metric):
-    assert len(simple_metric.listening_tcp_ports) == 4
+    # the duplicate TCP port 8000 is only stored once
+    assert len(simple_metric.listening_tcp_ports) == 3
     assert len(simple_metric.listening_udp_ports) == 3
 
     if any(
@@ -229,7 +238,7 @@ def test_add_listening_ports_dedup(simple_metric):
     new_udp_port = [{"port": 999, "interface": "eth0"}]
 
     simple_metric.add_listening_ports("TCP", new_tcp_port)
-    assert len(simple_metric.listening_tcp_ports) == 4
+    assert len(simple_metric.listening_tcp_ports) == 3
 
     simple_metric.add_listening_ports("UDP", new_udp_port)
     assert len(simple_metric.listening_udp_ports) == 3
@@ -269,15 +278,75 @@ def test_network_stats_delta_calculation(simple_metric):
     assert m3.network_stats["bytes_out"] == 25
     assert m3.network_stats["packets_out"] == 25
 
+
+def test_network_stats_delta_calculation_short_names():
+    m1 = metrics.Metrics(short_names=True)
+    m1.add_network_stats(bytes_in=100, packets_in=50, bytes_out=200, packets_out=150)
+
+    m2 = metrics.Metrics(short_names=True, last_metric=m1)
+    m2.add_network_stats(bytes_in=125, packets_in=75, bytes_out=225, packets_out=175)
+
+    assert m2.network_stats == {"bi": 25, "bo": 25, "pi": 25, "po": 25}
+
+
 def test_add_cpu_usage(simple_metric):
     assert len(simple_metric.cpu_metrics) == 1
     assert simple_metric.cpu_metrics["number"] == 50.5
 
+
 def test_add_network_connections(simple_metric):
     assert len(simple_metric._net_connections) == 3
-    assert simple_metric._net_connections[0]["remote_addr"] == "10.10.10.10:80"
-    assert simple_metric._net_connections[1]["remote_addr"] == "11.11.11.11:80"
-    assert simple_metric._net_connections[2]["remote_addr"] == "[2001:0db8:85a3:0000:0000:8a2e:0370:7334]:80"
+    assert simple_metric.network_connections[0]["remote_addr"] == "10.10.10.10:80"
+    assert simple_metric.network_connections[1]["remote_addr"] == "11.11.11.11:80"
+    assert simple_metric.network_connections[2]["remote_addr"] == "[2001:0db8:85a3:0000:0000:8a2e:0370:7334]:80"
+
+
+def test_add_listening_ports_does_not_multiply_entries():
+    m = metrics.Metrics()
+    ports = [{"port": i, "interface": "eth0"} for i in range(100)]
+
+    m.add_listening_ports("TCP", ports)
+    m.add_listening_ports("TCP", ports + [{"port": 100}])
+
+    assert len(m.listening_tcp_ports) == 101
+    assert m.listening_ports("TCP")[0] == {"port": 0, "interface": "eth0"}
+    assert m.listening_ports("TCP")[100] == {"port": 100}
+
+
+def test_report_output(simple_metric):
+    simple_metric._timestamp = 1600000000
+
+    assert simple_metric.to_json_string() == (
+        '{"header":{"report_id":1600000000,"version":"1.0"},'
+        '"metrics":{"tcp_connections":{"established_connections":{"connections":['
+        '{"remote_addr":"10.10.10.10:80","local_interface":"eth0","local_port":9009},'
+        '{"remote_addr":"11.11.11.11:80","local_interface":"eth0","local_port":88888},'
+        '{"remote_addr":"[2001:0db8:85a3:0000:0000:8a2e:0370:7334]:80","local_interface":"eth0","local_port":8080}],'
+        '"total":3}},'
+        '"listening_tcp_ports":{"ports":[{"port":80,"interface":"eth0"},{"port":88,"interface":"wlan0"},'
+        '{"port":8000,"interface":"eth0"}],"total":3},'
+        '"listening_udp_ports":{"ports":[{"port":999,"interface":"eth0"},{"port":980,"interface":"wlan0"},'
+        '{"port":9032,"interface":"eth0"}],"total":3}},'
+        '"custom_metrics":{"cpu_usage":[{"number":50.5}]}}'
+    )
+
+
+def test_report_id_setter(simple_metric):
+    before = simple_metric.to_json_string()
+    simple_metric.report_id = 42
+
+    assert simple_metric.report_id == 42
+    assert json.loads(simple_metric.to_json_string())["header"]["report_id"] == 42
+    assert cbor.loads(bytes(simple_metric.to_cbor()))["header"]["report_id"] == 42
+    assert simple_metric.to_json_string() != before
+
+
+def test_network_connection_records(simple_metric):
+    assert simple_metric._net_connections[2] == metrics.Connection(
+        "2001:0db8:85a3:0000:0000:8a2e:0370:7334", 80, "eth0", 8080
+    )
+    assert metrics.format_address("10.0.0.1", 443) == "10.0.0.1:443"
+    assert metrics.format_address("::1", 443) == "[::1]:443"
 
 
 def test_add_network_connection_dedup(simple_metric):
@@ -315,3 +384,563 @@ def test_sampled_lists(simple_metric):
     assert len(metric_block[t.listening_tcp_ports][t.ports]) == 10
     assert len(metric_block[t.listening_udp_ports][t.ports]) == 10
     assert len(metric_block[t.tcp_conn][t.established_connections][t.connections]) == 10
+
+
+def test_report_is_built_once(simple_metric):
+    simple_metric.max_list_size = 2
+
+    report = simple_metric._v1_metrics()
+    assert simple_metric._v1_metrics() is report
+
+    # JSON and CBOR of the same metrics carry the same sampled entries
+    from_json = json.loads(simple_metric.to_json_string())
+    from_pretty_json = json.loads(simple_metric.to_json_string(pretty_print=True))
+    from_cbor = cbor.loads(bytes(simple_metric.to_cbor()))
+    assert from_json == from_pretty_json == from_cbor == report
+    assert json.loads(simple_metric.write_json(io.BytesIO()).getvalue()) == report
+
+
+def test_report_cache_invalidation(simple_metric):
+    t = tags.Tags()
+    report = simple_metric._v1_metrics()
+
+    simple_metric.add_network_connection("12.12.12.12", 443, "eth0", 5000)
+    report = simple_metric._v1_metrics()
+    assert report[t.metrics][t.tcp_conn][t.established_connections][t.total] == 4
+
+    simple_metric.listening_udp_ports.append({"port": 53})
+    report = simple_metric._v1_metrics()
+    assert report[t.metrics][t.listening_udp_ports][t.total] == 4
+
+    simple_metric.max_list_size = 1
+    report = simple_metric._v1_metrics()
+    assert len(report[t.metrics][t.listening_udp_ports][t.ports]) == 1
+
+    simple_metric.add_cpu_usage(10.0)
+    assert simple_metric._v1_metrics()[t.custom_metrics][t.cpu_usage] == [{"number": 10.0}]
+
+    # adding a duplicate entry keeps the cached report
+    report = simple_metric._v1_metrics()
+    simple_metric.add_network_connection("12.12.12.12", 443, "eth0", 5000)
+    assert simple_metric._v1_metrics() is report
+
+
+@pytest.mark.parametrize("short_names", [False, True])
+def test_streamed_json_is_identical(short_names):
+    m = metrics.Metrics(short_names=short_names)
+    m.add_network_stats(bytes_in=100, packets_in=50, bytes_out=200, packets_out=150)
+    m2 = metrics.Metrics(short_names=short_names, last_metric=m)
+    m2.add_network_stats(bytes_in=300, packets_in=70, bytes_out=200, packets_out=250)
+    for i in range(200):
+        m2.add_network_connection("10.0.%d.%d" % (i // 256, i % 256), 443, "eth0", 1024 + i)
+        m2.add_network_connection("2001:db8::%x" % i, 443, None, 1024 + i)
+    m2.add_listening_ports("TCP", [{"port": 22, "interface": "eth0"}, {"port": 8883}])
+    m2.add_listening_ports("UDP", [{"port": i} for i in range(100)])
+    m2.add_cpu_usage(25.65)
+
+    assert m2.write_json(io.BytesIO()).getvalue() == m2.to_json_string().encode('utf-8')
+
+
+def test_streamed_json_empty_report():
+    m = metrics.Metrics()
+
+    assert m.write_json(io.BytesIO()).getvalue() == m.to_json_string().encode('utf-8')
+
+
+@pytest.mark.parametrize("extension", [True, False], ids=["extension", "writer"])
+@pytest.mark.parametrize("short_names", [False, True])
+def test_cbor_conformance(short_names, extension, monkeypatch):
+    monkeypatch.setattr(metrics, "CBOR_EXTENSION", extension)
+    m = metrics.Metrics(short_names=short_names)
+    m.add_network_stats(bytes_in=100, packets_in=50, bytes_out=200, packets_out=150)
+    m2 = metrics.Metrics(short_names=short_names, last_metric=m)
+    m2.add_network_stats(bytes_in=300, packets_in=70, bytes_out=200, packets_out=250)
+    for i in range(200):
+        m2.add_network_connection("10.0.%d.%d" % (i // 256, i % 256), 443, "eth0", 1024 + i)
+        m2.add_network_connection("2001:db8::%x" % i, 443, None, 1024 + i)
+    m2.add_listening_ports("TCP", [{"port": 22, "interface": "eth0"}, {"port": 8883}])
+    m2.add_listening_ports("UDP", [{"port": i} for i in range(100)])
+    m2.add_cpu_usage(25.65)
+
+    encoded = m2.to_cbor()
+
+    assert bytes(encoded) == cbor.dumps(m2._v1_metrics())
+    assert cbor.loads(bytes(encoded)) == m2._v1_metrics()
+    buffer = bytearray(b"previous report")
+    assert m2.to_cbor(buffer) is buffer
+    assert bytes(buffer) == bytes(encoded)
+
+
+def test_cbor_empty_report():
+    m = metrics.Metrics()
+
+    assert cbor.loads(bytes(m.to_cbor())) == m._v1_metrics()
+
+
+def test_reservoir_is_bounded():
+    reservoir = metrics.Reservoir(10)
+    reservoir.extend(range(10000))
+
+    sample = reservoir.sample()
+    assert len(reservoir) == 10
+    assert len(set(sample)) == 10
+    assert sample == sorted(sample)  # entries keep the order they were offered in
+
+
+def test_reservoir_is_uniform():
+    chosen = [0] * 20
+    for seed in range(2000):
+        reservoir = metrics.Reservoir(5, random.Random(seed))
+        reservoir.extend(range(20))
+        for entry in reservoir.sample():
+            chosen[entry] += 1
+
+    # every entry is expected 500 times
+    assert min(chosen) > 400
+    assert max(chosen) < 600
+
+
+def test_sampling_does_not_reseed_global_random():
+    state = random.getstate()
+    m = metrics.Metrics()
+    m.max_list_size = 5
+    for i in range(100):
+        m.add_network_connection("10.0.0.1", i, "eth0", 8000 + i)
+    m._v1_metrics()
+
+    assert random.getstate() == state
+
+
+def test_sampling_with_record_set_reservoir():
+    t = tags.Tags()
+    m = metrics.Metrics()
+    m.max_list_size = 10
+    for i in range(1000):
+        m.add_network_connection("10.0.0.1", i, "eth0", 8000)
+
+    assert len(m._net_connections.reservoir) == 10
+    established = m._v1_metrics()[t.metrics][t.tcp_conn][t.established_connections]
+    assert len(established[t.connections]) == 10
+    assert established[t.total] == 1000
+
+    m.max_list_size = 20
+    assert len(m._v1_metrics()[t.metrics][t.tcp_conn][t.established_connections][t.connections]) == 20
+
+    m.max_list_size = None
+    assert m._net_connections.reservoir is None
+    assert len(m._v1_metrics()[t.metrics][t.tcp_conn][t.established_connections][t.connections]) == 1000
+
+
+def test_stable_sampling_across_cycles():
+    t = tags.Tags()
+
+    def cycle(ports):
+        m = metrics.Metrics(stable_sampling=True)
+        m.max_list_size = 10
+        for port in ports:
+            m.add_network_connection("10.0.0.1", port, "eth0", 8000)
+        connections = m._v1_metrics()[t.metrics][t.tcp_conn][t.established_connections][t.connections]
+        return [c[t.remote_addr] for c in connections]
+
+    first = cycle(range(100))
+    # the same connections, seen in a different order, and a few short-lived ones
+    second = cycle(list(reversed(range(100))) + list(range(1000, 1005)))
+
+    assert set(first) == set(cycle(range(100)))
+    assert len(set(first) & set(second)) >= 5
+
+
+STABLE_SAMPLE = """
+from AWSIoTDeviceDefenderAgentSDK import metrics
+m = metrics.Metrics(stable_sampling=True)
+m.max_list_size = 10
+for i in range(100):
+    m.add_network_connection("10.0.0.%d" % i, 443, "eth0", 8000 + i)
+m.add_listening_ports("TCP", [{"port": port, "interface": "eth0"} for port in range(1, 101)])
+print(m.to_json_string())
+"""
+
+
+def test_stable_sampling_across_processes():
+    # string hashes are salted per process, the sample must not depend on them
+    root = os.path.dirname(os.path.dirname(os.path.abspath(metrics.__file__)))
+    reports = []
+    for seed in ("1", "2"):
+        env = dict(os.environ, PYTHONHASHSEED=seed,
+                   PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+        output = subprocess.check_output([sys.executable, "-c", STABLE_SAMPLE], env=env)
+        reports.append(json.loads(output.decode("utf-8"))["metrics"])
+
+    assert len(reports[0]["tcp_connections"]["established_connections"]["connections"]) == 10
+    assert reports[0]["tcp_connections"] == reports[1]["tcp_connections"]
+    assert reports[0]["listening_tcp_ports"] == reports[1]["listening_tcp_ports"]
+
+
+def steady_state_metric(last_metric=None, extra_connections=()):
+    m = metrics.Metrics(last_metric=last_metric)
+    m.max_list_size = 5
+    for i in range(20):
+        m.add_network_connection("10.0.0.%d" % i, 443, "eth0", 8000 + i)
+    for remote_addr in extra_connections:
+        m.add_network_connection(remote_addr, 443, "eth0", 9000)
+    m.add_listening_ports("TCP", [{"port": 22, "interface": "eth0"}])
+    m.add_listening_ports("UDP", [{"port": 68}])
+    return m
+
+
+def test_listening_ports_by_name():
+    m = metrics.Metrics()
+    m.add_listening_ports("TCP", [{"port": 22, "interface": "eth0"}, {"port": 80}, {"port": 22, "interface": "eth0"}])
+
+    ports = m.listening_tcp_ports
+    assert len(ports) == 2
+    assert ports[0]['port'] == 22 and ports[0]['interface'] == "eth0"
+    assert ports[-1]['port'] == 80 and ports[-1].get('interface') is None
+    with pytest.raises(KeyError):
+        ports[1]['interface']
+    assert ports[0][0] == 22
+    assert [p['port'] for p in ports] == [22, 80]
+    assert m.listening_ports("TCP") == [{"port": 22, "interface": "eth0"}, {"port": 80}]
+
+
+def test_record_set_diff():
+    previous = metrics.RecordSet([1, 2, 3])
+    current = metrics.RecordSet([3, 2, 4])
+
+    diff = current.diff(previous)
+    assert diff.added == {4}
+    assert diff.removed == {1}
+    assert diff.changed
+    assert not current.diff(current).changed
+
+    assert metrics.RecordSet([3, 2, 1]).same_entries(previous)
+    assert not current.same_entries(previous)
+
+
+def test_metrics_diff():
+    m1 = steady_state_metric()
+    m1.add_network_connection("10.1.1.1", 443, "eth0", 9000)
+    m2 = steady_state_metric(m1, ["10.2.2.2"])
+
+    diff = m2.diff()
+    assert diff.connections.added == {metrics.Connection("10.2.2.2", 443, "eth0", 9000)}
+    assert diff.connections.removed == {metrics.Connection("10.1.1.1", 443, "eth0", 9000)}
+    assert not diff.tcp_ports.changed
+    assert not diff.udp_ports.changed
+
+    assert m1.diff(m2).connections.added == diff.connections.removed
+    assert metrics.Metrics().diff() is None
+
+
+def test_unchanged_sections_are_not_rendered_again():
+    t = tags.Tags()
+    m1 = steady_state_metric()
+    report1 = m1._v1_metrics()
+    m2 = steady_state_metric(m1)
+    report2 = m2._v1_metrics()
+
+    established1 = report1[t.metrics][t.tcp_conn][t.established_connections]
+    established2 = report2[t.metrics][t.tcp_conn][t.established_connections]
+    assert established2[t.connections] is established1[t.connections]
+    assert report2[t.metrics][t.listening_tcp_ports][t.ports] is report1[t.metrics][t.listening_tcp_ports][t.ports]
+    assert m2.to_json_string() == m1.to_json_string().replace(str(m1._timestamp), str(m2._timestamp))
+
+    # a changed section is sampled again, the others are still reused
+    m3 = steady_state_metric(m2, ["10.3.3.3"])
+    report3 = m3._v1_metrics()
+    assert report3[t.metrics][t.tcp_conn][t.established_connections][t.total] == 21
+    assert report3[t.metrics][t.listening_udp_ports][t.ports] is report1[t.metrics][t.listening_udp_ports][t.ports]
+
+
+def test_sections_are_not_reused_across_sampling_changes():
+    t = tags.Tags()
+    m1 = steady_state_metric()
+    m1._v1_metrics()
+    m2 = steady_state_metric(m1)
+    m2.max_list_size = 10
+
+    assert len(m2._v1_metrics()[t.metrics][t.tcp_conn][t.established_connections][t.connections]) == 10
+
+    # a previous report that was never rendered has nothing to reuse
+    m3 = steady_state_metric(steady_state_metric())
+    assert len(m3._v1_metrics()[t.metrics][t.tcp_conn][t.established_connections][t.connections]) == 5
+
+
+def test_elapsed_interval_is_monotonic_and_sub_second():
+    m1 = metrics.Metrics()
+    m1.collection_start -= 2.5
+    m1._timestamp -= 3
+    m2 = metrics.Metrics(last_metric=m1)
+
+    assert m2._elapsed_interval == pytest.approx(2.5, abs=0.1)
+    # wall-clock seconds, as before
+    assert m2.interval == m2._timestamp - m1._timestamp
+    assert isinstance(m2.interval, int)
+    assert m2.collection_end is None
+
+
+def test_network_rates():
+    m1 = metrics.Metrics()
+    m1.add_network_stats(bytes_in=100, packets_in=50, bytes_out=200, packets_out=150)
+    m1._stats_time -= 2.0
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_network_stats(bytes_in=300, packets_in=70, bytes_out=200, packets_out=250)
+
+    rates = m2.network_rates
+    assert rates.bytes_in == pytest.approx(100, rel=0.01)
+    assert rates.packets_in == pytest.approx(10, rel=0.01)
+    assert rates.bytes_out == 0
+    assert rates.packets_out == pytest.approx(50, rel=0.01)
+    assert m1.network_rates is None
+
+
+def stats(bytes_in, bytes_out=0, packets_in=0, packets_out=0):
+    return metrics.NetworkStats(bytes_in, bytes_out, packets_in, packets_out)
+
+
+def test_interface_slots_are_stable_and_reused():
+    slots = metrics.InterfaceSlots()
+    slots.update(["lo", "eth0", "veth1"])
+    assert [slots["lo"], slots["eth0"], slots["veth1"]] == [0, 1, 2]
+
+    slots.update(["lo", "veth1", "veth2", "veth3"])
+    assert slots["veth1"] == 2
+    assert slots["veth2"] == 1
+    assert slots["veth3"] == 3
+    assert len(slots) == 4
+
+
+def test_interface_stats_delta():
+    m1 = metrics.Metrics()
+    m1.add_interface_stats({"lo": stats(100, 100, 1, 1), "eth0": stats(1000, 500, 10, 5),
+                            "veth1": stats(50)})
+    assert m1.interface_stats == {}
+    assert m1.network_stats == {}
+    assert m1.total_counts == stats(1150, 600, 11, 6)
+
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_interface_stats({"lo": stats(150, 150, 2, 2), "eth0": stats(1500, 700, 15, 7),
+                            "veth2": stats(10000)})
+
+    # veth1 disappeared and veth2 appeared, neither has a delta nor skews the aggregate
+    assert m2.interface_stats == {"eth0": stats(500, 200, 5, 2), "lo": stats(50, 50, 1, 1)}
+    assert list(m2.interface_stats) == ["eth0", "lo"]
+    assert m2.network_stats == {"bytes_in": 550, "bytes_out": 250, "packets_in": 6, "packets_out": 3}
+    assert json.loads(m2.to_json_string())["metrics"]["network_stats"] == m2.network_stats
+
+    m3 = metrics.Metrics(last_metric=m2)
+    m3.add_interface_stats({"lo": stats(200, 200, 3, 3), "eth0": stats(1600, 800, 16, 8),
+                            "veth2": stats(10100)})
+    assert m3.interface_stats["veth2"] == stats(100)
+    assert m3.network_stats["bytes_in"] == 250
+
+
+def test_interface_stats_counter_reset_and_wrap():
+    m1 = metrics.Metrics()
+    m1.add_interface_stats({"eth0": stats(1000, 1000), "tun0": stats(2 ** 32 - 100, 10), "lo": stats(5)})
+    m1._stats_time -= 10
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_interface_stats({"eth0": stats(40, 1100), "tun0": stats(50, 20), "lo": stats(5)})
+
+    # eth0 was reset and is left out, tun0 wrapped around
+    assert m2.interface_stats == {"lo": stats(0), "tun0": stats(150, 10)}
+    assert m2.network_stats_status == metrics.COUNTER_RESET
+    assert m2.network_stats["bytes_in"] == 150
+
+
+def test_interface_stats_rates():
+    m1 = metrics.Metrics()
+    m1.add_interface_stats({"eth0": stats(100), "eth1": stats(100)})
+    m1._stats_time -= 2.0
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_interface_stats({"eth0": stats(300), "eth1": stats(200)})
+
+    assert m2.network_rates.bytes_in == pytest.approx(150, rel=0.01)
+
+
+@pytest.mark.parametrize("new, old, elapsed, expected", [
+    (150, 100, None, (50, metrics.COUNTER_OK)),
+    (100, 100, 1.0, (0, metrics.COUNTER_OK)),
+    # a 32-bit counter close to its limit wraps around
+    (100, 2 ** 32 - 50, 1.0, (150, metrics.COUNTER_WRAPPED)),
+    # a small reading after a small one is a reset, a wrap would take billions of bytes
+    (100, 5000, 1.0, (None, metrics.COUNTER_RESET)),
+    # 64-bit counters do not wrap
+    (100, 2 ** 40, None, (None, metrics.COUNTER_RESET)),
+    # a wrap faster than any link is a reset
+    (2 ** 30, 2 ** 32 - 1, 0.001, (None, metrics.COUNTER_RESET)),
+    # so is an increase faster than any link
+    (2 ** 50, 0, 1.0, (None, metrics.COUNTER_RESET)),
+])
+def test_counter_delta(new, old, elapsed, expected):
+    assert metrics.counter_delta(new, old, elapsed) == expected
+
+
+def test_network_stats_wraparound():
+    m1 = metrics.Metrics()
+    m1.add_network_stats(bytes_in=2 ** 32 - 10, packets_in=50, bytes_out=200, packets_out=150)
+    m1._stats_time -= 5.0
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_network_stats(bytes_in=90, packets_in=60, bytes_out=300, packets_out=160)
+
+    assert m2.network_stats_status == metrics.COUNTER_WRAPPED
+    assert m2.network_stats == {"bytes_in": 100, "bytes_out": 100, "packets_in": 10, "packets_out": 10}
+    assert m2.network_rates.bytes_in == pytest.approx(20, rel=0.01)
+
+
+def test_network_stats_reset_is_suppressed():
+    m1 = metrics.Metrics()
+    m1.add_network_stats(bytes_in=2 ** 40, packets_in=50000, bytes_out=2 ** 40, packets_out=40000)
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_network_stats(bytes_in=1000, packets_in=10, bytes_out=2 ** 40 + 10, packets_out=40010)
+
+    assert m2.network_stats_status == metrics.COUNTER_RESET
+    assert m2.network_stats == {}
+    assert m2.network_rates is None
+    assert "network_stats" not in json.loads(m2.to_json_string())["metrics"]
+    assert "network_stats" not in cbor.loads(bytes(m2.to_cbor()))["metrics"]
+
+    # the next delta is computed from the counters read after the reset
+    m3 = metrics.Metrics(last_metric=m2)
+    m3.add_network_stats(bytes_in=1500, packets_in=15, bytes_out=2 ** 40 + 20, packets_out=40020)
+    assert m3.network_stats_status == metrics.COUNTER_OK
+    assert m3.network_stats["bytes_in"] == 500
+
+
+def test_packet_counter_reset_is_not_a_wrap():
+    # a 32-bit packet counter reset after 3 billion packets looks like a wrap of 1.3 billion packets,
+    # plausible for bytes but not for packets in 10 seconds
+    m1 = metrics.Metrics()
+    m1.add_network_stats(bytes_in=5000, packets_in=3 * 10 ** 9, bytes_out=5000, packets_out=100)
+    m1._stats_time -= 10
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_network_stats(bytes_in=6000, packets_in=1000, bytes_out=6000, packets_out=110)
+
+    assert m2.network_stats_status == metrics.COUNTER_RESET
+    assert m2.network_stats == {}
+
+    m3 = metrics.Metrics()
+    m3.add_interface_stats({"eth0": stats(5000, 5000, 3 * 10 ** 9, 100), "lo": stats(5, 5, 1, 1)})
+    m3._stats_time -= 10
+    m4 = metrics.Metrics(last_metric=m3)
+    m4.add_interface_stats({"eth0": stats(6000, 6000, 1000, 110), "lo": stats(5, 5, 1, 1)})
+
+    assert m4.interface_stats == {"lo": stats(0)}
+    assert m4.network_stats_status == metrics.COUNTER_RESET
+
+
+def test_packet_counter_wrap():
+    m1 = metrics.Metrics()
+    m1.add_network_stats(bytes_in=5000, packets_in=2 ** 32 - 100, bytes_out=5000, packets_out=100)
+    m1._stats_time -= 10
+    m2 = metrics.Metrics(last_metric=m1)
+    m2.add_network_stats(bytes_in=6000, packets_in=400, bytes_out=6000, packets_out=110)
+
+    assert m2.network_stats_status == metrics.COUNTER_WRAPPED
+    assert m2.network_stats["packets_in"] == 500
+
+
+def test_network_stats_without_previous_reading():
+    m1 = metrics.Metrics()
+    m1.add_network_stats(bytes_in=100, packets_in=50, bytes_out=200, packets_out=150)
+    assert m1.network_stats == {}
+    assert m1.network_stats_status is None
+
+    m2 = metrics.Metrics(last_metric=metrics.Metrics())
+    m2.add_network_stats(bytes_in=100, packets_in=50, bytes_out=200, packets_out=150)
+    assert m2.network_stats == {}
+    assert m2.network_rates is None
+
+
+def populated(short_names=False, connections=2000, ports=300):
+    m = metrics.Metrics(short_names=short_names)
+    for i in range(connections):
+        m.add_network_connection("11.0.%d.%d" % (i // 256, i % 256), 443, "eth0", 1024 + i)
+    m.add_listening_ports("TCP", [{"port": p, "interface": "eth0"} for p in range(1, ports + 1)])
+    m.add_listening_ports("UDP", [{"port": p} for p in range(1, 11)])
+    return m
+
+
+def encoded(m, payload_format):
+    if payload_format == metrics.FORMAT_CBOR:
+        return bytes(m.to_cbor())
+    return m.to_json_string().encode("utf-8")
+
+
+@pytest.mark.parametrize("payload_format", metrics.FORMATS)
+@pytest.mark.parametrize("short_names", [False, True])
+@pytest.mark.parametrize("budget", [600, 4000, 20000])
+def test_payload_budget_is_respected(payload_format, short_names, budget):
+    m = populated(short_names)
+    m.max_list_size = None
+    m.payload_format = payload_format
+    m.max_payload_size = budget
+    payload = encoded(m, payload_format)
+
+    assert len(payload) <= budget
+    # the budget is filled up to about one connection entry
+    assert len(payload) > budget - 100
+
+
+def test_payload_budget_balances_coverage():
+    m = populated()
+    m.max_list_size = None
+    m.max_payload_size = 8000
+    report = json.loads(m.to_json_string())["metrics"]
+
+    connections = report["tcp_connections"]["established_connections"]
+    tcp = report["listening_tcp_ports"]
+    udp = report["listening_udp_ports"]
+    shares = [float(len(entries)) / total for entries, total in ((connections["connections"], connections["total"]),
+                                                                 (tcp["ports"], tcp["total"]),
+                                                                 (udp["ports"], udp["total"]))]
+    assert shares[0] > 0.04
+
+    def size(entry):
+        # encoded size of an entry of the compact report, with its separating comma
+        return len(json.dumps(entry, separators=(",", ":"))) + 1
+
+    # while every list takes entries, each is covered to within one entry of the others
+    for ports in (tcp, udp):
+        assert shares[0] - 1.0 / connections["total"] <= float(len(ports["ports"])) / ports["total"]
+    # once the next connection no longer fits, the bytes left, less than one connection entry, go to port entries
+    extra = []
+    for ports in (tcp, udp):
+        balanced = len(connections["connections"]) * ports["total"] // connections["total"] + 1
+        extra.extend(sorted(size(port) for port in ports["ports"])[:max(0, len(ports["ports"]) - balanced)])
+    assert sum(extra) < max(size(connection) for connection in connections["connections"])
+
+
+def test_payload_budget_format_and_tags_fit_more_entries():
+    counts = []
+    for short_names, payload_format in ((False, "json"), (True, "json"), (True, "cbor")):
+        m = populated(short_names)
+        m.max_list_size = None
+        m.payload_format = payload_format
+        m.max_payload_size = 10000
+        counts.append(len(m._sampled()[0]))
+    assert counts[0] < counts[1] < counts[2]
+
+
+def test_payload_budget_keeps_max_list_size_and_small_reports():
+    m = populated()
+    m.max_payload_size = 100000
+    report = m._v1_metrics()["metrics"]
+    assert len(report["tcp_connections"]["established_connections"]["connections"]) == 50
+    assert len(report["listening_tcp_ports"]["ports"]) == 50
+
+    small = populated(connections=3, ports=3)
+    small.max_payload_size = 100000
+    assert small.to_json_string() == populated(connections=3, ports=3).to_json_string()
+
+
+def test_payload_budget_smaller_than_report_skeleton():
+    m = populated()
+    m.max_payload_size = 10
+    report = m._v1_metrics()["metrics"]
+    assert report["tcp_connections"]["established_connections"] == {"connections": [], "total": 2000}
+
+
+def test_invalid_payload_format():
+    with pytest.raises(ValueError):
+        metrics.Metrics().payload_format = "xml"
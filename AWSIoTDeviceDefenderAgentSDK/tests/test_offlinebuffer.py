@@ -0,0 +1,257 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import os
+import threading
+import time
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import offlinebuffer
+from AWSIoTDeviceDefenderAgentSDK.fakemqtt import FakeMqttConnection
+from AWSIoTDeviceDefenderAgentSDK.offlinebuffer import BufferedPublisher, OfflineBuffer
+
+TOPIC = "$aws/things/thing/defender/metrics/json"
+
+
+def report(i):
+    return '{"header":{"report_id":%d}}' % i
+
+
+def drain_all(buffer):
+    messages = []
+    while True:
+        message = buffer.peek()
+        if message is None:
+            return messages
+        messages.append(message)
+        buffer.ack()
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(str(directory)) if name.endswith(offlinebuffer.SEGMENT_SUFFIX))
+
+
+def test_fifo_across_segments(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path), max_bytes=4096, segment_bytes=256, sync=False)
+    for i in range(20):
+        buffer.append(TOPIC, report(i))
+
+    assert len(buffer) == 20
+    assert len(segments(tmp_path)) > 1
+    assert drain_all(buffer) == [(TOPIC, report(i).encode()) for i in range(20)]
+    assert len(buffer) == 0
+    # delivered segments are deleted
+    assert len(segments(tmp_path)) == 1
+
+
+def test_survives_reopening(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path), segment_bytes=256)
+    for i in range(10):
+        buffer.append(TOPIC, report(i))
+    for _ in range(4):
+        buffer.peek()
+        buffer.ack()
+    buffer.close()
+
+    reopened = OfflineBuffer(str(tmp_path), segment_bytes=256)
+    assert len(reopened) == 6
+    assert [payload for _, payload in drain_all(reopened)] == [report(i).encode() for i in range(4, 10)]
+
+
+def test_ack_flushes_index(tmp_path):
+    class Index(object):
+        def __init__(self, index):
+            self.index = index
+            self.flushes = 0
+
+        def __setitem__(self, key, value):
+            self.index[key] = value
+
+        def flush(self):
+            self.flushes += 1
+            self.index.flush()
+
+    for sync in (True, False):
+        buffer = OfflineBuffer(str(tmp_path / str(sync)), sync=sync)
+        buffer.append(TOPIC, report(0))
+        buffer._index = index = Index(buffer._index)
+        buffer.peek()
+        buffer.ack()
+        assert index.flushes == (1 if sync else 0)
+        buffer._index = index.index
+        buffer.close()
+
+
+def test_incomplete_record_is_truncated(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path))
+    buffer.append(TOPIC, report(1))
+    buffer.append(TOPIC, report(2))
+    buffer.close()
+
+    # crash while appending the third report
+    path = os.path.join(str(tmp_path), segments(tmp_path)[-1])
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(offlinebuffer.RECORD_HEADER.pack(100, len(TOPIC), 0) + TOPIC.encode() + b'{"hea')
+
+    reopened = OfflineBuffer(str(tmp_path))
+    assert len(reopened) == 2
+    assert os.path.getsize(path) == size
+    reopened.append(TOPIC, report(3))
+    assert [payload for _, payload in drain_all(reopened)] == [report(i).encode() for i in (1, 2, 3)]
+
+
+def test_corrupt_index_redelivers(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path))
+    for i in range(3):
+        buffer.append(TOPIC, report(i))
+    buffer.peek()
+    buffer.ack()
+    buffer.close()
+
+    with open(os.path.join(str(tmp_path), offlinebuffer.INDEX_FILE), 'r+b') as f:
+        f.write(b'\xff' * 4)
+
+    # delivered at least once
+    assert len(OfflineBuffer(str(tmp_path))) == 3
+
+
+def test_evicts_oldest_when_full(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path), max_bytes=1024, segment_bytes=256, sync=False)
+    for i in range(100):
+        buffer.append(TOPIC, report(i))
+
+    assert buffer.size <= 1024
+    assert buffer.evicted > 0
+    assert len(buffer) + buffer.evicted == 100
+    payloads = [payload for _, payload in drain_all(buffer)]
+    assert payloads[-1] == report(99).encode()
+    assert payloads == [report(i).encode() for i in range(100 - len(payloads), 100)]
+
+
+def test_eviction_while_delivering(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path), max_bytes=512, segment_bytes=256, sync=False)
+    for i in range(5):
+        buffer.append(TOPIC, report(i))
+    buffer.peek()
+    for i in range(5, 40):
+        buffer.append(TOPIC, report(i))
+
+    # the report being delivered was evicted, acknowledging it must not skip another one
+    buffer.ack()
+    assert len(buffer) + buffer.evicted == 40
+    assert drain_all(buffer)[-1] == (TOPIC, report(39).encode())
+
+
+def test_oversized_report(tmp_path):
+    buffer = OfflineBuffer(str(tmp_path), max_bytes=1024, segment_bytes=256)
+    with pytest.raises(ValueError):
+        buffer.append(TOPIC, "x" * 300)
+
+
+def test_drain_rate_limit(tmp_path):
+    conn = FakeMqttConnection()
+    buffer = OfflineBuffer(str(tmp_path), sync=False)
+    for i in range(5):
+        buffer.append(TOPIC, report(i))
+
+    start = time.monotonic()
+    delivered = buffer.drain(lambda topic, payload: conn.publish(topic, payload, qos=1)[0], rate=50)
+
+    assert delivered == 5
+    assert time.monotonic() - start >= 4 / 50.0
+    assert [payload for _, payload in conn.published] == [report(i).encode() for i in range(5)]
+    conn.disconnect()
+
+
+def test_drain_stops_on_failure(tmp_path):
+    conn = FakeMqttConnection()
+    buffer = OfflineBuffer(str(tmp_path), sync=False)
+    buffer.append(TOPIC, report(0))
+    conn.interrupt()
+
+    assert buffer.drain(lambda topic, payload: conn.publish(topic, payload, qos=1)[0]) == 0
+    assert len(buffer) == 1
+    conn.disconnect()
+
+
+def test_buffered_publisher_outage(tmp_path):
+    publisher = BufferedPublisher(None, OfflineBuffer(str(tmp_path), sync=False), drain_rate=None)
+    conn = FakeMqttConnection(on_connection_interrupted=lambda **kwargs: publisher.interrupted(),
+                              on_connection_resumed=lambda **kwargs: publisher.resumed())
+    publisher._publish = lambda topic, payload: conn.publish(topic, payload, qos=1)[0]
+
+    publisher.publish(TOPIC, report(0)).result(timeout=1)
+    conn.interrupt()
+    for i in range(1, 4):
+        assert publisher.publish(TOPIC, report(i)) is None
+    assert len(publisher.buffer) == 3
+    conn.resume()
+    publisher._drainer.join(timeout=5)
+    publisher.publish(TOPIC, report(4)).result(timeout=1)
+
+    assert len(publisher.buffer) == 0
+    assert [bytes(payload, 'utf-8') if isinstance(payload, str) else payload
+            for _, payload in conn.published] == [report(i).encode() for i in range(5)]
+    publisher.close()
+    conn.disconnect()
+
+
+def test_buffered_publisher_failed_publish_is_kept(tmp_path):
+    conn = FakeMqttConnection()
+    publisher = BufferedPublisher(lambda topic, payload: conn.publish(topic, payload, qos=1)[0],
+                                  OfflineBuffer(str(tmp_path), sync=False), drain_rate=None)
+    # the connection drops before the agent is told
+    conn.connected = False
+
+    future = publisher.publish(TOPIC, report(0))
+    assert future.exception() is not None
+    assert len(publisher.buffer) == 1
+    publisher.close()
+    conn.disconnect()
+
+
+def test_buffered_publisher_single_drainer(tmp_path):
+    class SlowPublisher(BufferedPublisher):
+        @property
+        def draining(self):
+            draining = super(SlowPublisher, self).draining
+            # widen the window between the check and the drainer start
+            time.sleep(0.01)
+            return draining
+
+    conn = FakeMqttConnection()
+    release = threading.Event()
+
+    def publish(topic, payload):
+        release.wait()
+        return conn.publish(topic, payload, qos=1)[0]
+
+    publisher = SlowPublisher(publish, OfflineBuffer(str(tmp_path), sync=False), drain_rate=None)
+    publisher.interrupted()
+    for i in range(3):
+        publisher.publish(TOPIC, report(i))
+    publisher.connected = True
+
+    starters = [threading.Thread(target=publisher._start_drain) for _ in range(4)]
+    for starter in starters:
+        starter.start()
+    for starter in starters:
+        starter.join()
+    assert [thread.name for thread in threading.enumerate()].count("offline-buffer-drain") == 1
+    release.set()
+    publisher._drainer.join(timeout=5)
+
+    assert [payload for _, payload in conn.published] == [report(i).encode() for i in range(3)]
+    publisher.close()
+    conn.disconnect()
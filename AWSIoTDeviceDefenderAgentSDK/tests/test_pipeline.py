@@ -0,0 +1,158 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import itertools
+import json
+import time
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import metrics
+from AWSIoTDeviceDefenderAgentSDK.fakemqtt import FakeMqttConnection
+from AWSIoTDeviceDefenderAgentSDK.pipeline import PublishPipeline
+
+TOPIC = "$aws/things/thing/defender/metrics/json"
+
+
+@pytest.fixture
+def connection():
+    conn = FakeMqttConnection()
+    yield conn
+    conn.disconnect()
+
+
+def publish_to(connection):
+    def publish(topic, payload):
+        future, _ = connection.publish(topic, payload, qos=0)
+        return future
+    return publish
+
+
+def test_fake_connection_completes_after_latency():
+    conn = FakeMqttConnection(latency=0.05)
+    start = time.monotonic()
+    future, packet_id = conn.publish(TOPIC, bytearray(b"payload"), qos=0)
+
+    assert future.result(timeout=1) == {'packet_id': packet_id}
+    assert time.monotonic() - start >= 0.05
+    assert conn.published == [(TOPIC, b"payload")]
+    conn.disconnect()
+
+
+def test_publishes_every_report(connection):
+    counter = itertools.count()
+    first = []
+
+    def serialize(report):
+        if not first:
+            first.append(report)
+            return None
+        return TOPIC, report.to_json_string()
+
+    def collect():
+        m = metrics.Metrics()
+        m.add_cpu_usage(next(counter))
+        return m
+
+    p = PublishPipeline(collect, serialize, publish_to(connection), interval=0.001)
+    p.run(samples=5)
+
+    assert p.stats.collected == 5
+    assert p.stats.skipped == 1
+    assert p.stats.completed == 4
+    assert p.stats.in_flight == 0
+    usages = [json.loads(payload)["custom_metrics"]["cpu_usage"][0]["number"] for _, payload in connection.published]
+    assert usages == [1, 2, 3, 4]
+
+
+def test_publishes_every_message_of_a_list(connection):
+    things = ["a", "b", "c"]
+
+    def serialize(report):
+        return [("$aws/things/{}/defender/metrics/json".format(thing), report) for thing in things]
+
+    p = PublishPipeline(lambda: "{}", serialize, publish_to(connection), interval=0.001,
+                        queue_size=2 * len(things))
+    p.run(samples=2)
+
+    assert p.stats.completed == 6
+    assert p.stats.dropped == 0
+    assert [topic.split("/")[2] for topic, _ in connection.published] == things * 2
+
+
+def test_slow_publish_does_not_delay_sampling():
+    conn = FakeMqttConnection(latency=0.25)
+    collected_at = []
+
+    def collect():
+        collected_at.append(time.monotonic())
+        return len(collected_at)
+
+    p = PublishPipeline(collect, lambda report: (TOPIC, str(report)), publish_to(conn), interval=0.02,
+                        queue_size=1, max_in_flight=1)
+    p.start(samples=10)
+    time.sleep(0.4)
+
+    assert len(collected_at) == 10
+    p.join()
+    assert p.stats.dropped > 0
+    # the freshest report is never dropped
+    assert conn.published[-1] == (TOPIC, "10")
+    conn.disconnect()
+
+
+def test_cadence_does_not_drift(clock):
+    collected_at = []
+
+    def collect():
+        collected_at.append(clock())
+        clock.now += 3.5  # work
+
+    p = PublishPipeline(collect, lambda report: None, lambda topic, payload: None, interval=10,
+                        clock=clock, sleep=clock.sleep)
+    p.run(samples=6)
+
+    # collections start on multiples of the interval, instead of an interval after the previous one ended
+    assert collected_at == [pytest.approx(1000.0 + tick * 10) for tick in range(6)]
+    assert clock.sleeps == [pytest.approx(6.5)] * 5
+    assert p.stats.missed == 0
+
+
+def test_errors_do_not_stop_the_pipeline(connection):
+    calls = itertools.count()
+
+    def collect():
+        if next(calls) % 2:
+            raise OSError("collection failed")
+        return "report"
+
+    def failing_publish(topic, payload):
+        raise RuntimeError("not connected")
+
+    p = PublishPipeline(collect, lambda report: (TOPIC, report), failing_publish, interval=0.001)
+    p.run(samples=6)
+
+    assert p.stats.collected == 3
+    assert p.stats.errors == 3
+    assert p.stats.failed == 3
+    assert p.stats.in_flight == 0
+
+
+def test_stop_drains_collected_reports(connection):
+    p = PublishPipeline(lambda: "report", lambda report: (TOPIC, report), publish_to(connection), interval=0.01)
+    p.start()
+    time.sleep(0.05)
+    p.stop()
+
+    assert p.stats.collected > 0
+    assert p.stats.completed + p.stats.dropped == p.stats.collected
+    assert len(connection.published) == p.stats.completed
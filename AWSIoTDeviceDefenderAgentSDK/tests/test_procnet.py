@@ -0,0 +1,224 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import socket
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import collector, procnet
+
+if sys.version_info >= (3, 3):
+    from unittest import mock
+else:
+    import mock
+
+TCP_HEADER = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+TCP6_HEADER = ("  sl  local_address                         remote_address                        "
+               "st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n")
+ROW_TAIL = " 00000000:00000000 00:00000000 00000000     0        0 1000 1 0000000000000000 100 0 0 10 0\n"
+
+# Addresses are little-endian, as written by the kernel on x86 and ARM
+PROC_NET = {
+    "tcp": "".join((TCP_HEADER,
+                    "   0: 0100007F:0050 00000000:0000 0A" + ROW_TAIL,
+                    "   1: 0100000A:D431 0101010B:01BB 01" + ROW_TAIL,
+                    "   2: 0100000A:D432 0101010B:01BB 06" + ROW_TAIL)),
+    "tcp6": "".join((
+        TCP6_HEADER,
+        "   0: 00000000000000000000000000000000:0016 00000000000000000000000000000000:0000 0A" + ROW_TAIL,
+        "   1: 0000000000000000FFFF00000100000A:2328 0000000000000000FFFF00000201000B:C350 01" + ROW_TAIL)),
+    "udp": TCP_HEADER + "   0: 00000000:0044 00000000:0000 07" + ROW_TAIL,
+    "dev": "Inter-|   Receive                                                |  Transmit\n"
+    " face |bytes    packets errs drop fifo frame compressed multicast|"
+    "bytes    packets errs drop fifo colls carrier compressed\n"
+    "    lo:    1000      10    0    0    0     0          0         0"
+    "     1000      10    0    0    0     0       0          0\n"
+    "  eth0:  500000     400    0    0    0     0          0         0"
+    "    20000     300    0    0    0     0       0          0\n",
+    # 172.16.0.1 is only covered by the default route, its interface is unknown
+    "fib_trie": "Main:\n"
+    "  +-- 0.0.0.0/0 3 0 5\n"
+    "     |-- 0.0.0.0\n"
+    "        /0 universe UNICAST\n"
+    "     +-- 10.0.0.0/24 2 0 2\n"
+    "        |-- 10.0.0.1\n"
+    "           /32 host LOCAL\n"
+    "     |-- 127.0.0.1\n"
+    "        /32 host LOCAL\n"
+    "     |-- 172.16.0.1\n"
+    "        /32 host LOCAL\n"
+    "Local:\n"
+    "  +-- 0.0.0.0/0 3 0 5\n"
+    "     +-- 10.0.0.0/24 2 0 2\n"
+    "        |-- 10.0.0.1\n"
+    "           /32 host LOCAL\n",
+    "route": "Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n"
+    "eth0\t00000000\t0100000A\t0003\t0\t0\t0\t00000000\t0\t0\t0\n"
+    "eth0\t0000000A\t00000000\t0001\t0\t0\t0\t00FFFFFF\t0\t0\t0\n",
+    "if_inet6": "00000000000000000000000000000001 01 80 10 80       lo\n"
+    "fe800000000000000000000000000001 02 40 20 80     eth0\n",
+}
+
+
+@pytest.fixture()
+def procfs(tmp_path):
+    net = tmp_path / "net"
+    net.mkdir()
+    for name, content in PROC_NET.items():
+        (net / name).write_text(content)
+    return str(tmp_path)
+
+
+def test_parse_proc_net(procfs):
+    conns = list(procnet.ProcNetReader(procfs).net_connections())
+
+    assert len(conns) == 6
+    assert conns[0] == procnet.sconn(socket.AF_INET, socket.SOCK_STREAM,
+                                     procnet.addr("127.0.0.1", 80), (), "LISTEN")
+    assert conns[1] == procnet.sconn(socket.AF_INET, socket.SOCK_STREAM,
+                                     procnet.addr("10.0.0.1", 54321), procnet.addr("11.1.1.1", 443), "ESTABLISHED")
+    assert conns[2].status == "TIME_WAIT"
+    assert conns[3] == procnet.sconn(socket.AF_INET6, socket.SOCK_STREAM,
+                                     procnet.addr("::", 22), (), "LISTEN")
+    assert conns[4] == procnet.sconn(socket.AF_INET6, socket.SOCK_STREAM, procnet.addr("::ffff:10.0.0.1", 9000),
+                                     procnet.addr("::ffff:11.0.1.2", 50000), "ESTABLISHED")
+    # udp6 is missing, as on hosts with IPv6 disabled
+    assert conns[5] == procnet.sconn(socket.AF_INET, socket.SOCK_DGRAM,
+                                     procnet.addr("0.0.0.0", 68), (), "NONE")
+
+
+def test_parse_across_buffer_boundaries(procfs):
+    reader = procnet.ProcNetReader(procfs)
+    reader._buffer = bytearray(7)
+
+    assert list(reader.net_connections()) == list(procnet.ProcNetReader(procfs).net_connections())
+
+
+def test_net_io_counters(procfs):
+    assert procnet.net_io_counters(procfs, pernic=True) == {
+        "lo": procnet.snetio(bytes_sent=1000, bytes_recv=1000, packets_sent=10, packets_recv=10),
+        "eth0": procnet.snetio(bytes_sent=20000, bytes_recv=500000, packets_sent=300, packets_recv=400)}
+    assert procnet.net_io_counters(procfs) == procnet.snetio(21000, 501000, 310, 410)
+
+
+def test_net_if_addrs(procfs, tmp_path):
+    if_addrs = procnet.net_if_addrs(procfs)
+
+    assert if_addrs == {
+        "lo": [procnet.snicaddr(socket.AF_INET6, "::1", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff", None, None),
+               procnet.snicaddr(socket.AF_INET, "127.0.0.1", "255.0.0.0", None, None)],
+        "eth0": [procnet.snicaddr(socket.AF_INET6, "fe80::1", "ffff:ffff:ffff:ffff::", None, None),
+                 procnet.snicaddr(socket.AF_INET, "10.0.0.1", "255.255.255.0", None, None)]}
+    assert procnet.net_if_addrs(str(tmp_path / "missing")) == {}
+
+
+def test_available(procfs, tmp_path):
+    assert procnet.available(procfs)
+    assert not procnet.available(str(tmp_path / "missing"))
+
+
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_io_counters")
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_connections")
+def test_collector_procfs_backend(mock_net_connections, mock_io_counters, procfs):
+    with mock.patch.object(collector.ps, "PROCFS_PATH", procfs):
+        coll = collector.Collector(use_custom_metrics=False, backend=collector.BACKEND_PROCFS)
+        assert coll.backend == collector.BACKEND_PROCFS
+        metrics_output = coll.collect_metrics()
+
+    assert not mock_net_connections.called
+    assert [p["port"] for p in metrics_output.listening_ports("TCP")] == [80, 22]
+    assert [p["port"] for p in metrics_output.listening_ports("UDP")] == [68]
+    assert [c["remote_addr"] for c in metrics_output.network_connections] == ["11.1.1.1:443",
+                                                                              "[::ffff:11.0.1.2]:50000"]
+
+
+def test_collector_procfs_backend_fallback(tmp_path):
+    with mock.patch.object(collector.ps, "PROCFS_PATH", str(tmp_path)):
+        coll = collector.Collector(backend=collector.BACKEND_PROCFS)
+
+    assert coll.backend == collector.BACKEND_PSUTIL
+
+
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_io_counters")
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_connections")
+def test_collector_procfs_path(mock_net_connections, mock_io_counters, procfs):
+    coll = collector.Collector(use_custom_metrics=False, backend=collector.BACKEND_SOCK_DIAG, procfs_path=procfs)
+    assert coll.backend == collector.BACKEND_PROCFS
+    coll.collect_metrics()
+    metrics_output = coll.collect_metrics()
+
+    assert not mock_net_connections.called
+    assert not mock_io_counters.called
+    assert [p["port"] for p in metrics_output.listening_ports("TCP")] == [80, 22]
+    # counters are unchanged since the previous collection
+    assert metrics_output.network_stats["bytes_in"] == 0
+
+
+def test_collector_unreadable_procfs_path(tmp_path):
+    with pytest.raises(ValueError):
+        collector.Collector(procfs_path=str(tmp_path))
+
+
+snicaddr = namedtuple("snicaddr", "family address netmask broadcast ptp")
+
+
+def collected(metrics_output):
+    return (metrics_output.listening_ports("TCP"), metrics_output.listening_ports("UDP"),
+            metrics_output.network_connections, metrics_output.network_stats)
+
+
+@pytest.fixture(params=["processes", "injected"])
+def process_pool(request):
+    """No pool, for the collector to create its own, or a thread pool injected into it."""
+    if request.param == "processes":
+        yield None
+        return
+    pool = ThreadPoolExecutor(2)
+    yield pool
+    pool.shutdown()
+
+
+# the agent's own addresses, which must not be used to resolve the interfaces of another namespace
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_if_addrs",
+            return_value={"wlan0": [snicaddr(socket.AF_INET, "10.0.0.1", None, None, None)]})
+def test_collector_parallel_matches_sequential(mock_if_addrs, process_pool, procfs):
+    sequential = collector.Collector(use_custom_metrics=False, procfs_path=procfs)
+    parallel = collector.Collector(use_custom_metrics=False, procfs_path=procfs, parallel=True,
+                                   process_pool=process_pool)
+    try:
+        for _ in range(2):
+            expected = collected(sequential.collect_metrics())
+            assert collected(parallel.collect_metrics()) == expected
+    finally:
+        parallel.close()
+
+    assert not mock_if_addrs.called
+    assert expected[0] == [{"port": 80, "interface": "lo"}, {"port": 22, "interface": "::"}]
+    assert [c["local_interface"] for c in expected[2]] == ["eth0", "eth0"]
+
+
+def test_collector_invalid_backend():
+    with pytest.raises(ValueError):
+        collector.Collector(backend="bogus")
+
+
+def test_collector_per_interface(procfs):
+    coll = collector.Collector(use_custom_metrics=False, procfs_path=procfs, per_interface=True)
+    first = coll.collect_metrics()
+    second = coll.collect_metrics()
+
+    assert first.total_counts == (501000, 21000, 410, 310)
+    assert second.interface_stats == {"eth0": (0, 0, 0, 0), "lo": (0, 0, 0, 0)}
+    assert second.network_stats["bytes_in"] == 0
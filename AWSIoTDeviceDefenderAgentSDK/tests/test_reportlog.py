@@ -0,0 +1,119 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import os
+
+import cbor
+
+from AWSIoTDeviceDefenderAgentSDK import metrics
+from AWSIoTDeviceDefenderAgentSDK.reportlog import INDEX_ENTRY, INDEX_SUFFIX, ReportLog, ReportLogReader
+
+
+def payload(report_id):
+    return cbor.dumps({"header": {"report_id": report_id, "version": "1.0"}, "metrics": {}})
+
+
+def write_log(path, report_ids, thing_name="thing"):
+    log = ReportLog(path)
+    for report_id in report_ids:
+        log.append(report_id, payload(report_id), thing_name)
+    log.close()
+
+
+def test_append_and_read(tmp_path):
+    path = str(tmp_path / "reports.log")
+    m = metrics.Metrics()
+    m.add_network_connection("11.0.0.1", 443, "eth0", 50000)
+    log = ReportLog(path)
+    log.append(m.report_id, m.to_cbor(), "web-1")
+    log.append(m.report_id + 300, payload(m.report_id + 300), "web-2")
+    assert len(log) == 2
+    log.close()
+
+    with ReportLogReader(path) as reader:
+        records = list(reader)
+        assert [r.report_id for r in records] == [m.report_id, m.report_id + 300]
+        assert [r.thing_name for r in records] == ["web-1", "web-2"]
+        assert records[0].payload == bytes(m.to_cbor())
+        assert records[0].report() == cbor.loads(m.to_cbor())
+
+
+def test_range_and_get(tmp_path):
+    path = str(tmp_path / "reports.log")
+    write_log(path, range(1000, 2000, 100))
+    write_log(path, [1500], "other")
+
+    with ReportLogReader(path) as reader:
+        assert len(reader) == 11
+        assert [r.report_id for r in reader.range(1200, 1500)] == [1200, 1300, 1400]
+        assert [r.report_id for r in reader.range(end=1150)] == [1000, 1100]
+        assert [r.report_id for r in reader.range(1850)] == [1900]
+        assert sorted(r.thing_name for r in reader.get(1500)) == ["other", "thing"]
+        assert reader.get(1550) == []
+
+
+def test_out_of_order_ids(tmp_path):
+    path = str(tmp_path / "reports.log")
+    # the clock was set back between the third and fourth report
+    write_log(path, [300, 400, 500, 100, 200])
+
+    with ReportLogReader(path) as reader:
+        assert [r.report_id for r in reader] == [300, 400, 500, 100, 200]
+        assert [r.report_id for r in reader.range(150, 450)] == [200, 300, 400]
+        assert [r.report()["header"]["report_id"] for r in reader.range()] == [100, 200, 300, 400, 500]
+
+
+def test_recovers_incomplete_record(tmp_path):
+    path = str(tmp_path / "reports.log")
+    write_log(path, [1, 2, 3])
+    complete = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b"\x40\x00\x00\x00partial")
+
+    with ReportLogReader(path) as reader:
+        assert [r.report_id for r in reader] == [1, 2, 3]
+
+    log = ReportLog(path)
+    assert os.path.getsize(path) == complete
+    log.append(4, payload(4))
+    log.close()
+    with ReportLogReader(path) as reader:
+        assert [r.report() for r in reader] == [cbor.loads(payload(i)) for i in (1, 2, 3, 4)]
+
+
+def test_rebuilds_missing_index_entries(tmp_path):
+    path = str(tmp_path / "reports.log")
+    write_log(path, [1, 2, 3, 4])
+    index_path = path + INDEX_SUFFIX
+    with open(index_path, "r+b") as f:
+        # a crash between writing the last record and its index entry, and a torn index entry
+        f.truncate(2 * INDEX_ENTRY.size + 5)
+
+    with ReportLogReader(path) as reader:
+        assert [r.report_id for r in reader] == [1, 2, 3, 4]
+
+    log = ReportLog(path)
+    assert len(log) == 4
+    log.close()
+    assert os.path.getsize(index_path) == 4 * INDEX_ENTRY.size
+
+    os.remove(index_path)
+    with ReportLogReader(path) as reader:
+        assert [r.report_id for r in reader.range(2, 4)] == [2, 3]
+
+
+def test_empty_log(tmp_path):
+    path = str(tmp_path / "logs" / "reports.log")
+    ReportLog(path).close()
+    with ReportLogReader(path) as reader:
+        assert len(reader) == 0
+        assert list(reader.range(0)) == []
@@ -0,0 +1,54 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK.scheduler import Scheduler
+
+
+def test_deadlines_do_not_drift(clock):
+    scheduler = Scheduler(10, clock=clock, sleep=clock.sleep)
+    scheduler.begin()
+
+    for tick in range(1, 6):
+        clock.now += 3.5  # work
+        assert scheduler.wait() == 0
+        assert clock.now == pytest.approx(1000.0 + tick * 10)
+    assert scheduler.missed == 0
+
+
+def test_missed_deadlines_are_skipped(clock):
+    scheduler = Scheduler(10, clock=clock, sleep=clock.sleep)
+    scheduler.begin()
+
+    clock.now += 25  # overruns the deadlines at 10 and 20
+    assert scheduler.wait() == 2
+    assert clock.now == pytest.approx(1030.0)
+    assert clock.sleeps[-1] == pytest.approx(5)
+
+    clock.now += 1
+    assert scheduler.wait() == 0
+    assert clock.now == pytest.approx(1040.0)
+    assert scheduler.missed == 2
+
+
+def test_first_wait_begins(clock):
+    scheduler = Scheduler(10, clock=clock, sleep=clock.sleep)
+
+    assert scheduler.wait() == 0
+    assert scheduler.start == 1000.0
+    assert clock.sleeps == []
+
+
+def test_invalid_interval():
+    with pytest.raises(ValueError):
+        Scheduler(0)
@@ -0,0 +1,151 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import socket
+import struct
+import sys
+from binascii import unhexlify
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import collector, sockdiag
+from AWSIoTDeviceDefenderAgentSDK.procnet import addr, sconn
+
+if sys.version_info >= (3, 3):
+    from unittest import mock
+else:
+    import mock
+
+# Responses recorded from a Linux 6.x kernel, one list of datagrams per dump request, with
+# a TCP listener on 127.0.0.1:8883 and a client connected to it, a TCP listener on [::1]:8443
+# and a UDP socket bound to 0.0.0.0:5353.
+TCP4_LISTEN = unhexlify(
+    "7c0000001400020001000000e1130000020a000022b300007f0000010000000000000000000000000000000000000000"
+    "000000000000000000000000090000000000000000000000000000008000000000000000ab2300000500080000000000"
+    "08000f00000000000c00150001000000000000000600160052000000"
+)
+TCP4_ESTABLISHED = unhexlify(
+    "7c0000001400020001000000e11300000201000022b385867f0000010000000000000000000000007f00000100000000"
+    "0000000000000000000000000a0000000000000000000000000000000000000000000000ad2300000500080000000000"
+    "08000f00000000000c00150001000000000000000600160052000000"
+)
+TCP6_LISTEN = unhexlify(
+    "840000001400020002000000e11300000a0a000020fb00000000000000000000000000000000000100000000000000000000"
+    "000000000000000000000c0000000000000000000000000000008000000000000000ae230000050008000000000005000b00"
+    "0100000008000f00000000000c00150001000000000000000600160012000000"
+)
+UDP4_BOUND = unhexlify(
+    "7c0000001400020003000000e11300000207000014e900000000000000000000000000000000000000000000000000000000"
+    "000000000000000000000d0000000000000000000000000000000000000000000000af230000050008000000000008000f00"
+    "000000000c00150001000000000000000600160050000000"
+)
+
+
+def done(seq):
+    return struct.pack("=IHHIIi", 20, sockdiag.NLMSG_DONE, 2, seq, 0x13e1, 0)
+
+
+RECORDED_DUMPS = [
+    [TCP4_LISTEN + TCP4_ESTABLISHED, done(1)],
+    [TCP6_LISTEN, done(2)],
+    [UDP4_BOUND + done(3)],
+    [done(4)],
+]
+
+
+class FakeNetlinkSocket(object):
+    """Replays recorded datagrams, one list per dump request sent."""
+
+    def __init__(self, dumps):
+        self.dumps = list(dumps)
+        self.requests = []
+        self.pending = []
+        self.closed = False
+
+    def sendto(self, data, address):
+        self.requests.append(data)
+        self.pending = list(self.dumps.pop(0))
+        return len(data)
+
+    def recv_into(self, buffer):
+        datagram = self.pending.pop(0)
+        buffer[:len(datagram)] = datagram
+        return len(datagram)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def fake_socket():
+    return FakeNetlinkSocket(RECORDED_DUMPS)
+
+
+def test_sock_diag_connections(fake_socket):
+    reader = sockdiag.SockDiagReader(socket_factory=lambda: fake_socket)
+
+    conns = list(reader.net_connections())
+
+    assert conns == [
+        sconn(socket.AF_INET, socket.SOCK_STREAM, addr("127.0.0.1", 8883), (), "LISTEN"),
+        sconn(socket.AF_INET, socket.SOCK_STREAM, addr("127.0.0.1", 8883), addr("127.0.0.1", 34182), "ESTABLISHED"),
+        sconn(socket.AF_INET6, socket.SOCK_STREAM, addr("::1", 8443), (), "LISTEN"),
+        sconn(socket.AF_INET, socket.SOCK_DGRAM, addr("0.0.0.0", 5353), (), "NONE"),
+    ]
+    assert fake_socket.closed
+
+
+def test_sock_diag_requests_filter_states(fake_socket):
+    list(sockdiag.SockDiagReader(socket_factory=lambda: fake_socket).net_connections())
+
+    assert len(fake_socket.requests) == 4
+    for request, (family, protocol, states) in zip(fake_socket.requests, sockdiag.DUMP_REQUESTS):
+        length, msg_type, flags, _, _ = sockdiag.NLMSG_HEADER.unpack_from(request)
+        assert length == len(request) == 72
+        assert msg_type == sockdiag.SOCK_DIAG_BY_FAMILY
+        assert flags == sockdiag.NLM_F_REQUEST | sockdiag.NLM_F_DUMP
+        assert struct.unpack_from("=BBBBI", request, 16) == (family, protocol, 0, 0, states)
+
+    tcp_states = struct.unpack_from("=I", fake_socket.requests[0], 20)[0]
+    assert tcp_states == (1 << 1) | (1 << 10)
+
+
+def test_sock_diag_error():
+    error = struct.pack("=IHHIIi", 36, sockdiag.NLMSG_ERROR, 0, 1, 0, -13) + b"\0" * 16
+    fake_socket = FakeNetlinkSocket([[error]])
+
+    with pytest.raises(OSError):
+        list(sockdiag.SockDiagReader(socket_factory=lambda: fake_socket).net_connections())
+    assert fake_socket.closed
+
+
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_if_addrs")
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_io_counters")
+@mock.patch("AWSIoTDeviceDefenderAgentSDK.collector.ps.net_connections")
+def test_collector_sock_diag_backend(mock_net_connections, mock_io_counters, mock_if_addrs, fake_socket):
+    mock_if_addrs.return_value = {}
+    with mock.patch.object(collector.sockdiag, "netlink_socket", lambda: fake_socket):
+        coll = collector.Collector(use_custom_metrics=False, backend=collector.BACKEND_SOCK_DIAG)
+        assert coll.backend == collector.BACKEND_SOCK_DIAG
+        metrics_output = coll.collect_metrics()
+
+    assert not mock_net_connections.called
+    assert [p["port"] for p in metrics_output.listening_ports("TCP")] == [8883, 8443]
+    assert [p["port"] for p in metrics_output.listening_ports("UDP")] == [5353]
+    assert [c["remote_addr"] for c in metrics_output.network_connections] == ["127.0.0.1:34182"]
+
+
+def test_collector_sock_diag_backend_fallback():
+    with mock.patch.object(collector.sockdiag, "available", lambda: False):
+        coll = collector.Collector(backend=collector.BACKEND_SOCK_DIAG)
+
+    assert coll.backend == collector.BACKEND_PSUTIL
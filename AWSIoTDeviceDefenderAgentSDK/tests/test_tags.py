@@ -0,0 +1,53 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import pickle
+
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import tags
+
+
+def test_tags_are_shared_per_mode():
+    assert tags.Tags() is tags.Tags(short_names=False)
+    assert tags.Tags(True) is tags.Tags(short_names=True)
+    assert tags.Tags() is not tags.Tags(True)
+
+
+def test_tag_names():
+    long_tags = tags.Tags()
+    short_tags = tags.Tags(short_names=True)
+
+    for name, tag in tags.Tags.NAMES:
+        if isinstance(tag, str):
+            assert getattr(long_tags, name) == getattr(short_tags, name) == tag
+        else:
+            assert getattr(long_tags, name) == tag[0]
+            assert getattr(short_tags, name) == tag[1]
+
+    assert long_tags.remote_addr == "remote_addr"
+    assert short_tags.remote_addr == "rad"
+    assert long_tags.interface_stats == "network_stats"
+    assert short_tags.cpu_usage == "cpu_usage"
+    assert not long_tags.short_names
+    assert short_tags.short_names
+
+
+def test_tags_are_immutable():
+    with pytest.raises(AttributeError):
+        tags.Tags().short_names = True
+    with pytest.raises(AttributeError):
+        tags.Tags().header = "hed"
+
+
+def test_tags_pickle_to_shared_instance():
+    assert pickle.loads(pickle.dumps(tags.Tags(True))) is tags.Tags(True)
@@ -0,0 +1,73 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+import pytest
+
+from AWSIoTDeviceDefenderAgentSDK import targets
+from AWSIoTDeviceDefenderAgentSDK.targets import MultiCollector, Target, parse_target
+from AWSIoTDeviceDefenderAgentSDK.tests.test_procnet import PROC_NET, ROW_TAIL, TCP_HEADER
+
+
+def make_procfs(directory, listening_port):
+    net = directory / "net"
+    net.mkdir(parents=True)
+    (net / "tcp").write_text(TCP_HEADER + "   0: 0100007F:%04X 00000000:0000 0A" % listening_port + ROW_TAIL)
+    (net / "dev").write_text(PROC_NET["dev"])
+    return str(directory)
+
+
+def test_parse_target():
+    assert parse_target("web-1=/proc/4242") == Target("web-1", "/proc/4242")
+    assert parse_target("web-1") == Target("web-1", None)
+    assert parse_target(" web-1 = ") == Target("web-1", None)
+    with pytest.raises(ValueError):
+        parse_target("=/proc/4242")
+
+
+def test_collects_each_target_from_its_procfs(tmp_path):
+    multi = MultiCollector([Target("a", make_procfs(tmp_path / "a", 80)),
+                            Target("b", make_procfs(tmp_path / "b", 8080)),
+                            Target("c", make_procfs(tmp_path / "c", 443))],
+                           workers=2, use_custom_metrics=False)
+    try:
+        multi.collect_metrics()
+        reports = multi.collect_metrics()
+    finally:
+        multi.close()
+
+    assert [target.thing_name for target, _ in reports] == ["a", "b", "c"]
+    assert [[p["port"] for p in report.listening_ports("TCP")] for _, report in reports] == [[80], [8080], [443]]
+    # each target computes deltas from its own previous report
+    assert all(report.network_stats["bytes_in"] == 0 for _, report in reports)
+
+
+def test_failed_target_is_left_out(tmp_path):
+    broken = make_procfs(tmp_path / "broken", 22)
+    multi = MultiCollector([Target("ok", make_procfs(tmp_path / "ok", 80)), Target("broken", broken)],
+                           use_custom_metrics=False)
+    (tmp_path / "broken" / "net" / "dev").unlink()
+    try:
+        reports = multi.collect_metrics()
+    finally:
+        multi.close()
+
+    assert [target.thing_name for target, _ in reports] == ["ok"]
+
+
+def test_duplicate_thing_names(tmp_path):
+    with pytest.raises(ValueError):
+        MultiCollector([Target("a", None), Target("a", None)])
+
+
+def test_unreadable_procfs(tmp_path):
+    with pytest.raises(ValueError):
+        targets.MultiCollector([Target("a", str(tmp_path))])
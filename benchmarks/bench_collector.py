@@ -0,0 +1,173 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Per-cycle cost of socket enumeration in the collector.
+
+Run from the repository root against the live host::
+
+    python -m benchmarks.bench_collector
+
+or against a synthetic socket table of a given size::
+
+    python -m benchmarks.bench_collector --synthetic 20000
+
+Sequential and parallel collection cycles are compared on a synthetic ``/proc/net`` of a given size with::
+
+    python -m benchmarks.bench_collector --parallel 200000
+
+On Linux, the live run also compares socket enumeration by psutil with the procfs and sock_diag backends.
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import timeit
+from collections import namedtuple
+from unittest import mock
+
+import psutil
+
+from AWSIoTDeviceDefenderAgentSDK import collector, metrics, procnet, sockdiag
+
+addr = namedtuple("addr", "ip port")
+sconn = namedtuple("sconn", "fd family type laddr raddr status pid")
+snicaddr = namedtuple("snicaddr", "family address netmask broadcast ptp")
+
+
+def synthetic_net_connections(count):
+    """Build a psutil-like ``net_connections`` replacement that pays a per-socket cost on every call."""
+
+    def net_connections(kind='inet'):
+        conns = []
+        for i in range(count):
+            if i % 10 == 0:
+                conns.append(sconn(-1, socket.AF_INET, socket.SOCK_DGRAM,
+                                   addr("10.0.0.1", 1024 + i % 60000), (), psutil.CONN_NONE, None))
+            elif i % 10 == 1:
+                conns.append(sconn(-1, socket.AF_INET, socket.SOCK_STREAM,
+                                   addr("10.0.0.1", 1024 + i % 60000), (), psutil.CONN_LISTEN, None))
+            else:
+                conns.append(sconn(-1, socket.AF_INET, socket.SOCK_STREAM,
+                                   addr("10.0.0.1", 1024 + i % 60000),
+                                   addr("11.0.%d.%d" % (i // 256 % 256, i % 256), 443),
+                                   psutil.CONN_ESTABLISHED, None))
+        return conns
+
+    return net_connections
+
+
+def synthetic_net_if_addrs():
+    return {"lo": [snicaddr(socket.AF_INET, "127.0.0.1", None, None, None)],
+            "eth0": [snicaddr(socket.AF_INET, "10.0.0.1", None, None, None)]}
+
+
+def two_pass_cycle(coll):
+    """The pre-snapshot behaviour: every metric family enumerates sockets on its own."""
+    m = metrics.Metrics()
+    coll.listening_ports(m)
+    coll.network_connections(m)
+
+
+def snapshot_cycle(coll):
+    m = metrics.Metrics()
+    snapshot = collector.SocketSnapshot.take()
+    coll.listening_ports(m, snapshot)
+    coll.network_connections(m, snapshot)
+
+
+def run(cycles):
+    coll = collector.Collector()
+    for name, fn in (("two-pass", two_pass_cycle), ("snapshot", snapshot_cycle)):
+        best = min(timeit.repeat(lambda: fn(coll), number=cycles, repeat=3)) / cycles
+        print("{:<10} {:10.2f} ms/cycle".format(name, best * 1000))
+
+
+def run_backends(cycles):
+    reader = procnet.ProcNetReader(psutil.PROCFS_PATH)
+    enumerators = [("psutil", lambda: list(psutil.net_connections(kind='inet'))),
+                   ("procfs", lambda: list(reader.net_connections()))]
+    if sockdiag.available():
+        diag = sockdiag.SockDiagReader()
+        enumerators.append(("sock_diag", lambda: list(diag.net_connections())))
+    print("{} sockets".format(len(psutil.net_connections(kind='inet'))))
+    for name, fn in enumerators:
+        best = min(timeit.repeat(fn, number=cycles, repeat=3)) / cycles
+        print("{:<10} {:10.2f} ms/enumeration".format(name, best * 1000))
+
+
+def synthetic_procfs(directory, count):
+    """Write ``count`` sockets, spread over the four ``/proc/net`` socket tables, and interface counters."""
+    net = os.path.join(directory, "net")
+    os.mkdir(net)
+    header = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+    tail = " 00000000:00000000 00:00000000 00000000     0        0 1000 1 0000000000000000 100 0 0 10 0\n"
+    for index, (name, family, _) in enumerate(procnet.PROC_NET_FILES):
+        with open(os.path.join(net, name), "w") as f:
+            f.write(header)
+            for i in range(index, count, len(procnet.PROC_NET_FILES)):
+                port = 1024 + i % 60000
+                if family == socket.AF_INET:
+                    local, remote = "0100000A:%04X" % port, "%08X:01BB" % (0x0B000000 + i)
+                else:
+                    local = "0000000000000000FFFF00000100000A:%04X" % port
+                    remote = "0000000000000000FFFF0000%08X:01BB" % (0x0B000000 + i)
+                status = "0A" if i % 10 == 0 else "01"
+                f.write("%6d: %s %s %s%s" % (i, local, remote, status, tail))
+    with open(os.path.join(net, "dev"), "w") as f:
+        f.write("Inter-|   Receive\n face |bytes\n")
+        f.write("  eth0: 1000 10 0 0 0 0 0 0 2000 20 0 0 0 0 0 0\n")
+
+
+def run_parallel(count, cycles):
+    directory = tempfile.mkdtemp()
+    try:
+        synthetic_procfs(directory, count)
+        print("{} sockets, {} CPUs".format(count, os.cpu_count()))
+        for name, parallel in (("sequential", False), ("parallel", True)):
+            coll = collector.Collector(procfs_path=directory, parallel=parallel)
+            try:
+                coll.collect_metrics()
+                best = min(timeit.repeat(coll.collect_metrics, number=cycles, repeat=3)) / cycles
+            finally:
+                coll.close()
+            print("{:<10} {:10.2f} ms/cycle".format(name, best * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Number of synthetic sockets, omit to benchmark the live host")
+    parser.add_argument("--parallel", type=int, default=0,
+                        help="Compare sequential and parallel collection over this many synthetic procfs sockets")
+    parser.add_argument("--cycles", type=int, default=5, help="Collection cycles per measurement")
+    args = parser.parse_args()
+
+    if args.parallel:
+        run_parallel(args.parallel, args.cycles)
+    elif args.synthetic:
+        with mock.patch.object(collector.ps, "net_connections", synthetic_net_connections(args.synthetic)), \
+                mock.patch.object(collector.ps, "net_if_addrs", synthetic_net_if_addrs):
+            run(args.cycles)
+    else:
+        run(args.cycles)
+        if procnet.available(psutil.PROCFS_PATH):
+            run_backends(args.cycles)
+
+
+if __name__ == '__main__':
+    main()
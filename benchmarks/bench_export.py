@@ -0,0 +1,100 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Bytes per report and encode CPU time of the export encodings, for single reports and batches.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_export
+"""
+
+import argparse
+import random
+import time
+import timeit
+
+from AWSIoTDeviceDefenderAgentSDK import export, metrics
+
+BATCH_SIZES = (1, 16)
+
+
+def build_reports(count, connections, short_names, seed=1):
+    """Reports of one gateway over ``count`` cycles, talking to a stable set of remote hosts."""
+    rng = random.Random(seed)
+    hosts = ["%d.%d.%d.%d" % (rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+             for _ in range(connections // 2)]
+    reports = []
+    for _ in range(count):
+        m = metrics.Metrics(short_names=short_names)
+        for i in range(connections):
+            m.add_network_connection(rng.choice(hosts), rng.choice((443, 8883, 80)), "eth0", rng.randint(32768, 60999))
+        m.add_listening_ports("TCP", [{"port": port, "interface": "eth0"} for port in (22, 80, 443)])
+        m.add_listening_ports("UDP", [{"port": 68}])
+        m.add_network_stats(rng.randint(0, 10 ** 9), rng.randint(0, 10 ** 9), rng.randint(0, 10 ** 6),
+                            rng.randint(0, 10 ** 6))
+        m.add_cpu_usage(rng.random() * 100)
+        reports.append(m)
+    return reports
+
+
+def uncached(encoder, batch):
+    """Drop the cached samples and reports, so every run renders from the stored records."""
+    def run():
+        for m in batch:
+            m._samples = m._report = None
+        return encoder.encode_batch(batch)
+    return run
+
+
+def options():
+    compressions = [export.COMPRESSION_NONE, export.COMPRESSION_ZLIB]
+    if export.zstandard is not None:
+        compressions.append(export.COMPRESSION_ZSTD)
+    for payload_format in metrics.FORMATS:
+        for compression in compressions:
+            dictionaries = (b"", None) if compression != export.COMPRESSION_NONE else (b"",)
+            for dictionary in dictionaries:
+                for intern in (False, True):
+                    yield payload_format, compression, dictionary, intern
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--short-tags", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    reports = build_reports(max(BATCH_SIZES), args.connections, args.short_tags)
+    baseline = len(reports[0].to_json_string())
+    print("{} connections per report, to_json_string {} bytes".format(args.connections, baseline))
+    if export.zstandard is None:
+        print("zstandard is not installed, zstd is skipped")
+
+    for batch_size in BATCH_SIZES:
+        batch = reports[:batch_size]
+        print("\nbatches of {} reports".format(batch_size))
+        for payload_format, compression, dictionary, intern in options():
+            encoder = export.ExportEncoder(payload_format, compression, dictionary, intern=intern)
+            size = len(encoder.encode_batch(batch)) / float(batch_size)
+            cpu = min(timeit.repeat(uncached(encoder, batch), timer=time.process_time,
+                                    number=20, repeat=args.repeat)) / 20 / batch_size
+            name = "{} {}{}{}".format(payload_format, compression, " +dict" if dictionary is None else "",
+                                      " +intern" if intern else "")
+            print("{:<28} {:8.0f} bytes/report {:6.1%} {:9.1f} us/report".format(
+                name, size, size / baseline, cpu * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Cost of building a metrics report with many connections and listening ports.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_metrics
+"""
+
+import argparse
+import timeit
+import tracemalloc
+from ipaddress import ip_address, IPv4Address
+
+from AWSIoTDeviceDefenderAgentSDK import metrics, tags
+
+SIZES = (10, 1000, 50000)
+# The list-scan deduplication this replaced is quadratic, so it is only measured on smaller inputs
+LEGACY_MAX_SIZE = 5000
+
+
+def connections(count):
+    return [("11.0.%d.%d" % (i // 256 % 256, i % 256), 443, "eth0", 1024 + i % 60000) for i in range(count)]
+
+
+def ports(count):
+    return [{'port': i % 65536, 'interface': "eth%d" % (i // 65536)} for i in range(count)]
+
+
+def add_entries(conns, port_list):
+    m = metrics.Metrics()
+    for conn in conns:
+        m.add_network_connection(*conn)
+    m.add_listening_ports("TCP", port_list)
+    return m
+
+
+def legacy_add_entries(conns, port_list):
+    """Deduplication by scanning a list of dictionaries, as done before RecordSet."""
+    net_connections = []
+    for remote_addr, remote_port, interface, local_port in conns:
+        if type(ip_address(remote_addr)) is not IPv4Address:
+            remote_addr = "[" + remote_addr + "]"
+        new_conn = {'remote_addr': remote_addr + ":" + str(remote_port),
+                    'local_interface': interface,
+                    'local_port': local_port}
+        if new_conn not in net_connections:
+            net_connections.append(new_conn)
+    listening_ports = []
+    for p in port_list:
+        if p not in listening_ports:
+            listening_ports.append(p)
+
+
+def legacy_connection_dicts(conns):
+    """Connections stored as tag-keyed dictionaries with a pre-formatted address, as done before records."""
+    return [{'remote_addr': remote_addr + ":" + str(remote_port),
+             'local_interface': interface,
+             'local_port': local_port} for remote_addr, remote_port, interface, local_port in conns]
+
+
+def connection_records(conns):
+    return metrics.RecordSet(metrics.Connection(*conn) for conn in conns)
+
+
+def allocated(fn, arg):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn(arg)
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def measure_memory(count):
+    # Copy the strings, so the inputs are not shared with the structures being measured
+    conns = [("".join(ip), port, "".join(iface), lport) for ip, port, iface, lport in connections(count)]
+    print("\nmemory per {} connections".format(count))
+    for name, fn in (("dicts", legacy_connection_dicts), ("records", connection_records)):
+        size = allocated(fn, conns)
+        print("{:<10} {:10.1f} KiB {:8.1f} bytes/entry".format(name, size / 1024.0, size / float(count)))
+
+
+class LegacyTags(object):
+    """Tag lookup through a property and a mode branch on every access, as done before the shared tables."""
+
+    def __init__(self, short_names=False):
+        self.short_names = short_names
+
+    def get(self, tag):
+        if self.short_names:
+            return tag[1]
+        else:
+            return tag[0]
+
+    @property
+    def remote_addr(self):
+        return self.get(tags.Tags.REMOTE_ADDR)
+
+    @property
+    def local_interface(self):
+        return self.get(tags.Tags.LOCAL_INTERFACE)
+
+    @property
+    def local_port(self):
+        return self.get(tags.Tags.LOCAL_PORT)
+
+
+def measure_tags(count, repeat):
+    m = metrics.Metrics()
+    records = [metrics.Connection(*conn) for conn in connections(count)]
+    print("\nrendering {} connections".format(count))
+    for name, t in (("properties", LegacyTags()), ("tables", tags.Tags())):
+        m.t = t
+        best = measure(lambda: [m._connection_dict(c) for c in records], repeat)
+        print("{:<10} {:10.2f} ms {:8.3f} us/connection".format(name, best * 1000, best * 1e6 / count))
+
+
+def measure_steady_state(count, repeat):
+    """Render a report whose connections are the same as the previous report's, sampled and unsampled."""
+    print("\nsteady state report of {} connections".format(count))
+    conns = connections(count)
+    for max_list_size in (50, None):
+        previous = metrics.Metrics()
+        previous.max_list_size = max_list_size
+        for conn in conns:
+            previous.add_network_connection(*conn)
+        previous._v1_metrics()
+
+        for name, last_metric in (("cold", None), ("unchanged", previous)):
+            m = metrics.Metrics(last_metric=last_metric)
+            m.max_list_size = max_list_size
+            for conn in conns:
+                m.add_network_connection(*conn)
+
+            def render():
+                m._samples = m._rendered = m._report = None
+                return m._v1_metrics()
+            best = measure(render, repeat)
+            print("max_list_size={:<5} {:<10} {:10.3f} ms".format(str(max_list_size), name, best * 1000))
+
+
+def measure_interface_stats(count, repeat):
+    """Per-interface deltas of ``count`` interfaces, a tenth of which are replaced between readings."""
+    print("\ninterface stats of {} interfaces".format(count))
+    first = {"veth%d" % i: metrics.NetworkStats(i * 1000, i * 500, i * 10, i * 5) for i in range(count)}
+    second = {"veth%d" % (i + count // 10): metrics.NetworkStats(i * 2000, i * 600, i * 20, i * 6)
+              for i in range(count)}
+    previous = metrics.Metrics()
+    previous.add_interface_stats(first)
+
+    def add():
+        m = metrics.Metrics(last_metric=previous)
+        m.add_interface_stats(second)
+        return m.interface_stats
+    best = measure(add, repeat)
+    print("{:<10} {:10.3f} ms {:8.3f} us/interface".format("delta", best * 1000, best * 1e6 / count))
+
+
+def measure(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>8} {:>14} {:>14}".format("entries", "record set ms", "list scan ms"))
+    for size in SIZES:
+        conns = connections(size)
+        port_list = ports(size)
+        current = measure(lambda: add_entries(conns, port_list), args.repeat)
+        if size <= LEGACY_MAX_SIZE:
+            legacy = "{:14.2f}".format(measure(lambda: legacy_add_entries(conns, port_list), args.repeat) * 1000)
+        else:
+            legacy = "{:>14}".format("skipped")
+        print("{:>8} {:14.2f} {}".format(size, current * 1000, legacy))
+
+    measure_memory(10000)
+    measure_tags(10000, args.repeat)
+    measure_steady_state(50000, args.repeat)
+    measure_interface_stats(500, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
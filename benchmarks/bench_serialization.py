@@ -0,0 +1,87 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Encode throughput and peak memory of metrics reports with large, unsampled connection lists.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_serialization
+"""
+
+import argparse
+import io
+import timeit
+import tracemalloc
+
+import cbor
+
+from AWSIoTDeviceDefenderAgentSDK import metrics
+
+SIZES = (50, 1000, 10000)
+
+
+def build_metrics(count):
+    m = metrics.Metrics()
+    m.max_list_size = None
+    for i in range(count):
+        m.add_network_connection("11.0.%d.%d" % (i // 256 % 256, i % 256), 443, "eth0", 1024 + i % 60000)
+    m.add_listening_ports("TCP", [{'port': 22, 'interface': 'eth0'}])
+    m.add_listening_ports("UDP", [{'port': 68}])
+    m.add_cpu_usage(12.5)
+    return m
+
+
+def uncached(m, encode):
+    """Drop the cached samples and report, so every run renders from the stored records."""
+    def run():
+        m._samples = m._report = None
+        return encode(m)
+    return run
+
+
+ENCODERS = (
+    ("cbor.dumps(dict tree)", lambda m: cbor.dumps(m._v1_metrics())),
+    ("to_cbor", lambda m: m.to_cbor()),
+    ("json.dumps(dict tree)", lambda m: m.to_json_string().encode('utf-8')),
+    ("write_json", lambda m: m.write_json(io.BytesIO()).getvalue()),
+)
+
+
+def peak_memory(run):
+    """Peak memory allocated while running, in bytes."""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for size in SIZES:
+        m = build_metrics(size)
+        print("\n{} connections, {} bytes".format(size, len(m.to_cbor())))
+        for name, encode in ENCODERS:
+            best = min(timeit.repeat(uncached(m, encode), number=1, repeat=args.repeat))
+            peak = peak_memory(uncached(m, encode))
+            print("{:<24} {:10.3f} ms {:10.0f} connections/s {:10.1f} KiB peak".format(
+                name, best * 1000, size / best, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
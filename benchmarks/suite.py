@@ -0,0 +1,274 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+"""
+Benchmark suite of collection, metrics construction and serialization, compared against stored baselines.
+
+Every case runs on fixed synthetic inputs, psutil is replaced by prebuilt socket tables, so results only vary with
+the code and the machine. Run from the repository root::
+
+    python -m benchmarks.suite                  # compare with benchmarks/baseline.json
+    python -m benchmarks.suite -k to_cbor       # only the cases whose name contains to_cbor
+    python -m benchmarks.suite --save           # store the results as the new baseline
+
+The suite exits with status 1 when a case is slower than its baseline by more than ``--threshold``. Baselines
+are only comparable on the machine and Python version they were recorded with, save new ones before comparing
+elsewhere.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import timeit
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from unittest import mock
+
+import psutil
+
+from AWSIoTDeviceDefenderAgentSDK import collector, metrics
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# A case slower than its baseline by more than this fraction is a regression
+THRESHOLD = 0.25
+REPEAT = 7
+# Each repeat calls a case enough times to last at least this long, in seconds
+MIN_TIME = 0.2
+
+addr = namedtuple("addr", "ip port")
+sconn = namedtuple("sconn", "fd family type laddr raddr status pid")
+snicaddr = namedtuple("snicaddr", "family address netmask broadcast ptp")
+snetio = namedtuple("snetio", "bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout")
+
+# name -> context manager factory yielding the callable to time
+CASES = OrderedDict()
+
+
+def benchmark(name, sizes):
+    """Register a case for each size, as ``name[size]``."""
+    def register(factory):
+        for size in sizes:
+            CASES["{}[{}]".format(name, size)] = partial(contextmanager(factory), size)
+        return factory
+    return register
+
+
+def socket_table(count):
+    """psutil ``net_connections`` of a host with ``count`` sockets: 10% listening TCP, 10% UDP, the rest established."""
+    conns = []
+    for i in range(count):
+        local = addr("10.0.0.1", 1024 + i % 60000)
+        if i % 10 == 0:
+            conns.append(sconn(-1, socket.AF_INET, socket.SOCK_DGRAM, local, (), psutil.CONN_NONE, None))
+        elif i % 10 == 1:
+            conns.append(sconn(-1, socket.AF_INET, socket.SOCK_STREAM, local, (), psutil.CONN_LISTEN, None))
+        else:
+            conns.append(sconn(-1, socket.AF_INET, socket.SOCK_STREAM, local,
+                               addr("11.%d.%d.%d" % (i // 65536 % 256, i // 256 % 256, i % 256), 443),
+                               psutil.CONN_ESTABLISHED, None))
+    return conns
+
+
+def connections(count):
+    return [("11.0.%d.%d" % (i // 256 % 256, i % 256), 443, "eth0", 1024 + i % 60000) for i in range(count)]
+
+
+def populated(count):
+    m = metrics.Metrics()
+    m.max_list_size = None
+    for conn in connections(count):
+        m.add_network_connection(*conn)
+    m.add_listening_ports("TCP", [{'port': port, 'interface': "eth0"} for port in range(1, 101)])
+    m.add_listening_ports("UDP", [{'port': port} for port in range(1, 11)])
+    m.add_network_stats(1000, 2000, 10, 20)
+    m.add_cpu_usage(12.5)
+    return m
+
+
+def uncached(m, encode):
+    """Drop the cached samples, rendered entries and report, so every call renders from the stored records."""
+    def run():
+        m._samples = m._rendered = m._report = None
+        return encode(m)
+    return run
+
+
+@benchmark("collect_metrics", (100, 10000, 100000))
+def collect_metrics(sockets):
+    table = socket_table(sockets)
+    with mock.patch.object(collector.ps, "net_connections", lambda kind='inet': list(table)), \
+            mock.patch.object(collector.ps, "net_if_addrs",
+                              lambda: {"eth0": [snicaddr(socket.AF_INET, "10.0.0.1", None, None, None)]}), \
+            mock.patch.object(collector.ps, "net_io_counters",
+                              lambda pernic=False: snetio(2000, 1000, 20, 10, 0, 0, 0, 0)):
+        coll = collector.Collector(use_custom_metrics=False)
+        try:
+            coll.collect_metrics()
+            yield coll.collect_metrics
+        finally:
+            coll.close()
+
+
+@benchmark("add_network_connection", (1000, 50000))
+def add_network_connection(count):
+    # every connection is added twice, the second time as a duplicate
+    conns = connections(count // 2) * 2
+
+    def run():
+        m = metrics.Metrics()
+        for conn in conns:
+            m.add_network_connection(*conn)
+        return m
+    yield run
+
+
+@benchmark("v1_metrics", (50, 1000, 10000))
+def v1_metrics(count):
+    yield uncached(populated(count), lambda m: m._v1_metrics())
+
+
+@benchmark("to_json_string", (50, 1000, 10000))
+def to_json_string(count):
+    yield uncached(populated(count), lambda m: m.to_json_string())
+
+
+@benchmark("to_cbor", (50, 1000, 10000))
+def to_cbor(count):
+    yield uncached(populated(count), lambda m: m.to_cbor())
+
+
+def measure(run, repeat=REPEAT, min_time=MIN_TIME):
+    """
+    Best CPU time of one call of ``run`` in seconds, over ``repeat`` repeats of at least ``min_time`` each.
+
+    CPU time of the process rather than wall time, and the best repeat, keep other load on the machine out of the
+    measurement as far as possible.
+    """
+    timer = partial(timeit.Timer, run, timer=time.process_time)
+    number = 1
+    while True:
+        elapsed = timer().timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed > min_time / 10 else 10
+    times = [elapsed] + timer().repeat(max(0, repeat - 1), number)
+    return min(times) / number
+
+
+def machine():
+    return OrderedDict((("python", platform.python_version()),
+                        ("implementation", platform.python_implementation()),
+                        ("platform", platform.platform()),
+                        ("processor", platform.processor() or platform.machine()),
+                        ("cpus", os.cpu_count())))
+
+
+def run_cases(pattern=None, repeat=REPEAT, min_time=MIN_TIME):
+    """Time every case whose name contains ``pattern``, returns their times in seconds by name."""
+    results = OrderedDict()
+    for name, factory in CASES.items():
+        if pattern and pattern not in name:
+            continue
+        with factory() as run:
+            gc.collect()
+            results[name] = measure(run, repeat, min_time)
+        print("{:<32} {:12.3f} ms".format(name, results[name] * 1000))
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compare times with baseline times.
+
+    Returns
+    -------
+        A list of ``(name, baseline, time, ratio, status)`` tuples, status being ``new``, ``ok``, ``faster`` or
+        ``REGRESSION``.
+    """
+    rows = []
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            rows.append((name, None, seconds, None, "new"))
+            continue
+        ratio = seconds / reference
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, reference, seconds, ratio, status))
+    return rows
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def save_baseline(path, results, previous=None):
+    """Store results, keeping the baselines of cases that were not run."""
+    stored = OrderedDict(previous["results"]) if previous else OrderedDict()
+    stored.update(results)
+    with open(path, "w") as f:
+        json.dump(OrderedDict((("machine", machine()), ("results", stored))), f, indent=2)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("-k", dest="pattern", default=None, help="Only run cases whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline file")
+    parser.add_argument("--save", action="store_true", help="Store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="Slowdown over the baseline reported as a regression, 0.25 for 25%%")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, dest="min_time")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if os.path.exists(args.baseline) else None
+    results = run_cases(args.pattern, args.repeat, args.min_time)
+
+    if args.save:
+        save_baseline(args.baseline, results, baseline)
+        print("Saved {} result(s) to {}".format(len(results), args.baseline))
+        return 0
+    if baseline is None:
+        print("No baseline at {}, store one with --save".format(args.baseline))
+        return 0
+
+    if baseline["machine"] != machine():
+        print("\nWarning: the baseline was recorded on another machine, {}".format(dict(baseline["machine"])))
+    rows = compare(results, baseline["results"], args.threshold)
+    print("\n{:<32} {:>12} {:>12} {:>8}".format("case", "baseline ms", "ms", "ratio"))
+    for name, reference, seconds, ratio, status in rows:
+        print("{:<32} {:>12} {:12.3f} {:>8} {}".format(
+            name, "-" if reference is None else "{:.3f}".format(reference * 1000), seconds * 1000,
+            "-" if ratio is None else "{:.2f}".format(ratio), status))
+    regressions = [row for row in rows if row[4] == "REGRESSION"]
+    if regressions:
+        print("\n{} case(s) slower than their baseline by more than {:.0%}".format(len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())